@@ -0,0 +1,62 @@
+"""Activity submissions as they were queued and batched before.
+
+Queued activities used to be JSON encoded activity submissions with a base64
+encoded body, which batch-sender joined into JSON batches as they were. The
+package only decodes such queued activities anymore, the rest is kept here to
+compare against.
+"""
+
+import json
+from collections.abc import Iterable
+from datetime import datetime
+from typing import Any
+
+from activitypub_federation_queue_batcher.types import SerializableActivitySubmission
+
+_encoder = json.JSONEncoder(separators=(",", ":"))
+
+
+def _activity_submission_to_dict(
+    activity: SerializableActivitySubmission,
+) -> dict[str, Any]:
+    return {
+        "time": activity.time.isoformat(),
+        "activity_id": activity.activity_id,
+        "host": activity.host,
+        "path": activity.path,
+        "headers": activity.headers,
+        "b64_body": activity.b64_body,
+    }
+
+
+def encode_activity_submission(activity: SerializableActivitySubmission) -> bytes:
+    return _encoder.encode(_activity_submission_to_dict(activity)).encode()
+
+
+def encode_activity_submissions(
+    activities: Iterable[SerializableActivitySubmission],
+) -> bytes:
+    return _encoder.encode(
+        [_activity_submission_to_dict(a) for a in activities],
+    ).encode()
+
+
+def decode_activity_submissions(
+    data: bytes | str,
+) -> list[SerializableActivitySubmission]:
+    return [
+        SerializableActivitySubmission(
+            time=datetime.fromisoformat(d["time"]),
+            activity_id=d["activity_id"],
+            host=d["host"],
+            path=d["path"],
+            headers=d["headers"],
+            b64_body=d["b64_body"],
+        )
+        for d in json.loads(data)
+    ]
+
+
+def join_encoded_activity_submissions(encoded: Iterable[bytes]) -> bytes:
+    """Build a batch from activity submissions which are already encoded."""
+    return b"[" + b",".join(encoded) + b"]"
@@ -0,0 +1,126 @@
+"""Generator for realistic looking ActivityPub deliveries as sent by Lemmy."""
+
+import json
+import random
+from base64 import b64encode
+from datetime import UTC, datetime
+from email.utils import format_datetime
+from hashlib import sha256
+from uuid import uuid4
+
+from activitypub_federation_queue_batcher.types import SerializableActivitySubmission
+
+SOURCE_DOMAIN = "lemmy.world"
+DESTINATION_DOMAIN = "myinstance.tld"
+
+COMMUNITIES = [f"https://{SOURCE_DOMAIN}/c/community{i}" for i in range(50)]
+USERS = [f"https://{SOURCE_DOMAIN}/u/user{i}" for i in range(500)]
+
+# Rough distribution of activity types seen in Lemmy federation traffic
+ACTIVITY_TYPES = {
+    "Like": 45,
+    "Dislike": 5,
+    "Create": 25,
+    "Update": 10,
+    "Delete": 3,
+    "Undo": 7,
+    "Follow": 5,
+}
+
+
+def _note(rng: random.Random, actor: str, community: str) -> dict[str, object]:
+    return {
+        "type": "Note",
+        "id": f"https://{SOURCE_DOMAIN}/comment/{rng.randrange(10**8)}",
+        "attributedTo": actor,
+        "to": ["https://www.w3.org/ns/activitystreams#Public"],
+        "cc": [community, f"{community}/followers"],
+        "content": "<p>" + " ".join("lorem" for _ in range(rng.randrange(5, 400))),
+        "mediaType": "text/html",
+        "source": {"content": "lorem ipsum", "mediaType": "text/markdown"},
+        "inReplyTo": f"https://{SOURCE_DOMAIN}/post/{rng.randrange(10**7)}",
+        "published": datetime.now(UTC).isoformat(),
+        "distinguished": False,
+        "language": {"identifier": "en", "name": "English"},
+        "audience": community,
+    }
+
+
+def generate_activity(rng: random.Random | None = None) -> dict[str, object]:
+    rng = rng or random.Random()
+    actor = rng.choice(USERS)
+    community = rng.choice(COMMUNITIES)
+    activity_type = rng.choices(
+        list(ACTIVITY_TYPES),
+        weights=list(ACTIVITY_TYPES.values()),
+    )[0]
+
+    inner: dict[str, object] = {
+        "id": f"https://{SOURCE_DOMAIN}/activities/{activity_type.lower()}/{uuid4()}",
+        "actor": actor,
+        "type": activity_type,
+        "audience": community,
+    }
+    if activity_type in ("Create", "Update"):
+        inner["object"] = _note(rng, actor, community)
+        inner["to"] = ["https://www.w3.org/ns/activitystreams#Public"]
+        inner["cc"] = [community]
+    else:
+        inner["object"] = f"https://{SOURCE_DOMAIN}/comment/{rng.randrange(10**8)}"
+
+    # Lemmy wraps everything sent to community followers into an Announce
+    return {
+        "@context": [
+            "https://join-lemmy.org/context.json",
+            "https://www.w3.org/ns/activitystreams",
+        ],
+        "actor": community,
+        "to": ["https://www.w3.org/ns/activitystreams#Public"],
+        "object": inner,
+        "cc": [f"{community}/followers"],
+        "type": "Announce",
+        "id": f"https://{SOURCE_DOMAIN}/activities/announce/{uuid4()}",
+    }
+
+
+def generate_headers(activity: dict[str, object], body: bytes) -> list[list[str]]:
+    digest = b64encode(sha256(body).digest()).decode()
+    return [
+        ["Host", DESTINATION_DOMAIN],
+        ["X-Real-IP", "10.20.30.40"],
+        ["X-Forwarded-For", "10.20.30.40"],
+        ["X-Forwarded-Proto", "https"],
+        ["Connection", "close"],
+        ["Content-Length", str(len(body))],
+        ["Content-Type", "application/activity+json"],
+        ["Date", format_datetime(datetime.now(UTC), usegmt=True)],
+        ["Digest", f"SHA-256={digest}"],
+        [
+            "Signature",
+            f'keyId="{activity["actor"]}#main-key",algorithm="hs2019",'
+            'headers="(request-target) content-type date digest host",'
+            f'signature="{b64encode(random.randbytes(256)).decode()}"',
+        ],
+        ["Accept", "*/*"],
+        ["User-Agent", f"Lemmy/0.19.3; +https://{SOURCE_DOMAIN}"],
+        ["Accept-Encoding", "gzip"],
+    ]
+
+
+def generate_submission(
+    rng: random.Random | None = None,
+) -> tuple[SerializableActivitySubmission, bytes]:
+    activity = generate_activity(rng)
+    body = json.dumps(activity).encode()
+
+    return (
+        SerializableActivitySubmission(
+            time=datetime.now(UTC),
+            activity_id=str(activity["id"]),
+            host=DESTINATION_DOMAIN,
+            path="/inbox",
+            headers=generate_headers(activity, body),
+            b64_body=b64encode(body).decode(),
+        ),
+        body,
+    )
@@ -0,0 +1,202 @@
+"""Simulate batch-sender with static and adaptive batch sizes and wait times.
+
+Replays synthetic activity arrival patterns through a model of the batch
+pipeline: a batch is collected once a pipeline slot is free, reaches
+batch-receiver after half a round trip, waits for upstream to finish previous
+batches, and its results stream back as upstream processes each activity.
+The same model drives the static configuration and the adaptive controller.
+"""
+
+import argparse
+import heapq
+import random
+import statistics
+from bisect import bisect_right
+from collections.abc import Callable
+from typing import Protocol
+
+from activitypub_federation_queue_batcher._adaptive_batch_helpers import (
+    AdaptiveBatchController,
+)
+
+
+class BatchPolicy(Protocol):
+    size: int
+    wait: float
+
+    def record_collected(self, count: int, backlog: int, now: float) -> None: ...
+
+    def record_completed(
+        self,
+        count: int,
+        first_result_after: float,
+        last_result_after: float,
+    ) -> None: ...
+
+
+class StaticPolicy:
+    def __init__(self, size: int, wait: float) -> None:
+        self.size = size
+        self.wait = wait
+
+    def record_collected(self, count: int, backlog: int, now: float) -> None:
+        pass
+
+    def record_completed(
+        self,
+        count: int,
+        first_result_after: float,
+        last_result_after: float,
+    ) -> None:
+        pass
+
+
+def poisson(rng: random.Random, rate: float, start: float, end: float) -> list[float]:
+    arrivals = []
+    t = start + rng.expovariate(rate)
+    while t < end:
+        arrivals.append(t)
+        t += rng.expovariate(rate)
+    return arrivals
+
+
+SCENARIOS: dict[str, Callable[[random.Random], list[float]]] = {
+    # A few activities per second, batches rarely fill up
+    "idle": lambda rng: poisson(rng, 2, 0, 120),
+    "steady": lambda rng: poisson(rng, 150, 0, 60),
+    # Backlog after an outage, followed by regular traffic
+    "backlog": lambda rng: sorted(
+        [0.0] * 10000 + poisson(rng, 20, 0, 120),
+    ),
+    # Alternating quiet periods and bursts
+    "bursty": lambda rng: sorted(
+        t
+        for period in range(6)
+        for t in (
+            poisson(rng, 5, period * 40, period * 40 + 30)
+            + poisson(rng, 400, period * 40 + 30, period * 40 + 40)
+        )
+    ),
+}
+
+
+def simulate(
+    arrivals: list[float],
+    policy: BatchPolicy,
+    *,
+    rtt: float,
+    processing_time: float,
+    pipeline_depth: int,
+) -> tuple[list[float], int]:
+    """Return the latency of each activity and the number of batches sent."""
+    latencies: list[float] = []
+    batches = 0
+
+    # Times at which pipeline slots become free again
+    slots = [0.0] * pipeline_depth
+    # Batches whose results haven't been passed to the policy yet
+    completions: list[tuple[float, int, float, float]] = []
+    upstream_free = 0.0
+    now = 0.0
+    i = 0
+
+    def complete_until(t: float) -> None:
+        while len(completions) > 0 and completions[0][0] <= t:
+            _, count, first, last = heapq.heappop(completions)
+            policy.record_completed(count, first, last)
+
+    while i < len(arrivals):
+        now = max(now, heapq.heappop(slots), arrivals[i])
+        complete_until(now)
+
+        size, wait = policy.size, policy.wait
+        deadline = now + wait
+        last = i + size - 1
+        # The batch is sent once it's full or the deadline passed
+        sent_at = (
+            max(now, arrivals[last])
+            if last < len(arrivals) and arrivals[last] <= deadline
+            else deadline
+        )
+        end = bisect_right(arrivals, sent_at, i, min(i + size, len(arrivals)))
+        batch = arrivals[i:end]
+        i = end
+        now = sent_at
+        complete_until(now)
+        policy.record_collected(
+            len(batch),
+            bisect_right(arrivals, now, i) - i,
+            now,
+        )
+
+        start = max(now + rtt / 2, upstream_free)
+        upstream_free = start + len(batch) * processing_time
+        latencies.extend(
+            start + (k + 1) * processing_time + rtt / 2 - arrival
+            for k, arrival in enumerate(batch)
+        )
+        first_result = start + processing_time + rtt / 2
+        last_result = upstream_free + rtt / 2
+        heapq.heappush(
+            completions,
+            (last_result, len(batch), first_result - now, last_result - now),
+        )
+        heapq.heappush(slots, last_result)
+        batches += 1
+
+    return latencies, batches
+
+
+def report(label: str, latencies: list[float], batches: int) -> None:
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(
+        f"  {label:>8}: p50 {quantiles[49]:7.3f}s, p99 {quantiles[98]:7.3f}s,"
+        f" max {max(latencies):8.3f}s, {batches:6} batches,"
+        f" {len(latencies) / batches:6.1f} activities per batch",
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rtt", type=float, default=0.3)
+    parser.add_argument(
+        "--processing-time",
+        type=float,
+        default=0.005,
+        help="seconds upstream takes per activity",
+    )
+    parser.add_argument("--pipeline-depth", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--max-wait", type=float, default=3)
+    parser.add_argument("--scenario", choices=SCENARIOS, action="append")
+    args = parser.parse_args()
+
+    for name in args.scenario or SCENARIOS:
+        arrivals = SCENARIOS[name](random.Random(0))
+        print(f"{name}: {len(arrivals)} activities")
+
+        policies: dict[str, BatchPolicy] = {
+            "static": StaticPolicy(args.batch_size, args.max_wait),
+            "adaptive": AdaptiveBatchController(
+                min_size=1,
+                max_size=args.batch_size,
+                min_wait=0,
+                max_wait=args.max_wait,
+                pipeline_depth=args.pipeline_depth,
+            ),
+        }
+        for label, policy in policies.items():
+            report(
+                label,
+                *simulate(
+                    arrivals,
+                    policy,
+                    rtt=args.rtt,
+                    processing_time=args.processing_time,
+                    pipeline_depth=args.pipeline_depth,
+                ),
+            )
+
+
+if __name__ == "__main__":
+    main()
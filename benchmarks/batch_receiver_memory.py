@@ -0,0 +1,185 @@
+"""Report peak memory of batch-receiver while it processes a batch.
+
+batch-receiver runs in a separate process tracing its allocations, while
+batches of generated activities are posted to it from this process, which also
+runs a stand-in for upstream. The peak is compared with decoding the whole
+batch at once as batch-receiver did before streaming batches, which is
+measured in this process.
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import multiprocessing.connection
+import os
+import random
+import tempfile
+import tracemalloc
+from base64 import b64decode
+from pathlib import Path
+
+os.environ.setdefault("LOGLEVEL", "WARNING")
+os.environ.setdefault("BATCH_RECEIVER_MAX_BATCH_SIZE", str(2**30))
+os.environ["BATCH_RECEIVER_UPSTREAM_UNIX_SOCKET"] = str(
+    Path(tempfile.gettempdir()) / f"apub-batcher-benchmark-{os.getpid()}.sock",
+)
+os.environ["OVERRIDE_DESTINATION_PROTOCOL"] = "http"
+
+import aiohttp.web
+from _legacy_codec import decode_activity_submissions
+from _payloads import generate_submission
+
+from activitypub_federation_queue_batcher._batch_helpers import (
+    BATCH_CONTENT_ENCODING_HEADER,
+    BINARY_BATCH_CONTENT_TYPE,
+)
+from activitypub_federation_queue_batcher._compression_helpers import (
+    BatchCompressor,
+)
+from activitypub_federation_queue_batcher.batch_receiver import (
+    __main__ as batch_receiver,
+)
+from activitypub_federation_queue_batcher.batch_sender import __main__ as batch_sender
+from activitypub_federation_queue_batcher.codec import (
+    encode_binary_batch,
+    encode_json_batch,
+    iter_binary_batch,
+)
+
+UPSTREAM_SOCKET = Path(os.environ["BATCH_RECEIVER_UPSTREAM_UNIX_SOCKET"])
+RECEIVER_SOCKET = UPSTREAM_SOCKET.with_suffix(".receiver.sock")
+
+
+async def memory_handler(_request: aiohttp.web.Request) -> aiohttp.web.Response:
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    return aiohttp.web.json_response({"current": current, "peak": peak})
+
+
+async def serve_receiver(ready: multiprocessing.connection.Connection) -> None:
+    app = await batch_receiver.init()
+    app.add_routes([aiohttp.web.get("/benchmark/memory", memory_handler)])
+
+    runner = aiohttp.web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await aiohttp.web.UnixSite(runner, str(RECEIVER_SOCKET)).start()
+
+    tracemalloc.start()
+    ready.send(obj=True)
+    await asyncio.Event().wait()
+
+
+def run_receiver(ready: multiprocessing.connection.Connection) -> None:
+    asyncio.run(serve_receiver(ready))
+
+
+async def upstream_handler(request: aiohttp.web.Request) -> aiohttp.web.Response:
+    await request.read()
+    return aiohttp.web.Response(status=202)
+
+
+def measure_buffered(body: bytes, *, binary: bool) -> int:
+    """Peak memory of decoding the batch at once, including a copy of it."""
+    tracemalloc.start()
+    data = bytes(body)
+    activities = (
+        list(iter_binary_batch(data))
+        if binary
+        else [
+            (activity, b64decode(activity.b64_body))
+            for activity in decode_activity_submissions(data)
+        ]
+    )
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del activities
+    return peak
+
+
+async def run(args: argparse.Namespace) -> None:
+    upstream_app = aiohttp.web.Application()
+    upstream_app.add_routes([aiohttp.web.post("/{path:.*}", upstream_handler)])
+    upstream_runner = aiohttp.web.AppRunner(upstream_app, access_log=None)
+    await upstream_runner.setup()
+    await aiohttp.web.UnixSite(upstream_runner, str(UPSTREAM_SOCKET)).start()
+
+    compressor = (
+        BatchCompressor(args.compression) if args.compression != "none" else None
+    )
+    rng = random.Random(0)
+
+    async with aiohttp.ClientSession(
+        connector=aiohttp.UnixConnector(path=str(RECEIVER_SOCKET)),
+    ) as cs:
+        for count in args.activities or [100, 1000, 5000]:
+            submissions = [generate_submission(rng) for _ in range(count)]
+
+            for binary in (False, True):
+                if binary:
+                    content_type = BINARY_BATCH_CONTENT_TYPE
+                    batch = encode_binary_batch(submissions)
+                else:
+                    content_type = "application/json"
+                    batch = encode_json_batch(submissions)
+
+                headers = {
+                    **batch_sender.get_batch_request_headers(),
+                    aiohttp.hdrs.CONTENT_TYPE: content_type,
+                }
+                body = batch
+                if compressor is not None:
+                    body = compressor.compress(batch)
+                    headers[BATCH_CONTENT_ENCODING_HEADER] = compressor.encoding
+
+                async with cs.get("http://receiver/benchmark/memory") as resp:
+                    before = (await resp.json())["current"]
+                async with cs.post(
+                    "http://receiver/batch",
+                    data=body,
+                    headers=headers,
+                ) as resp:
+                    resp.raise_for_status()
+                    results = (await resp.read()).splitlines()
+                    assert len(results) == count  # noqa: S101
+                async with cs.get("http://receiver/benchmark/memory") as resp:
+                    peak = (await resp.json())["peak"] - before
+
+                buffered = measure_buffered(batch, binary=binary)
+                print(
+                    f"{count:6} activities, {'binary' if binary else 'json':>6}"
+                    f" batch of {len(batch) / 1024**2:7.2f}MiB"
+                    f" ({len(body) / 1024**2:7.2f}MiB sent):"
+                    f" streamed {peak / 1024**2:7.2f}MiB peak,"
+                    f" buffered {buffered / 1024**2:7.2f}MiB peak",
+                )
+
+    await upstream_runner.cleanup()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--activities", type=int, action="append")
+    parser.add_argument(
+        "--compression",
+        choices=["none", "gzip", "br", "zstd"],
+        default="none",
+    )
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("fork")
+    ready, ready_child = context.Pipe()
+    receiver = context.Process(target=run_receiver, args=(ready_child,))
+    receiver.start()
+
+    try:
+        ready.recv()
+        asyncio.run(run(args))
+    finally:
+        receiver.terminate()
+        receiver.join()
+        UPSTREAM_SOCKET.unlink(missing_ok=True)
+        RECEIVER_SOCKET.unlink(missing_ok=True)
+
+
+if __name__ == "__main__":
+    main()
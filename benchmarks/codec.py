@@ -0,0 +1,155 @@
+"""Compare the JSON codec against the previous dataclasses-json serialization.
+
+Measures the serialization work done for one batch on every hop:
+inbox-receiver encoding each message, batch-sender decoding each message and
+encoding the batch, batch-receiver decoding the batch and encoding the
+responses, and batch-sender decoding the responses.
+
+Requires dataclasses-json, which is part of the `benchmark` dependency group.
+"""
+
+import random
+import timeit
+from collections.abc import Callable
+from dataclasses import asdict, dataclass, field
+from datetime import UTC, datetime
+from functools import partial
+
+from _legacy_codec import (
+    decode_activity_submissions,
+    encode_activity_submission,
+    join_encoded_activity_submissions,
+)
+from _payloads import generate_submission
+from dataclasses_json import DataClassJsonMixin, config
+from marshmallow import fields
+
+from activitypub_federation_queue_batcher.codec import (
+    decode_activity_submission,
+    decode_upstream_submission_responses,
+    encode_upstream_submission_responses,
+)
+from activitypub_federation_queue_batcher.types import (
+    SerializableActivitySubmission,
+    UpstreamSubmissionResponse,
+)
+
+BATCH_SIZES = (100, 1000)
+REPEAT = 5
+
+
+# Copies of the types as they were defined with dataclasses-json
+@dataclass
+class LegacySerializableActivitySubmission(DataClassJsonMixin):
+    time: datetime = field(
+        metadata=config(
+            encoder=datetime.isoformat,
+            decoder=datetime.fromisoformat,
+            mm_field=fields.DateTime(format="iso"),
+        ),
+    )
+    activity_id: str
+    host: str
+    path: str
+    headers: list[list[str]]
+    b64_body: str
+
+
+@dataclass
+class LegacyUpstreamSubmissionResponse(DataClassJsonMixin):
+    time: datetime = field(
+        metadata=config(
+            encoder=datetime.isoformat,
+            decoder=datetime.fromisoformat,
+            mm_field=fields.DateTime(format="iso"),
+        ),
+    )
+    activity_id: str
+    status: int
+    headers: list[list[str]]
+    content_type: str | None
+    body: str | None
+
+
+def legacy_round_trip(
+    activities: list[LegacySerializableActivitySubmission],
+    responses: list[LegacyUpstreamSubmissionResponse],
+) -> None:
+    schema = LegacySerializableActivitySubmission.schema
+    messages = [schema().dumps(a).encode() for a in activities]
+    decoded: list[LegacySerializableActivitySubmission] = [
+        schema().loads(m.decode())  # type: ignore[misc]
+        for m in messages
+    ]
+    batch = schema().dumps(decoded, many=True).encode()
+    schema().loads(batch, many=True)
+
+    response_schema = LegacyUpstreamSubmissionResponse.schema
+    t = response_schema().dumps(responses, many=True)
+    response_schema().loads(t, many=True)
+
+
+def codec_round_trip(
+    activities: list[SerializableActivitySubmission],
+    responses: list[UpstreamSubmissionResponse],
+) -> None:
+    messages = [encode_activity_submission(a) for a in activities]
+    for m in messages:
+        decode_activity_submission(m)
+    batch = join_encoded_activity_submissions(messages)
+    decode_activity_submissions(batch)
+
+    decode_upstream_submission_responses(
+        encode_upstream_submission_responses(responses),
+    )
+
+
+def best_of(fn: Callable[[], None], number: int) -> float:
+    return min(timeit.repeat(fn, number=number, repeat=REPEAT)) / number
+
+
+def main() -> None:
+    rng = random.Random(0)
+
+    for batch_size in BATCH_SIZES:
+        activities = [generate_submission(rng)[0] for _ in range(batch_size)]
+        responses = [
+            UpstreamSubmissionResponse(
+                time=datetime.now(UTC),
+                activity_id=a.activity_id,
+                status=200,
+                headers=[["Content-Type", "application/json"], ["Vary", "Origin"]],
+                content_type="application/json",
+                body=None,
+            )
+            for a in activities
+        ]
+
+        legacy_activities = [
+            LegacySerializableActivitySubmission(**asdict(a)) for a in activities
+        ]
+        # The index of partitioned batches didn't exist with dataclasses-json
+        legacy_responses = [
+            LegacyUpstreamSubmissionResponse(
+                **{k: v for k, v in asdict(r).items() if k != "index"},
+            )
+            for r in responses
+        ]
+
+        number = max(1, 1000 // batch_size)
+        legacy = best_of(
+            partial(legacy_round_trip, legacy_activities, legacy_responses),
+            number,
+        )
+        codec = best_of(partial(codec_round_trip, activities, responses), number)
+
+        print(
+            f"batch of {batch_size:>5}: "
+            f"dataclasses-json {legacy * 1000:8.2f} ms, "
+            f"codec {codec * 1000:8.2f} ms, "
+            f"speedup {legacy / codec:5.1f}x",
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Compare batch compression settings over a generated sample corpus.
+
+Reports the compression ratio as well as compression and decompression CPU
+time per batch for both batch formats. The zstd dictionary is trained on a
+separate set of generated activities, similar to what the
+train-zstd-dictionary tool does with queued activities.
+"""
+
+import random
+import time
+from base64 import b64decode
+
+import zstandard
+from _legacy_codec import (
+    encode_activity_submission,
+    join_encoded_activity_submissions,
+)
+from _payloads import generate_submission
+
+from activitypub_federation_queue_batcher._compression_helpers import (
+    BatchCompressor,
+    BatchDecompressor,
+)
+from activitypub_federation_queue_batcher.codec import encode_binary_batch
+from activitypub_federation_queue_batcher.types import SerializableActivitySubmission
+
+BATCH_SIZE = 100
+BATCHES = 20
+DICTIONARY_SAMPLES = 2000
+DICTIONARY_SIZE = 112640
+
+SETTINGS: list[tuple[str, int | None]] = [
+    ("gzip", 1),
+    ("gzip", 6),
+    ("br", 1),
+    ("br", 5),
+    ("zstd", 1),
+    ("zstd", 3),
+    ("zstd", 9),
+]
+
+
+def encode(
+    activities: list[SerializableActivitySubmission],
+    *,
+    binary: bool,
+) -> bytes:
+    if binary:
+        return encode_binary_batch((a, b64decode(a.b64_body)) for a in activities)
+
+    return join_encoded_activity_submissions(
+        encode_activity_submission(a) for a in activities
+    )
+
+
+def measure(
+    label: str,
+    batches: list[bytes],
+    compressor: BatchCompressor,
+    decompressor: BatchDecompressor,
+) -> None:
+    start = time.process_time()
+    compressed = [compressor.compress(batch) for batch in batches]
+    compress_time = time.process_time() - start
+
+    start = time.process_time()
+    for c in compressed:
+        streaming = decompressor.decompressobj(compressor.encoding)
+        streaming.decompress(c)
+        streaming.finish()
+    decompress_time = time.process_time() - start
+
+    ratio = sum(map(len, batches)) / sum(map(len, compressed))
+    print(
+        f"{label:<24} ratio {ratio:6.2f}, "
+        f"compress {compress_time / len(batches) * 1000:7.2f} ms/batch, "
+        f"decompress {decompress_time / len(batches) * 1000:6.2f} ms/batch",
+    )
+
+
+def main() -> None:
+    rng = random.Random(0)
+
+    for binary in (False, True):
+        batches = [
+            encode(
+                [generate_submission(rng)[0] for _ in range(BATCH_SIZE)],
+                binary=binary,
+            )
+            for _ in range(BATCHES)
+        ]
+        samples = [
+            encode([generate_submission(rng)[0]], binary=binary)
+            for _ in range(DICTIONARY_SAMPLES)
+        ]
+        dictionary = zstandard.train_dictionary(DICTIONARY_SIZE, samples)
+
+        average_size = sum(map(len, batches)) / len(batches) / 1024
+        print(
+            f"{'binary' if binary else 'json'} batches of {BATCH_SIZE} activities, "
+            f"{average_size:.0f} KiB on average",
+        )
+
+        for encoding, level in SETTINGS:
+            measure(
+                f"{encoding} level {level}",
+                batches,
+                BatchCompressor(encoding=encoding, level=level),
+                BatchDecompressor(max_size=2**31),
+            )
+
+        for level in (1, 3, 9):
+            measure(
+                f"zstd level {level} + dict",
+                batches,
+                BatchCompressor(
+                    encoding="zstd",
+                    level=level,
+                    zstd_dictionary=dictionary,
+                ),
+                BatchDecompressor(max_size=2**31, zstd_dictionary=dictionary),
+            )
+
+        print()
+
+
+if __name__ == "__main__":
+    main()
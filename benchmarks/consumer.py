@@ -0,0 +1,213 @@
+"""Compare collecting batches via polling with the consumer based accumulator.
+
+By default a stand-in for RabbitMQ is used, which answers every basic.get
+after a simulated round trip and pushes deliveries to consumers as long as
+fewer than the prefetch count are unacknowledged. Pass `--rabbitmq HOST` to
+run against an actual RabbitMQ instance instead, this uses a temporary queue.
+"""
+
+import argparse
+import asyncio
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable, Sequence
+from datetime import UTC, datetime, timedelta
+from typing import Any, cast
+
+import aio_pika
+from aio_pika.abc import AbstractIncomingMessage, AbstractQueue
+
+from activitypub_federation_queue_batcher._queue_helpers import (
+    BatchAccumulator,
+    QueueMessage,
+)
+
+BATCH_SIZE = 100
+BATCH_MAX_WAIT = 3
+PIPELINE_DEPTH = 2
+
+
+async def get_rmq_messages_polling(
+    queue: AbstractQueue,
+    limit: int,
+    timeout: float,  # noqa: ASYNC109
+) -> list[AbstractIncomingMessage]:
+    """Copy of the polling loop previously used by batch-sender."""
+    max_wait_until = None
+
+    messages: list[AbstractIncomingMessage] = []
+    while len(messages) == 0 or (
+        len(messages) < limit
+        and max_wait_until is not None
+        and datetime.now(UTC) < max_wait_until
+    ):
+        consume_timeout = (
+            None
+            if max_wait_until is None
+            else (max_wait_until - datetime.now(UTC)).total_seconds()
+        )
+
+        msg = await queue.get(fail=False, timeout=consume_timeout)
+
+        if msg is None:
+            if len(messages) > 0:
+                return messages
+
+            await asyncio.sleep(0.1)
+            continue
+
+        messages.append(msg)
+
+        if max_wait_until is None and len(messages) > 0 and limit > 1:
+            max_wait_until = datetime.now(UTC) + timedelta(seconds=timeout)
+
+    return messages
+
+
+class StandInMessage:
+    def __init__(self, broker: "StandInBroker", body: bytes) -> None:
+        self._broker = broker
+        self.body = body
+
+    async def ack(self) -> None:
+        self._broker.unacked -= 1
+        self._broker.acked.set()
+
+
+class StandInBroker:
+    """Queue with a simulated network round trip per basic.get."""
+
+    def __init__(self, messages: int, rtt: float) -> None:
+        self.rtt = rtt
+        self.prefetch_count = 0
+        self.unacked = 0
+        self.acked = asyncio.Event()
+        self._ready = deque(StandInMessage(self, b"{}") for _ in range(messages))
+
+    async def get(
+        self,
+        *,
+        fail: bool = True,  # noqa: ARG002
+        timeout: float | None = None,  # noqa: ARG002, ASYNC109
+    ) -> StandInMessage | None:
+        await asyncio.sleep(self.rtt)
+
+        if len(self._ready) == 0:
+            return None
+
+        self.unacked += 1
+        return self._ready.popleft()
+
+    async def consume(
+        self,
+        callback: Callable[[StandInMessage], Awaitable[Any]],
+    ) -> None:
+        # Deliveries are streamed, only the first one is delayed by the
+        # round trip of basic.consume.
+        await asyncio.sleep(self.rtt)
+
+        while len(self._ready) > 0:
+            if self.prefetch_count > 0 and self.unacked >= self.prefetch_count:
+                self.acked.clear()
+                await self.acked.wait()
+                continue
+
+            self.unacked += 1
+            await callback(self._ready.popleft())
+
+
+async def drain(
+    get_batch: Callable[[], Awaitable[Sequence[QueueMessage]]],
+    messages: int,
+) -> float:
+    start = time.perf_counter()
+
+    received = 0
+    while received < messages:
+        batch = await get_batch()
+        for msg in batch:
+            await msg.ack()
+        received += len(batch)
+
+    return time.perf_counter() - start
+
+
+async def run_stand_in(messages: int, rtt: float) -> None:
+    broker = StandInBroker(messages, rtt)
+    queue = cast("AbstractQueue", broker)
+    elapsed = await drain(
+        lambda: get_rmq_messages_polling(queue, BATCH_SIZE, BATCH_MAX_WAIT),
+        messages,
+    )
+    report("polling", messages, elapsed)
+
+    broker = StandInBroker(messages, rtt)
+    broker.prefetch_count = BATCH_SIZE * PIPELINE_DEPTH
+    accumulator = BatchAccumulator()
+    consumer = asyncio.create_task(
+        broker.consume(
+            cast("Callable[[StandInMessage], Awaitable[Any]]", accumulator.on_message),
+        ),
+    )
+    elapsed = await drain(
+        lambda: accumulator.get_batch(BATCH_SIZE, BATCH_MAX_WAIT),
+        messages,
+    )
+    await consumer
+    report("consumer", messages, elapsed)
+
+
+async def run_rabbitmq(messages: int, host: str) -> None:
+    async with await aio_pika.connect(host=host) as connection:
+        channel = await connection.channel()
+        queue = await channel.declare_queue(exclusive=True, auto_delete=True)
+
+        async def publish() -> None:
+            for _ in range(messages):
+                await channel.default_exchange.publish(
+                    aio_pika.Message(b"{}"),
+                    routing_key=queue.name,
+                )
+
+        await publish()
+        elapsed = await drain(
+            lambda: get_rmq_messages_polling(queue, BATCH_SIZE, BATCH_MAX_WAIT),
+            messages,
+        )
+        report("polling", messages, elapsed)
+
+        await publish()
+        await channel.set_qos(prefetch_count=BATCH_SIZE * PIPELINE_DEPTH)
+        accumulator = BatchAccumulator()
+        await queue.consume(accumulator.on_message)
+        elapsed = await drain(
+            lambda: accumulator.get_batch(BATCH_SIZE, BATCH_MAX_WAIT),
+            messages,
+        )
+        report("consumer", messages, elapsed)
+
+
+def report(label: str, messages: int, elapsed: float) -> None:
+    print(f"{label:>8}: {messages / elapsed:>10.0f} messages/s ({elapsed:.2f}s)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument(
+        "--rtt",
+        type=float,
+        default=0.0005,
+        help="simulated round trip time in seconds for the stand-in broker",
+    )
+    parser.add_argument("--rabbitmq", metavar="HOST")
+    args = parser.parse_args()
+
+    if args.rabbitmq is not None:
+        asyncio.run(run_rabbitmq(args.messages, args.rabbitmq))
+    else:
+        asyncio.run(run_stand_in(args.messages, args.rtt))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,392 @@
+"""Run inbox-receiver, batch-sender and batch-receiver in-process under load.
+
+Generated activities are delivered to inbox-receiver, queued in the embedded
+SQLite queue, sent through a proxy adding latency to the link between
+batch-sender and batch-receiver, and submitted to a stand-in for upstream with
+configurable processing time and status codes. The service configuration is
+taken from the usual environment variables, e.g. `HTTP_BATCH_SIZE` or
+`HTTP_BATCH_PIPELINE_DEPTH`. `QUEUE_BACKEND=rabbitmq` uses RabbitMQ instead,
+the queue should be empty when starting.
+
+Reports throughput, latency from delivering an activity to inbox-receiver
+until upstream received it, also per lane if `QUEUE_LANES` is set, and CPU
+time per activity. The CPU time includes
+the load generator and the stand-ins running in the same process.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+os.environ.setdefault("LOGLEVEL", "WARNING")
+os.environ.setdefault("QUEUE_BACKEND", "sqlite")
+os.environ.setdefault(
+    "QUEUE_SQLITE_PATH",
+    str(Path(tempfile.gettempdir()) / f"apub-batcher-benchmark-{os.getpid()}.sqlite3"),
+)
+os.environ.setdefault("RABBITMQ_CHANNEL_ROUTING_KEY", "benchmark-end-to-end")
+os.environ.setdefault("INBOX_RECEIVER_MESSAGE_QUEUE_LIMIT", str(2**31))
+os.environ["BATCH_RECEIVER_UPSTREAM_UNIX_SOCKET"] = str(
+    Path(tempfile.gettempdir()) / f"apub-batcher-benchmark-{os.getpid()}.sock",
+)
+os.environ["OVERRIDE_DESTINATION_PROTOCOL"] = "http"
+
+import aiohttp.web
+from _payloads import generate_activity
+from aiohttp.test_utils import TestServer
+
+from activitypub_federation_queue_batcher._dedup_helpers import (
+    create_activity_deduplicator,
+)
+from activitypub_federation_queue_batcher._queue_helpers import (
+    get_activity_lane,
+    open_activity_queue,
+)
+from activitypub_federation_queue_batcher.batch_receiver import (
+    __main__ as batch_receiver,
+)
+from activitypub_federation_queue_batcher.batch_sender import __main__ as batch_sender
+from activitypub_federation_queue_batcher.constants import (
+    QUEUE_BACKEND,
+    QUEUE_LANE_NAMES,
+    QUEUE_SQLITE_PATH,
+)
+from activitypub_federation_queue_batcher.inbox_receiver import (
+    __main__ as inbox_receiver,
+)
+
+UPSTREAM_SOCKET = Path(os.environ["BATCH_RECEIVER_UPSTREAM_UNIX_SOCKET"])
+
+
+class Upstream:
+    """Records when each activity arrived, after simulating processing."""
+
+    def __init__(
+        self,
+        rng: random.Random,
+        latency: float,
+        jitter: float,
+        statuses: dict[int, float],
+    ) -> None:
+        self._rng = rng
+        self._latency = latency
+        self._jitter = jitter
+        self._statuses = list(statuses)
+        self._weights = list(statuses.values())
+        self.received: dict[str, float] = {}
+        self.requests = 0
+        self.done = asyncio.Event()
+        self.expected = 0
+
+    async def handler(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+        body = await request.read()
+        self.requests += 1
+
+        delay = self._latency
+        if self._jitter > 0:
+            delay += self._rng.expovariate(1 / self._jitter)
+        await asyncio.sleep(delay)
+
+        status = self._rng.choices(self._statuses, self._weights)[0]
+        if status < 300:  # noqa: PLR2004
+            self.received.setdefault(json.loads(body)["id"], time.perf_counter())
+            if len(self.received) >= self.expected:
+                self.done.set()
+
+        return aiohttp.web.Response(status=status)
+
+
+async def relay(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    delay: float,
+) -> None:
+    """Forward data after `delay` seconds, without limiting the bandwidth."""
+    loop = asyncio.get_running_loop()
+    chunks: asyncio.Queue[tuple[float, bytes]] = asyncio.Queue()
+
+    async def send() -> None:
+        while True:
+            deadline, data = await chunks.get()
+            await asyncio.sleep(deadline - loop.time())
+            if len(data) == 0:
+                writer.close()
+                return
+            writer.write(data)
+            await writer.drain()
+
+    task = asyncio.create_task(send())
+    try:
+        while data := await reader.read(2**16):
+            chunks.put_nowait((loop.time() + delay, data))
+    finally:
+        chunks.put_nowait((loop.time() + delay, b""))
+        await task
+
+
+class Link:
+    """TCP proxy to `port` delaying data by `delay` seconds in each direction."""
+
+    def __init__(self, port: int, delay: float) -> None:
+        self._port = port
+        self._delay = delay
+        self._connections: set[asyncio.Task[None]] = set()
+        self._server: asyncio.Server | None = None
+        self.port = 0
+
+    async def _handle(
+        self,
+        client_reader: asyncio.StreamReader,
+        client_writer: asyncio.StreamWriter,
+    ) -> None:
+        server_reader, server_writer = await asyncio.open_connection(
+            "127.0.0.1",
+            self._port,
+        )
+        await asyncio.gather(
+            relay(client_reader, server_writer, self._delay),
+            relay(server_reader, client_writer, self._delay),
+            return_exceptions=True,
+        )
+
+    def _on_connection(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        task = asyncio.create_task(self._handle(reader, writer))
+        self._connections.add(task)
+        task.add_done_callback(self._connections.discard)
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._on_connection, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def close(self) -> None:
+        """Wait for connections to finish, which requires both ends to be closed."""
+        if self._server is not None:
+            self._server.close()
+        await asyncio.gather(*self._connections)
+
+
+async def deliver(
+    url: str,
+    bodies: list[tuple[str, bytes]],
+    rate: float,
+    concurrency: int,
+    rng: random.Random,
+) -> dict[str, float]:
+    """Deliver activities to inbox-receiver, returning when each one started."""
+    started: dict[str, float] = {}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with aiohttp.ClientSession() as cs:
+
+        async def post(activity_id: str, body: bytes) -> None:
+            try:
+                started[activity_id] = time.perf_counter()
+                async with cs.post(
+                    url,
+                    data=body,
+                    headers={aiohttp.hdrs.CONTENT_TYPE: "application/activity+json"},
+                ) as resp:
+                    resp.raise_for_status()
+            finally:
+                semaphore.release()
+
+        async with asyncio.TaskGroup() as tg:
+            for activity_id, body in bodies:
+                await semaphore.acquire()
+                tg.create_task(post(activity_id, body))
+                if rate > 0:
+                    await asyncio.sleep(rng.expovariate(rate))
+
+    return started
+
+
+def print_latency(label: str, latencies: list[float]) -> None:
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(
+        f"{label:>12}: p50 {quantiles[49]:7.3f}s, p90 {quantiles[89]:7.3f}s,"
+        f" p99 {quantiles[98]:7.3f}s, max {max(latencies):7.3f}s",
+    )
+
+
+async def run(args: argparse.Namespace) -> None:
+    rng = random.Random(0)
+    bodies = []
+    lanes: dict[str, int] = {}
+    for _ in range(args.activities):
+        activity = generate_activity(rng)
+        bodies.append((str(activity["id"]), json.dumps(activity).encode()))
+        lanes[str(activity["id"])] = get_activity_lane(activity)
+
+    upstream = Upstream(
+        rng,
+        args.upstream_latency,
+        args.upstream_jitter,
+        dict(args.upstream_status or [(202, 1)]),
+    )
+    upstream.expected = len(bodies)
+    upstream_app = aiohttp.web.Application()
+    upstream_app.add_routes([aiohttp.web.post("/{path:.*}", upstream.handler)])
+    upstream_runner = aiohttp.web.AppRunner(upstream_app, access_log=None)
+    await upstream_runner.setup()
+    await aiohttp.web.UnixSite(upstream_runner, str(UPSTREAM_SOCKET)).start()
+
+    inbox_server = TestServer(await inbox_receiver.init())
+    await inbox_server.start_server()
+    receiver_server = TestServer(await batch_receiver.init())
+    await receiver_server.start_server()
+    link = Link(receiver_server.port or 0, args.link_delay)
+    await link.start()
+
+    queue = await open_activity_queue()
+    sender = asyncio.create_task(
+        batch_sender.run_forwarders(
+            queue,
+            f"http://127.0.0.1:{link.port}/batch",
+            batch_sender.get_batch_request_headers(),
+            create_activity_deduplicator(batch_sender.DEDUPLICATION_METRIC),
+            batch_sender.get_sender_partitions(),
+        ),
+    )
+
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    started = await deliver(
+        str(inbox_server.make_url("/inbox")),
+        bodies,
+        args.rate,
+        args.concurrency,
+        rng,
+    )
+    delivered = time.perf_counter()
+
+    try:
+        async with asyncio.timeout(args.timeout):
+            await asyncio.wait(
+                [asyncio.ensure_future(upstream.done.wait()), sender],
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+    except TimeoutError:
+        print(f"Timed out with {len(upstream.received)} activities submitted")
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+
+    sender.cancel()
+    await asyncio.gather(sender, return_exceptions=True)
+    await queue.close()
+    await inbox_server.close()
+    await receiver_server.close()
+    await link.close()
+    await upstream_runner.cleanup()
+
+    latencies = [
+        received - started[activity_id]
+        for activity_id, received in upstream.received.items()
+    ]
+    if len(latencies) < 2:  # noqa: PLR2004
+        print("Not enough activities submitted")
+        return
+
+    print(
+        f"{len(latencies)} activities in {elapsed:.2f}s"
+        f" (delivered to inbox-receiver in {delivered - start:.2f}s),"
+        f" {upstream.requests} upstream requests",
+    )
+    print(f"  throughput: {len(latencies) / elapsed:8.1f} activities/s")
+    print_latency("latency", latencies)
+    if len(QUEUE_LANE_NAMES) > 1:
+        for lane, name in enumerate(QUEUE_LANE_NAMES):
+            lane_latencies = [
+                received - started[activity_id]
+                for activity_id, received in upstream.received.items()
+                if lanes[activity_id] == lane
+            ]
+            if len(lane_latencies) >= 2:  # noqa: PLR2004
+                print_latency(name, lane_latencies)
+    print(f"         cpu: {cpu / len(latencies) * 1000:8.3f}ms per activity")
+
+
+def cleanup() -> None:
+    paths = [UPSTREAM_SOCKET]
+    # Only remove the queue if it has been created for this run
+    if QUEUE_BACKEND == "sqlite" and QUEUE_SQLITE_PATH.startswith(
+        tempfile.gettempdir(),
+    ):
+        paths.extend(
+            Path(QUEUE_SQLITE_PATH + suffix) for suffix in ("", "-wal", "-shm")
+        )
+
+    for path in paths:
+        path.unlink(missing_ok=True)
+
+
+def parse_status(value: str) -> tuple[int, float]:
+    status, _, weight = value.partition("=")
+    return int(status), float(weight or 1)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--activities", type=int, default=2000)
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        help="average activities per second delivered, 0 for as fast as possible",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=32,
+        help="maximum concurrent deliveries to inbox-receiver",
+    )
+    parser.add_argument(
+        "--link-delay",
+        type=float,
+        default=0.15,
+        help="seconds added in each direction between batch-sender and receiver",
+    )
+    parser.add_argument(
+        "--upstream-latency",
+        type=float,
+        default=0.005,
+        help="seconds upstream takes for each activity",
+    )
+    parser.add_argument(
+        "--upstream-jitter",
+        type=float,
+        default=0,
+        help="mean of exponentially distributed extra upstream seconds",
+    )
+    parser.add_argument(
+        "--upstream-status",
+        type=parse_status,
+        action="append",
+        metavar="STATUS[=WEIGHT]",
+        help="upstream status code with its relative weight, may be repeated",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=120,
+        help="seconds to wait for all activities to be submitted",
+    )
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(run(args))
+    finally:
+        cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Report the size of queued messages with and without header compaction.
+
+Uses generated activities by default. With `--queue` a sample of the messages
+in the queue configured through the usual environment variables is used
+instead, the sampled messages are returned to the queue afterwards.
+"""
+
+import argparse
+import asyncio
+import random
+import statistics
+from dataclasses import replace
+
+from _payloads import generate_submission
+
+from activitypub_federation_queue_batcher._header_helpers import (
+    HEADER_POLICIES,
+    compact_headers,
+)
+from activitypub_federation_queue_batcher._queue_helpers import (
+    BatchAccumulator,
+    open_activity_queue,
+)
+from activitypub_federation_queue_batcher.codec import (
+    decode_queued_activity,
+    encode_queued_activity,
+)
+from activitypub_federation_queue_batcher.types import ActivitySubmissionMetadata
+
+
+async def sample_queue(
+    limit: int,
+) -> list[tuple[ActivitySubmissionMetadata, bytes]]:
+    queue = await open_activity_queue()
+    try:
+        accumulator = BatchAccumulator()
+        await queue.consume(accumulator.on_message, limit)
+        try:
+            async with asyncio.timeout(5):
+                messages = await accumulator.get_batch(limit, 1)
+        except TimeoutError:
+            return []
+
+        for message in messages:
+            await message.nack(requeue=True)
+
+        return [decode_queued_activity(message.body) for message in messages]
+    finally:
+        await queue.close()
+
+
+def report(
+    label: str,
+    submissions: list[tuple[ActivitySubmissionMetadata, bytes]],
+) -> None:
+    message_sizes = [len(encode_queued_activity(s, body)) for s, body in submissions]
+    header_sizes = [
+        sum(len(name) + len(value) for name, value in s.headers) for s, _ in submissions
+    ]
+    print(
+        f"{label:>10}: {statistics.mean(message_sizes):8.1f} bytes per message,"
+        f" {statistics.mean(header_sizes):7.1f} bytes of headers,"
+        f" {statistics.mean(len(s.headers) for s, _ in submissions):5.1f} headers",
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--samples", type=int, default=1000)
+    parser.add_argument(
+        "--queue",
+        action="store_true",
+        help="sample queued messages instead of generating activities",
+    )
+    args = parser.parse_args()
+
+    if args.queue:
+        submissions = asyncio.run(sample_queue(args.samples))
+        if len(submissions) == 0:
+            parser.exit(1, "No queued messages to sample\n")
+    else:
+        rng = random.Random(0)
+        submissions = [generate_submission(rng) for _ in range(args.samples)]
+
+    print(f"{len(submissions)} messages")
+    report("queued", submissions)
+    for policy in HEADER_POLICIES:
+        report(
+            policy,
+            [
+                (replace(s, headers=compact_headers(s.headers, policy)), body)
+                for s, body in submissions
+            ],
+        )
+
+
+if __name__ == "__main__":
+    main()
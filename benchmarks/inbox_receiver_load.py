@@ -0,0 +1,147 @@
+"""Measure inbox-receiver request latency against a local RabbitMQ instance.
+
+Compares the previous handler, which opened a channel, declared the queue and
+waited for a single publisher confirm for every request, with the current one
+using the publisher channel pool. Messages are published to a separate queue
+which is purged afterwards, set RABBITMQ_HOSTNAME to use a different broker.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import time
+
+os.environ.setdefault("RABBITMQ_CHANNEL_ROUTING_KEY", "benchmark-inbox-receiver")
+os.environ.setdefault("INBOX_RECEIVER_MESSAGE_QUEUE_LIMIT", str(2**31))
+
+import aio_pika
+import aiohttp.web
+from _payloads import generate_activity
+from aiohttp.test_utils import TestServer
+
+from activitypub_federation_queue_batcher._rmq_helpers import (
+    bootstrap_rmq,
+    declare_activity_queue,
+)
+from activitypub_federation_queue_batcher.constants import (
+    INBOX_RECEIVER_MESSAGE_QUEUE_LIMIT,
+    RABBITMQ_CHANNEL_ROUTING_KEY,
+)
+from activitypub_federation_queue_batcher.inbox_receiver.__main__ import init
+
+RABBITMQ_CONNECTION_APP_KEY = aiohttp.web.AppKey(
+    "RABBITMQ_CONNECTION_APP_KEY",
+    aio_pika.abc.AbstractRobustConnection,
+)
+
+
+async def legacy_handler(request: aiohttp.web.Request) -> aiohttp.web.Response:
+    """Reduced copy of the previous handler, without request validation."""
+    async with request.app[RABBITMQ_CONNECTION_APP_KEY].channel(
+        on_return_raises=True,
+    ) as channel:
+        queue = await declare_activity_queue(channel, passive=True)
+
+        if (
+            queue.declaration_result.message_count is not None
+            and queue.declaration_result.message_count
+            >= INBOX_RECEIVER_MESSAGE_QUEUE_LIMIT
+        ):
+            return aiohttp.web.HTTPServiceUnavailable()
+
+        await channel.default_exchange.publish(
+            aio_pika.Message(
+                body=await request.read(),
+                delivery_mode=aio_pika.abc.DeliveryMode.PERSISTENT,
+            ),
+            routing_key=RABBITMQ_CHANNEL_ROUTING_KEY,
+            timeout=5.0,
+        )
+
+    return aiohttp.web.HTTPNoContent()
+
+
+async def legacy_init() -> aiohttp.web.Application:
+    app = aiohttp.web.Application()
+    app[RABBITMQ_CONNECTION_APP_KEY] = await bootstrap_rmq()
+    app.add_routes([aiohttp.web.post("/{path:.*}", legacy_handler)])
+    return app
+
+
+async def measure(
+    app: aiohttp.web.Application,
+    bodies: list[bytes],
+    concurrency: int,
+) -> tuple[list[float], float]:
+    latencies: list[float] = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with TestServer(app) as server, aiohttp.ClientSession() as cs:
+        url = str(server.make_url("/inbox"))
+
+        async def post(body: bytes) -> None:
+            async with semaphore:
+                start = time.perf_counter()
+                async with cs.post(
+                    url,
+                    data=body,
+                    headers={aiohttp.hdrs.CONTENT_TYPE: "application/activity+json"},
+                ) as resp:
+                    resp.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        async with asyncio.TaskGroup() as tg:
+            for body in bodies:
+                tg.create_task(post(body))
+        elapsed = time.perf_counter() - start
+
+    rmq = await bootstrap_rmq()
+    async with rmq.channel() as channel:
+        queue = await declare_activity_queue(channel)
+        await queue.purge()
+    await rmq.close()
+
+    if RABBITMQ_CONNECTION_APP_KEY in app:
+        await app[RABBITMQ_CONNECTION_APP_KEY].close()
+
+    return latencies, elapsed
+
+
+def report(label: str, latencies: list[float], elapsed: float) -> None:
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(
+        f"{label:>8}: p50 {quantiles[49] * 1000:6.2f}ms,"
+        f" p99 {quantiles[98] * 1000:6.2f}ms,"
+        f" {len(latencies) / elapsed:8.0f} requests/s",
+    )
+
+
+async def run(requests: int, concurrency: int) -> None:
+    rng = random.Random(0)
+    bodies = [json.dumps(generate_activity(rng)).encode() for _ in range(requests)]
+
+    legacy_app = await legacy_init()
+    app = await init()
+    # Logging every request would dominate the measured latency
+    logging.disable(logging.INFO)
+
+    report("legacy", *await measure(legacy_app, bodies, concurrency))
+    report("pooled", *await measure(app, bodies, concurrency))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    args = parser.parse_args()
+
+    asyncio.run(run(args.requests, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
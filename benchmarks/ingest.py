@@ -0,0 +1,149 @@
+"""Compare the CPU time inbox-receiver spends queueing an activity.
+
+The previous envelope base64 encoded the body within a JSON encoded activity
+submission, queued activities are binary batch records with the body as
+received now. Both are measured for generated activities of typical sizes,
+from parsing the body until the message is encoded, together with decoding the
+message again as batch-sender does.
+"""
+
+import argparse
+import json
+import random
+import statistics
+import time
+from base64 import b64decode, b64encode
+from collections.abc import Callable
+from datetime import UTC, datetime
+
+from _legacy_codec import encode_activity_submission
+from _payloads import DESTINATION_DOMAIN, generate_activity, generate_headers
+
+from activitypub_federation_queue_batcher._header_helpers import compact_headers
+from activitypub_federation_queue_batcher._queue_helpers import (
+    get_activity_partition,
+)
+from activitypub_federation_queue_batcher.codec import (
+    decode_activity_submission,
+    decode_queued_activity,
+    encode_queued_activity,
+)
+from activitypub_federation_queue_batcher.types import (
+    ActivitySubmissionMetadata,
+    SerializableActivitySubmission,
+)
+
+Request = tuple[bytes, list[tuple[str, str]]]
+
+
+def legacy_ingest(body: bytes, headers: list[tuple[str, str]]) -> bytes:
+    """Reduced copy of the previous handler, from parsing to encoding."""
+    j = json.loads(body)
+    submission = SerializableActivitySubmission(
+        time=datetime.now(UTC),
+        activity_id=j["id"],
+        host=DESTINATION_DOMAIN,
+        path="/inbox",
+        headers=compact_headers(headers, "all"),
+        b64_body=b64encode(body).decode(),
+    )
+    return encode_activity_submission(submission)
+
+
+def legacy_decode(data: bytes) -> bytes:
+    return b64decode(decode_activity_submission(data).b64_body)
+
+
+def ingest(body: bytes, headers: list[tuple[str, str]]) -> bytes:
+    """Reduced copy of the handler, from parsing to encoding."""
+    j = json.loads(body)
+    metadata = ActivitySubmissionMetadata(
+        time=datetime.now(UTC),
+        activity_id=j["id"],
+        host=DESTINATION_DOMAIN,
+        path="/inbox",
+        headers=compact_headers(headers, "all"),
+    )
+    get_activity_partition(j)
+    return encode_queued_activity(metadata, body)
+
+
+def decode(data: bytes) -> bytes:
+    return decode_queued_activity(data)[1]
+
+
+def generate_requests(rng: random.Random, size: int, count: int) -> list[Request]:
+    """Generate Create activities of about `size` bytes with their headers."""
+    requests: list[Request] = []
+    while len(requests) < count:
+        activity = generate_activity(rng)
+        inner = activity["object"]
+        if not isinstance(inner, dict) or not isinstance(inner["object"], dict):
+            continue
+
+        # Pad the content to the size of the activity without it
+        note = inner["object"]
+        note["content"] = "<p>"
+        padding = size - len(json.dumps(activity))
+        note["content"] = "<p>" + "lorem " * max(0, padding // 6)
+
+        body = json.dumps(activity).encode()
+        headers = [
+            (name, value)
+            for name, value in generate_headers(activity, body)
+            if name != "Host"
+        ]
+        requests.append((body, headers))
+    return requests
+
+
+def measure(
+    requests: list[Request],
+    encode: Callable[[bytes, list[tuple[str, str]]], bytes],
+    decode: Callable[[bytes], bytes],
+) -> tuple[float, float, float]:
+    """Return CPU seconds per encoding and decoding and the message size."""
+    start = time.process_time()
+    messages = [encode(body, headers) for body, headers in requests]
+    encoded = time.process_time()
+    for message in messages:
+        decode(message)
+    decoded = time.process_time()
+
+    return (
+        (encoded - start) / len(requests),
+        (decoded - encoded) / len(requests),
+        statistics.mean(len(message) for message in messages),
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, action="append")
+    parser.add_argument("--requests", type=int, default=5000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    for size in args.size or [2048, 5120, 20480]:
+        requests = generate_requests(rng, size, args.requests)
+        body_size = statistics.mean(len(body) for body, _ in requests)
+        print(f"{body_size / 1024:.1f}KiB activities:")
+
+        for label, encode_func, decode_func in (
+            ("base64", legacy_ingest, legacy_decode),
+            ("raw", ingest, decode),
+        ):
+            encode_time, decode_time, message_size = measure(
+                requests,
+                encode_func,
+                decode_func,
+            )
+            print(
+                f"  {label:>8}: {encode_time * 1e6:7.1f}µs queueing,"
+                f" {decode_time * 1e6:7.1f}µs decoding,"
+                f" {message_size / 1024:5.1f}KiB messages",
+            )
+
+
+if __name__ == "__main__":
+    main()
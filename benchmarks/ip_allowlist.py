@@ -0,0 +1,132 @@
+"""Compare IP allowlist matching with the previous linear scan.
+
+Generates allowlists of random IPv4 and IPv6 networks and addresses and checks
+client IPs from a limited set of clients against them, as requests from the
+same sending instance keep arriving from the same addresses.
+"""
+
+import argparse
+import random
+import time
+from collections.abc import Callable
+from functools import partial
+from ipaddress import (
+    IPv4Address,
+    IPv4Network,
+    IPv6Address,
+    IPv6Network,
+    ip_address,
+)
+
+from activitypub_federation_queue_batcher._aiohttp_helpers import (
+    IPAddress,
+    IPMatcher,
+    IPRule,
+)
+
+
+def legacy_is_allowed_ip(allowed_ips: IPRule, client_ip: str | IPAddress) -> bool:
+    """Copy of the previous implementation, taking positional arguments."""
+    if isinstance(client_ip, str):
+        client_ip = ip_address(client_ip)
+
+    return any(
+        (isinstance(rule, IPv4Address | IPv6Address) and client_ip == rule)
+        or (isinstance(rule, IPv4Network | IPv6Network) and client_ip in rule)
+        for rule in allowed_ips
+    )
+
+
+def matches_uncached(matcher: IPMatcher, client_ip: str) -> bool:
+    return matcher.matches_address(ip_address(client_ip))
+
+
+def generate_rules(rng: random.Random, count: int) -> IPRule:
+    rules: list[IPv4Address | IPv6Address | IPv4Network | IPv6Network] = []
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.5:  # noqa: PLR2004
+            prefix = rng.randint(12, 28)
+            rules.append(
+                IPv4Network((rng.getrandbits(32), prefix), strict=False),
+            )
+        elif kind < 0.8:  # noqa: PLR2004
+            prefix = rng.randint(29, 64)
+            rules.append(
+                IPv6Network((rng.getrandbits(128), prefix), strict=False),
+            )
+        else:
+            rules.append(IPv4Address(rng.getrandbits(32)))
+    return rules
+
+
+def generate_clients(rng: random.Random, rules: IPRule, count: int) -> list[str]:
+    clients = []
+    for _ in range(count):
+        if rng.random() < 0.5:  # noqa: PLR2004
+            # An address within one of the rules
+            rule = rng.choice(rules)
+            if isinstance(rule, IPv4Network | IPv6Network):
+                clients.append(
+                    str(rule[rng.randrange(min(rule.num_addresses, 2**32))]),
+                )
+            else:
+                clients.append(str(rule))
+        elif rng.random() < 0.5:  # noqa: PLR2004
+            clients.append(str(IPv4Address(rng.getrandbits(32))))
+        else:
+            clients.append(str(IPv6Address(rng.getrandbits(128))))
+    return clients
+
+
+def measure(check: Callable[[str], bool], requests: list[str]) -> tuple[float, int]:
+    start = time.perf_counter()
+    allowed = sum(check(client_ip) for client_ip in requests)
+    return (time.perf_counter() - start) / len(requests), allowed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rules", type=int, action="append")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=20000)
+    args = parser.parse_args()
+
+    for count in args.rules or [10, 1000, 100000]:
+        rng = random.Random(0)
+        rules = generate_rules(rng, count)
+        clients = generate_clients(rng, rules, args.clients)
+        requests = [rng.choice(clients) for _ in range(args.requests)]
+
+        start = time.perf_counter()
+        matcher = IPMatcher(rules)
+        build_time = time.perf_counter() - start
+
+        # The linear scan is too slow to check every request for many rules
+        legacy_requests = requests[: max(100, args.requests * 10 // count)]
+        legacy_time, legacy_allowed = measure(
+            partial(legacy_is_allowed_ip, rules),
+            legacy_requests,
+        )
+        uncached_time, uncached_allowed = measure(
+            partial(matches_uncached, matcher),
+            requests,
+        )
+        cached_time, cached_allowed = measure(matcher.matches, requests)
+
+        assert uncached_allowed == cached_allowed  # noqa: S101
+        assert legacy_allowed == sum(  # noqa: S101
+            matcher.matches(client_ip) for client_ip in legacy_requests
+        )
+
+        print(f"{count} rules, built in {build_time * 1000:.1f}ms:")
+        for label, per_request in (
+            ("linear", legacy_time),
+            ("bisect", uncached_time),
+            ("cached", cached_time),
+        ):
+            print(f"  {label:>8}: {per_request * 1e6:10.2f}µs per request")
+
+
+if __name__ == "__main__":
+    main()
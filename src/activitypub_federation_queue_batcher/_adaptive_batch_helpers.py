@@ -0,0 +1,139 @@
+import logging
+import math
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveBatchController:
+    """
+    Chooses the batch size and how long to wait for a batch to fill up.
+
+    Completed batches provide estimates of the round-trip time and of how long
+    upstream takes per activity, the latter from the time between the first
+    and the last result arriving. While activities are backlogged, batches are
+    sized so that the round-trip time makes up at most `overhead` of the time
+    a batch takes, as larger batches don't increase throughput much further.
+    Otherwise batches only wait for further activities if more are expected
+    within a round trip, and never longer than that, as sending a batch right
+    away and the next one later would be faster.
+    """
+
+    def __init__(
+        self,
+        *,
+        min_size: int,
+        max_size: int,
+        min_wait: float,
+        max_wait: float,
+        pipeline_depth: int,
+        overhead: float = 0.1,
+        smoothing: float = 0.2,
+    ) -> None:
+        self.min_size = min_size
+        self.max_size = max_size
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+        self._pipeline_depth = pipeline_depth
+        self._overhead = overhead
+        self._smoothing = smoothing
+
+        # Start out like the static configuration until there are estimates
+        self.size = max_size
+        self.wait = max_wait
+
+        self.rtt: float | None = None
+        self.processing_time: float | None = None
+        # Activities arriving per second while not backlogged
+        self.arrival_rate: float | None = None
+        self._backlogged = False
+        self._last_collected: float | None = None
+
+    def _smooth(self, previous: float | None, value: float) -> float:
+        if previous is None:
+            return value
+        return previous + self._smoothing * (value - previous)
+
+    def record_collected(self, count: int, backlog: int, now: float) -> None:
+        """
+        Record a batch being collected at monotonic time `now`.
+
+        `backlog` is the number of activities which didn't fit into the batch.
+        """
+        previous, self._last_collected = self._last_collected, now
+        self._backlogged = backlog > 0
+
+        # All activities which arrived since the previous batch are part of
+        # this one, unless some were left over.
+        if not self._backlogged and previous is not None and now > previous:
+            self.arrival_rate = self._smooth(
+                self.arrival_rate,
+                count / (now - previous),
+            )
+
+        self._update()
+
+    def record_completed(
+        self,
+        count: int,
+        first_result_after: float,
+        last_result_after: float,
+    ) -> None:
+        """Record the times from sending a batch until its results arrived."""
+        if count > 1 and last_result_after > first_result_after:
+            self.processing_time = self._smooth(
+                self.processing_time,
+                (last_result_after - first_result_after) / (count - 1),
+            )
+            rtt = first_result_after - self.processing_time
+        else:
+            # Results which aren't streamed all arrive at once, which leaves
+            # the previous estimate to tell the round-trip time apart.
+            rtt = last_result_after - count * (self.processing_time or 0)
+
+        self.rtt = self._smooth(self.rtt, max(rtt, 0))
+
+        self._update()
+
+    def _get_target_size(self) -> int:
+        if self.rtt is None or not self.processing_time:
+            return self.max_size
+
+        # Other batches in flight hide part of the round-trip time
+        rtt = self.rtt / self._pipeline_depth
+        return math.ceil(
+            rtt * (1 - self._overhead) / (self._overhead * self.processing_time),
+        )
+
+    def _get_target_wait(self) -> float:
+        if self._backlogged or self.rtt is None:
+            return self.max_wait
+
+        if self.arrival_rate is None or self.arrival_rate * self.rtt < 1:
+            # Waiting would only delay the activities which are already there
+            return self.min_wait
+
+        return min(self.size / self.arrival_rate, self.rtt)
+
+    def _update(self) -> None:
+        previous_size, previous_wait = self.size, self.wait
+
+        self.size = min(max(self._get_target_size(), self.min_size), self.max_size)
+        self.wait = min(max(self._get_target_wait(), self.min_wait), self.max_wait)
+
+        # The wait time follows every change of the arrival rate
+        if self.size != previous_size or not math.isclose(
+            self.wait,
+            previous_wait,
+            rel_tol=0.25,
+            abs_tol=0.01,
+        ):
+            logger.info(
+                "Adjusted batch size to %s and wait time to %.3f seconds, "
+                "round trip %s seconds, %s seconds per activity, "
+                "%s activities per second",
+                self.size,
+                self.wait,
+                self.rtt,
+                self.processing_time,
+                self.arrival_rate,
+            )
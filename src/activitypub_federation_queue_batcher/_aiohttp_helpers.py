@@ -1,4 +1,6 @@
+from bisect import bisect_right
 from collections.abc import Sequence
+from functools import lru_cache
 from ipaddress import IPv4Address, IPv4Network, IPv6Address, IPv6Network, ip_address
 from typing import TypeAlias
 
@@ -10,21 +12,70 @@ IPNetwork: TypeAlias = IPv4Network | IPv6Network
 
 IPRule: TypeAlias = Sequence[IPAddress | IPNetwork]
 
-ALLOWED_IPS_APP_KEY: AppKey[IPRule] = AppKey("ALLOWED_IPS_APP_KEY", IPRule)
+# Number of recent client IPs whose result is cached
+IP_MATCHER_CACHE_SIZE = 4096
+
+
+class IPMatcher:
+    """
+    Matches IPs against a set of addresses and networks.
+
+    The rules are compiled into sorted, non-overlapping integer ranges per IP
+    version, which are searched with bisect instead of checking every rule.
+    """
+
+    def __init__(self, rules: IPRule) -> None:
+        ranges: dict[int, list[tuple[int, int]]] = {4: [], 6: []}
+        for rule in rules:
+            # This uses an explicit Union instead of IPAddress
+            # See https://github.com/python/mypy/issues/12155
+            if isinstance(rule, IPv4Address | IPv6Address):
+                ranges[rule.version].append((int(rule), int(rule)))
+            else:
+                ranges[rule.version].append(
+                    (int(rule.network_address), int(rule.broadcast_address)),
+                )
+
+        self._starts: dict[int, list[int]] = {}
+        self._ends: dict[int, list[int]] = {}
+        for version, version_ranges in ranges.items():
+            starts = self._starts[version] = []
+            ends = self._ends[version] = []
+            for start, end in sorted(version_ranges):
+                # Merge overlapping and adjacent ranges
+                if len(ends) > 0 and start <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+
+        self._matches_str = lru_cache(maxsize=IP_MATCHER_CACHE_SIZE)(
+            self._matches_str_uncached,
+        )
+
+    def _matches_str_uncached(self, ip: str) -> bool:
+        return self.matches_address(ip_address(ip))
+
+    def matches_address(self, ip: IPAddress) -> bool:
+        starts = self._starts[ip.version]
+        value = int(ip)
+        i = bisect_right(starts, value) - 1
+        return i >= 0 and value <= self._ends[ip.version][i]
+
+    def matches(self, ip: str | IPAddress) -> bool:
+        if isinstance(ip, str):
+            # Requests from the same clients are checked repeatedly
+            return self._matches_str(ip)
+
+        return self.matches_address(ip)
+
+
+ALLOWED_IPS_APP_KEY: AppKey[IPMatcher] = AppKey("ALLOWED_IPS_APP_KEY", IPMatcher)
 
 
 def parse_trusted_ips(s: str, sep: str = ",") -> IPRule:
     return parse_trusted_element(s.split(sep))
 
 
-def is_allowed_ip(*, allowed_ips: IPRule, client_ip: str | IPAddress) -> bool:
-    if isinstance(client_ip, str):
-        client_ip = ip_address(client_ip)
-
-    return any(
-        # This uses an explicit Union instead of IPAddress
-        # See https://github.com/python/mypy/issues/12155
-        (isinstance(rule, IPv4Address | IPv6Address) and client_ip == rule)
-        or (isinstance(rule, IPv4Network | IPv6Network) and client_ip in rule)
-        for rule in allowed_ips
-    )
+def is_allowed_ip(*, allowed_ips: IPMatcher, client_ip: str | IPAddress) -> bool:
+    return allowed_ips.matches(client_ip)
@@ -1,3 +1,8 @@
+import json
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+
+from aiohttp.hdrs import RETRY_AFTER
 from aiohttp.web import (
     HTTPBadRequest,
     HTTPInternalServerError,
@@ -19,3 +24,83 @@ def is_tolerable_activity_submission_status_code(status: int, /) -> bool:
         status not in (HTTPRequestTimeout.status_code, HTTPTooManyRequests.status_code)
         and status < HTTPInternalServerError.status_code
     )
+
+
+def get_retry_after(headers: list[list[str]], now: datetime, /) -> float | None:
+    """
+    Get the number of seconds to wait according to a Retry-After header.
+
+    The header may either contain a number of seconds or an HTTP date.
+    """
+    for name, value in headers:
+        if name.lower() != RETRY_AFTER.lower():
+            continue
+
+        if value.strip().isdecimal():
+            return float(value)
+
+        try:
+            return max(0.0, (parsedate_to_datetime(value) - now).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+    return None
+
+
+ACTIVITY_ORDERING_KEYS = frozenset({"actor", "object", "community"})
+
+
+def _get_object_id(value: object, /) -> str | None:
+    if isinstance(value, str):
+        return value
+
+    if isinstance(value, dict):
+        object_id = value.get("id")
+        if isinstance(object_id, str):
+            return object_id
+
+    return None
+
+
+def get_activity_ordering_key(body: bytes, key: str, /) -> str | None:
+    """
+    Get the value activities need to be ordered by from an activity body.
+
+    Activities with the same ordering key must be submitted in order, while
+    activities with different ordering keys are independent of each other.
+    None is returned if the activity does not contain the key.
+    """
+    try:
+        activity = json.loads(body)
+    except ValueError:
+        return None
+
+    return get_parsed_activity_ordering_key(activity, key)
+
+
+def get_parsed_activity_ordering_key(activity: object, key: str, /) -> str | None:
+    """Get the ordering key like `get_activity_ordering_key` from a parsed body."""
+    if not isinstance(activity, dict):
+        return None
+
+    if key == "actor":
+        return _get_object_id(activity.get("actor"))
+
+    if key == "object":
+        return _get_object_id(activity.get("object"))
+
+    if key == "community":
+        # Lemmy sets the community as audience on activities within it, when
+        # a community forwards activities it wraps them in an Announce.
+        inner = activity.get("object")
+        return (
+            _get_object_id(activity.get("audience"))
+            or (
+                _get_object_id(inner.get("audience"))
+                if isinstance(inner, dict)
+                else None
+            )
+            or _get_object_id(activity.get("actor"))
+        )
+
+    raise ValueError(key)
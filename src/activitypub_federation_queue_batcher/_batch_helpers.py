@@ -0,0 +1,25 @@
+from multidict import istr
+
+# Identifies a single batch sender run, sequence numbers are only meaningful
+# within the same session.
+BATCH_SESSION_HEADER = istr("X-Batch-Session")
+# Compression of the batch request body, handled by batch-receiver itself
+# instead of through Content-Encoding as that allows using zstd dictionaries.
+BATCH_CONTENT_ENCODING_HEADER = istr("X-Batch-Content-Encoding")
+# Position of a batch within its session, starting at 0.
+BATCH_SEQUENCE_HEADER = istr("X-Batch-Sequence")
+# Marks the first batch a batch sender sends after a failure. Earlier batches
+# of the session which are still processed are stopped and skipped, as the
+# batch sender sends their activities again.
+BATCH_RESUME_HEADER = istr("X-Batch-Resume")
+# Sent by batch senders which can handle results in a different order than the
+# batch, identified by their index. Only then batch-receiver may submit
+# activities of different partitions concurrently.
+BATCH_PARTITIONING_HEADER = istr("X-Batch-Partitioning")
+
+# Batch receivers send each activity result as a separate JSON line once it
+# is known when this is listed in the Accept header of a batch request.
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+
+# See activitypub_federation_queue_batcher.codec for the format description
+BINARY_BATCH_CONTENT_TYPE = "application/vnd.activitypub-federation-queue-batch"
@@ -0,0 +1,301 @@
+import zlib
+from dataclasses import dataclass, field
+
+try:
+    import brotlicffi as brotli
+except ImportError:
+    import brotli
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # type: ignore[assignment]
+
+SUPPORTED_BATCH_ENCODINGS = {"gzip", "br", "zstd"}
+
+
+class UnsupportedBatchEncodingError(ValueError):
+    def __init__(self, encoding: str) -> None:
+        super().__init__(f"Unsupported batch encoding {encoding!r}")
+
+
+class BatchDecompressionError(ValueError):
+    pass
+
+
+class TruncatedBatchError(BatchDecompressionError):
+    def __init__(self) -> None:
+        super().__init__("Compressed batch is truncated")
+
+
+class BatchTooLargeError(ValueError):
+    def __init__(self, max_size: int) -> None:
+        super().__init__(f"Decompressed batch exceeds {max_size} bytes")
+
+
+def load_zstd_dictionary(path: str) -> "zstandard.ZstdCompressionDict":
+    if zstandard is None:
+        raise UnsupportedBatchEncodingError("zstd")
+
+    with open(path, "rb") as f:  # noqa: PTH123
+        return zstandard.ZstdCompressionDict(f.read())
+
+
+@dataclass
+class BatchCompressor:
+    encoding: str
+    level: int | None = None
+    zstd_dictionary: "zstandard.ZstdCompressionDict | None" = None
+    _zstd: "zstandard.ZstdCompressor | None" = field(default=None, init=False)
+
+    def __post_init__(self) -> None:
+        if self.encoding not in SUPPORTED_BATCH_ENCODINGS:
+            raise UnsupportedBatchEncodingError(self.encoding)
+
+        if self.encoding == "zstd":
+            if zstandard is None:
+                raise UnsupportedBatchEncodingError(self.encoding)
+
+            # Creating the compressor is expensive with a dictionary, so this
+            # is done only once.
+            self._zstd = zstandard.ZstdCompressor(
+                level=self.level if self.level is not None else 3,
+                dict_data=self.zstd_dictionary,
+            )
+
+    def compress(self, data: bytes) -> bytes:
+        if self._zstd is not None:
+            return self._zstd.compress(data)
+
+        if self.encoding == "br":
+            return brotli.compress(  # type: ignore[no-any-return]
+                data,
+                quality=self.level if self.level is not None else 5,
+            )
+
+        return zlib.compress(
+            data,
+            level=self.level if self.level is not None else 6,
+            wbits=16 + zlib.MAX_WBITS,
+        )
+
+
+class _BoundedOutput:
+    """Collects the output of a zstd stream writer up to a limit."""
+
+    def __init__(self) -> None:
+        self.limit = 0
+        self._chunks: list[bytes] = []
+        self._size = 0
+
+    def write(self, data: bytes) -> int:
+        self._size += len(data)
+        if self._size > self.limit:
+            # Stops the decompression right away
+            raise BatchTooLargeError(self.limit)
+
+        self._chunks.append(data)
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self.limit -= self._size
+        self._chunks.clear()
+        self._size = 0
+        return data
+
+
+ZSTD_FRAME_MAGIC = (0xFD2FB528).to_bytes(4, "little")
+
+
+class _ZstdFrameScanner:
+    """
+    Follows the frame and block headers of a zstd stream.
+
+    The stream writer doesn't tell whether the last frame is complete, so the
+    headers are read here while block contents are skipped by their size.
+    """
+
+    def __init__(self) -> None:
+        self._pending = b""
+        self._skip = 0
+        self._frames = 0
+        self._in_frame = False
+        self._checksum = False
+
+    @property
+    def eof(self) -> bool:
+        return (
+            self._frames > 0
+            and not self._in_frame
+            and self._skip == 0
+            and len(self._pending) == 0
+        )
+
+    def _header_size(self, data: bytes, pos: int) -> int:
+        """Return the size of the header at `pos`, or 0 if it isn't known yet."""
+        if self._in_frame:
+            return 3
+        if len(data) - pos < 5:  # noqa: PLR2004
+            return 0
+        if data[pos : pos + 4] != ZSTD_FRAME_MAGIC:
+            # Skippable frames, the stream writer rejects anything else
+            return 8
+
+        descriptor = data[pos + 4]
+        single_segment = descriptor & 0x20
+        return (
+            5
+            + (0 if single_segment else 1)
+            + (0, 1, 2, 4)[descriptor & 0x03]
+            + (1 if single_segment else 0, 2, 4, 8)[descriptor >> 6]
+        )
+
+    def _parse_header(self, header: bytes) -> None:
+        if self._in_frame:
+            block = int.from_bytes(header, "little")
+            # RLE blocks consist of a single byte
+            self._skip = 1 if (block >> 1) & 0x03 == 1 else block >> 3
+            if block & 0x01:
+                self._skip += 4 if self._checksum else 0
+                self._in_frame = False
+        elif header[:4] == ZSTD_FRAME_MAGIC:
+            self._frames += 1
+            self._in_frame = True
+            self._checksum = bool(header[4] & 0x04)
+        else:
+            self._skip = int.from_bytes(header[4:], "little")
+
+    def feed(self, data: bytes) -> None:
+        data = self._pending + data
+        pos = 0
+
+        while True:
+            skipped = min(self._skip, len(data) - pos)
+            pos += skipped
+            self._skip -= skipped
+
+            size = self._header_size(data, pos)
+            if self._skip > 0 or size == 0 or len(data) - pos < size:
+                break
+
+            self._parse_header(data[pos : pos + size])
+            pos += size
+
+        self._pending = data[pos:]
+
+
+class StreamingBatchDecompressor:
+    """Decompresses a batch chunk by chunk while it is being received."""
+
+    def __init__(
+        self,
+        encoding: str,
+        *,
+        max_size: int,
+        zstd: "zstandard.ZstdDecompressor | None",
+    ) -> None:
+        self.encoding = encoding
+        self._max_size = max_size
+        self._size = 0
+        self._gzip: zlib._Decompress | None = None
+        self._br: brotli.Decompressor | None = None
+        self._zstd: zstandard.ZstdDecompressionWriter | None = None
+        self._zstd_output = _BoundedOutput()
+        self._zstd_frames = _ZstdFrameScanner()
+
+        if encoding == "zstd":
+            if zstd is None:
+                raise UnsupportedBatchEncodingError(encoding)
+            # Unlike decompressobj(), the stream writer passes on its output
+            # in chunks, which allows stopping once the limit is exceeded.
+            self._zstd = zstd.stream_writer(
+                self._zstd_output,  # type: ignore[arg-type]
+            )
+        elif encoding == "br":
+            self._br = brotli.Decompressor()
+        elif encoding == "gzip":
+            self._gzip = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+        else:
+            raise UnsupportedBatchEncodingError(encoding)
+
+    def _decompress(self, data: bytes) -> bytes:
+        if self._zstd is not None:
+            if self._size == 0:
+                # Frames usually include their size, which allows rejecting
+                # batches which are too large right away.
+                try:
+                    content_size = zstandard.get_frame_parameters(data).content_size
+                except zstandard.ZstdError:
+                    content_size = zstandard.CONTENTSIZE_UNKNOWN
+                if (
+                    content_size != zstandard.CONTENTSIZE_UNKNOWN
+                    and content_size > self._max_size
+                ):
+                    raise BatchTooLargeError(self._max_size)
+
+            self._zstd_output.limit = self._max_size - self._size
+            self._zstd.write(data)
+            self._zstd_frames.feed(data)
+            return self._zstd_output.take()
+
+        # Reading one more byte than allowed tells us if the limit was
+        # exceeded without decompressing everything.
+        limit = self._max_size - self._size + 1
+
+        if self._br is not None:
+            output: bytes = self._br.process(data, output_buffer_limit=limit)
+            # The rest of the output is returned by further calls, once the
+            # limit is reached it doesn't matter anymore.
+            while len(output) < limit and not self._br.can_accept_more_data():
+                output += self._br.process(
+                    b"",
+                    output_buffer_limit=limit - len(output),
+                )
+            return output
+
+        if self._gzip is not None:
+            return self._gzip.decompress(data, limit)
+
+        raise UnsupportedBatchEncodingError(self.encoding)
+
+    def decompress(self, data: bytes) -> bytes:
+        try:
+            decompressed = self._decompress(data)
+        except BatchTooLargeError:
+            raise
+        except Exception as e:
+            raise BatchDecompressionError(str(e)) from e
+
+        self._size += len(decompressed)
+        if self._size > self._max_size:
+            raise BatchTooLargeError(self._max_size)
+
+        return decompressed
+
+    def finish(self) -> None:
+        """Check that the compressed batch was complete."""
+        if (
+            (self._zstd is not None and not self._zstd_frames.eof)
+            or (self._br is not None and not self._br.is_finished())
+            or (self._gzip is not None and not self._gzip.eof)
+        ):
+            raise TruncatedBatchError
+
+
+@dataclass
+class BatchDecompressor:
+    max_size: int
+    zstd_dictionary: "zstandard.ZstdCompressionDict | None" = None
+    _zstd: "zstandard.ZstdDecompressor | None" = field(default=None, init=False)
+
+    def __post_init__(self) -> None:
+        if zstandard is not None:
+            self._zstd = zstandard.ZstdDecompressor(dict_data=self.zstd_dictionary)
+
+    def decompressobj(self, encoding: str) -> StreamingBatchDecompressor:
+        return StreamingBatchDecompressor(
+            encoding,
+            max_size=self.max_size,
+            zstd=self._zstd,
+        )
@@ -0,0 +1,79 @@
+import time
+from collections import OrderedDict
+from hashlib import sha256
+
+from prometheus_client import Counter
+
+from activitypub_federation_queue_batcher.constants import (
+    ACTIVITY_DEDUPLICATION_MAX_ENTRIES,
+    ACTIVITY_DEDUPLICATION_TTL,
+)
+
+
+def get_activity_key(activity_id: str, body: bytes) -> bytes:
+    """
+    Identify an activity by its id and body.
+
+    Activities are only duplicates if their body matches as well, as some
+    software reuses ids for updated activities.
+    """
+    return sha256(activity_id.encode() + b"\0" + body).digest()
+
+
+class ActivityDeduplicator:
+    """
+    Remembers activities seen within the last `ttl` seconds.
+
+    At most `max_entries` activities are remembered, the oldest ones are
+    forgotten first. Entries aren't refreshed when seeing an activity again,
+    so they expire in the order they've been added in.
+    """
+
+    def __init__(self, *, max_entries: int, ttl: float, metric: Counter) -> None:
+        self._max_entries = max_entries
+        self._ttl = ttl
+        # Activity keys mapped to the monotonic time they expire at
+        self._entries: OrderedDict[bytes, float] = OrderedDict()
+        self._hits = metric.labels("hit")
+        self._misses = metric.labels("miss")
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _expire(self, now: float) -> None:
+        while len(self._entries) > 0:
+            key, expires = next(iter(self._entries.items()))
+            if expires > now and len(self._entries) <= self._max_entries:
+                break
+            del self._entries[key]
+
+    def is_duplicate(self, key: bytes) -> bool:
+        """Check whether an activity has been seen, counting it as hit or miss."""
+        self._expire(time.monotonic())
+
+        if key in self._entries:
+            self._hits.inc()
+            return True
+
+        self._misses.inc()
+        return False
+
+    def add(self, key: bytes) -> None:
+        if key not in self._entries:
+            self._entries[key] = time.monotonic() + self._ttl
+            self._expire(time.monotonic())
+
+    def discard(self, key: bytes) -> None:
+        """Forget an activity, e.g. because it couldn't be delivered after all."""
+        self._entries.pop(key, None)
+
+
+def create_activity_deduplicator(metric: Counter) -> ActivityDeduplicator | None:
+    if ACTIVITY_DEDUPLICATION_TTL <= 0 or ACTIVITY_DEDUPLICATION_MAX_ENTRIES <= 0:
+        return None
+
+    return ActivityDeduplicator(
+        max_entries=ACTIVITY_DEDUPLICATION_MAX_ENTRIES,
+        ttl=ACTIVITY_DEDUPLICATION_TTL,
+        metric=metric,
+    )
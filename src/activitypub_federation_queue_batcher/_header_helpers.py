@@ -0,0 +1,106 @@
+import re
+import sys
+from collections.abc import Iterable, Sequence
+
+# https://www.rfc-editor.org/rfc/rfc9110#section-7.6.1
+HOP_BY_HOP_HEADERS = frozenset(
+    {
+        "connection",
+        "keep-alive",
+        "proxy-authenticate",
+        "proxy-authorization",
+        "proxy-connection",
+        "te",
+        "trailer",
+        "transfer-encoding",
+        "upgrade",
+    },
+)
+
+# Kept by the signature header policy even if they're not signed, as they're
+# needed for delivering and verifying the activity.
+SIGNATURE_POLICY_HEADERS = frozenset(
+    {
+        "host",
+        "date",
+        "digest",
+        "content-digest",
+        "content-type",
+        "authorization",
+        "signature",
+        "signature-input",
+    },
+)
+
+HEADER_POLICIES = ("all", "signature")
+
+# draft-cavage-http-signatures, listing the signed headers in one parameter
+_SIGNED_HEADERS_RE = re.compile(r'(?:^|[\s,])headers="([^"]*)"')
+# RFC 9421 covered components, derived components start with "@"
+_SIGNATURE_INPUT_COMPONENTS_RE = re.compile(r"\(([^)]*)\)")
+_SIGNATURE_INPUT_COMPONENT_RE = re.compile(r'"([^"]*)"')
+
+
+def get_signed_header_names(headers: Iterable[Sequence[str]]) -> set[str] | None:
+    """
+    Return the lowercase names of all headers covered by HTTP signatures.
+
+    None is returned if the request isn't signed.
+    """
+    names: set[str] | None = None
+
+    for name, value in headers:
+        lower_name = name.lower()
+
+        if lower_name == "signature-input":
+            names = names or set()
+            for components in _SIGNATURE_INPUT_COMPONENTS_RE.findall(value):
+                names.update(
+                    component.lower()
+                    for component in _SIGNATURE_INPUT_COMPONENT_RE.findall(components)
+                    if not component.startswith("@")
+                )
+        elif lower_name == "signature" or (
+            lower_name == "authorization" and value[:10].lower() == "signature "
+        ):
+            names = names or set()
+            # Without headers parameter only the Date header is signed
+            for signed in _SIGNED_HEADERS_RE.findall(value) or ["date"]:
+                names.update(signed.lower().split())
+
+    return names
+
+
+def compact_headers(
+    headers: Iterable[Sequence[str]],
+    policy: str,
+) -> list[list[str]]:
+    """
+    Drop headers which must not or don't need to be replayed upstream.
+
+    Hop-by-hop headers only apply to the connection they were received on and
+    are always dropped, including those listed in the Connection header. The
+    "signature" policy additionally drops all headers which aren't needed for
+    verifying HTTP signatures, unless the request isn't signed.
+
+    Header names are interned, as the same few names repeat for every activity.
+    """
+    headers = list(headers)
+
+    dropped = set(HOP_BY_HOP_HEADERS)
+    for name, value in headers:
+        if name.lower() == "connection":
+            dropped.update(option.strip().lower() for option in value.split(","))
+
+    kept = None
+    if policy == "signature":
+        signed = get_signed_header_names(headers)
+        if signed is not None:
+            kept = SIGNATURE_POLICY_HEADERS | signed
+
+    return [
+        [sys.intern(str(name)), value]
+        for name, value in headers
+        if (lower_name := name.lower()) not in dropped
+        and (kept is None or lower_name in kept)
+    ]
@@ -0,0 +1,82 @@
+import os
+from pathlib import Path
+
+import aiohttp.web
+import prometheus_client
+import prometheus_client.multiprocess
+
+# Environment variable which enables the multiprocess mode of prometheus_client
+METRICS_MULTIPROC_DIR_ENV = "PROMETHEUS_MULTIPROC_DIR"
+
+DURATION_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    300.0,
+)
+# Activities may wait in the queue for hours while upstream is unavailable
+DELAY_BUCKETS = (0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0, 21600.0)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# Only the totals are exposed, as before
+prometheus_client.disable_created_metrics()  # type: ignore[no-untyped-call]
+
+
+def get_metrics_multiproc_dir() -> Path | None:
+    directory = os.environ.get(METRICS_MULTIPROC_DIR_ENV)
+    return Path(directory) if directory else None
+
+
+def clear_multiprocess_metrics() -> None:
+    """Remove the metrics of a previous run before starting worker processes."""
+    directory = get_metrics_multiproc_dir()
+    if directory is None:
+        return
+
+    for path in directory.glob("*.db"):
+        path.unlink()
+
+
+def metrics_response() -> aiohttp.web.Response:
+    registry = prometheus_client.REGISTRY
+    if get_metrics_multiproc_dir() is not None:
+        # Each worker writes its metrics to files in this directory, which are
+        # aggregated across all of them when collected.
+        registry = prometheus_client.CollectorRegistry()
+        prometheus_client.multiprocess.MultiProcessCollector(  # type: ignore[no-untyped-call]
+            registry,
+        )
+
+    return aiohttp.web.Response(
+        body=prometheus_client.generate_latest(registry),
+        headers={aiohttp.hdrs.CONTENT_TYPE: prometheus_client.CONTENT_TYPE_LATEST},
+    )
+
+
+async def metrics_handler(_request: aiohttp.web.Request) -> aiohttp.web.Response:
+    return metrics_response()
+
+
+async def start_metrics_server(
+    port: int,
+    *,
+    reuse_port: bool = False,
+) -> aiohttp.web.AppRunner:
+    """Serve /metrics on a port of its own, apart from any public endpoints."""
+    app = aiohttp.web.Application()
+    app.add_routes([aiohttp.web.get("/metrics", metrics_handler)])
+
+    runner = aiohttp.web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await aiohttp.web.TCPSite(runner, port=port, reuse_port=reuse_port).start()
+    return runner
@@ -0,0 +1,296 @@
+import asyncio
+import math
+import zlib
+from collections import deque
+from collections.abc import Awaitable, Callable, Sequence
+from typing import Any, Protocol
+
+from activitypub_federation_queue_batcher._apub_helpers import (
+    get_parsed_activity_ordering_key,
+)
+from activitypub_federation_queue_batcher._rmq_helpers import (
+    RabbitMQActivityQueue,
+    bootstrap_rmq,
+)
+from activitypub_federation_queue_batcher._sqlite_queue_helpers import (
+    SQLiteActivityQueue,
+)
+from activitypub_federation_queue_batcher.constants import (
+    QUEUE_BACKEND,
+    QUEUE_LANE_NAMES,
+    QUEUE_LANE_WEIGHTS,
+    QUEUE_LANES,
+    QUEUE_NAMES,
+    QUEUE_PARTITION_KEY,
+    QUEUE_PARTITIONS,
+    QUEUE_SQLITE_PATH,
+)
+
+
+class QueueMessage(Protocol):
+    @property
+    def body(self) -> bytes: ...
+
+    async def ack(self) -> None: ...
+
+    async def nack(self, *, requeue: bool = True) -> None: ...
+
+
+class LaneMessage:
+    """Queue message of a lane, delegating to the message of its queue."""
+
+    __slots__ = ("_message", "lane")
+
+    def __init__(self, message: QueueMessage, lane: int) -> None:
+        self._message = message
+        self.lane = lane
+
+    @property
+    def body(self) -> bytes:
+        return self._message.body
+
+    async def ack(self) -> None:
+        await self._message.ack()
+
+    async def nack(self, *, requeue: bool = True) -> None:
+        await self._message.nack(requeue=requeue)
+
+
+def get_message_lane(message: QueueMessage) -> int:
+    return message.lane if isinstance(message, LaneMessage) else 0
+
+
+class ActivityQueue(Protocol):
+    """
+    Durable queue of activity submissions.
+
+    The queue consists of QUEUE_PARTITIONS partitions for each lane, which are
+    ordered independently of each other. Partitions are numbered by lane
+    first, see `get_queue_partition`.
+    """
+
+    async def publish(self, bodies: Sequence[bytes], partition: int = 0) -> None:
+        """
+        Add messages to a partition of the queue in order.
+
+        Only returns once all messages are stored durably.
+        """
+
+    async def get_message_count(self) -> int | None:
+        """Get the number of messages across all partitions."""
+
+    async def consume(
+        self,
+        callback: Callable[[QueueMessage], Awaitable[None]],
+        prefetch_count: int,
+        partition: int = 0,
+    ) -> None:
+        """
+        Start passing messages of a partition to `callback` in queue order.
+
+        At most `prefetch_count` messages are delivered without having been
+        acknowledged. Messages which are not acknowledged are delivered again.
+        """
+
+    async def close(self) -> None: ...
+
+
+async def open_activity_queue() -> ActivityQueue:
+    if QUEUE_BACKEND == "sqlite":
+        return SQLiteActivityQueue(QUEUE_SQLITE_PATH, QUEUE_NAMES)
+
+    return RabbitMQActivityQueue(await bootstrap_rmq(), QUEUE_NAMES)
+
+
+def is_valid_queue_lanes() -> bool:
+    """Check QUEUE_LANES and QUEUE_LANE_WEIGHTS for conflicts."""
+    types = [t for lane_types in QUEUE_LANES.values() for t in lane_types]
+    return (
+        "default" not in QUEUE_LANES
+        and all(len(name) > 0 and len(t) > 0 for name, t in QUEUE_LANES.items())
+        # Each type can only belong to a single lane
+        and len(types) == len(set(types))
+        and all(
+            name in QUEUE_LANE_NAMES and math.isfinite(weight) and weight > 0
+            for name, weight in QUEUE_LANE_WEIGHTS.items()
+        )
+    )
+
+
+def get_queue_lane_weights() -> list[float]:
+    return [QUEUE_LANE_WEIGHTS.get(name, 1.0) for name in QUEUE_LANE_NAMES]
+
+
+def get_queue_partition(lane: int, partition: int) -> int:
+    """Get the queue partition of a partition within a lane."""
+    return lane * QUEUE_PARTITIONS + partition
+
+
+def _get_type_lane(activity: dict[str, Any]) -> int:
+    types = activity.get("type")
+    if not isinstance(types, list):
+        types = [types]
+
+    for lane, lane_types in enumerate(QUEUE_LANES.values(), start=1):
+        if any(isinstance(t, str) and t in lane_types for t in types):
+            return lane
+
+    return 0
+
+
+def get_activity_lane(activity: object) -> int:
+    """
+    Get the lane of a parsed activity by its type, the default lane is 0.
+
+    Activities wrapped by another one, e.g. in an Announce by Lemmy
+    communities, use the lane of their own type unless the outer type has one.
+    """
+    if len(QUEUE_LANES) == 0 or not isinstance(activity, dict):
+        return 0
+
+    lane = _get_type_lane(activity)
+    inner = activity.get("object")
+    if lane == 0 and isinstance(inner, dict):
+        return _get_type_lane(inner)
+
+    return lane
+
+
+def get_activity_partition(activity: object) -> int:
+    """
+    Get the queue partition of a parsed activity.
+
+    The partition within its lane is selected by QUEUE_PARTITION_KEY,
+    activities without the key go to the first partition of their lane.
+    """
+    lane = get_activity_lane(activity)
+    if QUEUE_PARTITIONS == 1:
+        return lane
+
+    key = get_parsed_activity_ordering_key(activity, QUEUE_PARTITION_KEY)
+    if key is None:
+        return get_queue_partition(lane, 0)
+
+    # Stable across processes, unlike hash()
+    return get_queue_partition(lane, zlib.crc32(key.encode()) % QUEUE_PARTITIONS)
+
+
+class BatchAccumulator:
+    """
+    Collects messages delivered by queue consumers into batches.
+
+    Messages are pushed as long as fewer than the prefetch count are
+    unacknowledged, so the prefetch count limits how many messages are buffered
+    here in addition to those of batches still being processed.
+
+    Each lane is consumed separately and batches are filled from the buffered
+    lanes by weighted fair queuing. Every message advances the virtual time of
+    its lane by the inverse of the lane's weight and the lane which is furthest
+    behind goes next, so a backlog in one lane can't delay other lanes by more
+    than their share. Messages of a lane stay in order, messages of different
+    lanes don't.
+    """
+
+    def __init__(self, weights: Sequence[float] = (1.0,)) -> None:
+        self._lanes: list[deque[QueueMessage]] = [deque() for _ in weights]
+        self._costs = [1 / weight for weight in weights]
+        # Virtual time at which each lane gets its next turn
+        self._tags = [0.0] * len(weights)
+        # Virtual time of the last message taken
+        self._virtual_time = 0.0
+        self._changed = asyncio.Event()
+        self._interrupted = False
+        # Seconds the last batch waited for further messages after its first
+        self.fill_time = 0.0
+
+    def lane_callback(self, lane: int) -> Callable[[QueueMessage], Awaitable[None]]:
+        """Get the callback to consume the queue of a lane with."""
+        if len(self._lanes) == 1:
+            return self.on_message
+
+        async def on_lane_message(message: QueueMessage) -> None:
+            self._append(lane, LaneMessage(message, lane))
+
+        return on_lane_message
+
+    async def on_message(self, message: QueueMessage) -> None:
+        self._append(0, message)
+
+    def _append(self, lane: int, message: QueueMessage) -> None:
+        messages = self._lanes[lane]
+        if len(messages) == 0:
+            # Lanes don't accumulate turns while they have nothing to send
+            self._tags[lane] = max(self._tags[lane], self._virtual_time)
+        messages.append(message)
+        self._changed.set()
+
+    @property
+    def buffered(self) -> int:
+        return sum(len(messages) for messages in self._lanes)
+
+    def requeue(self, messages: Sequence[QueueMessage]) -> None:
+        """Put messages back in front of buffered messages of their lane, in order."""
+        for message in reversed(messages):
+            self._lanes[get_message_lane(message)].appendleft(message)
+        self._changed.set()
+
+    def interrupt(self) -> None:
+        """Make the current or next `get_batch` call return without waiting."""
+        self._interrupted = True
+        self._changed.set()
+
+    def _pop(self) -> QueueMessage | None:
+        if len(self._lanes) == 1:
+            return self._lanes[0].popleft() if len(self._lanes[0]) > 0 else None
+
+        lane = min(
+            (i for i, messages in enumerate(self._lanes) if len(messages) > 0),
+            key=self._tags.__getitem__,
+            default=None,
+        )
+        if lane is None:
+            return None
+
+        self._virtual_time = self._tags[lane]
+        self._tags[lane] += self._costs[lane]
+        return self._lanes[lane].popleft()
+
+    async def get_batch(
+        self,
+        limit: int,
+        timeout: float,  # noqa: ASYNC109
+    ) -> list[QueueMessage]:
+        """
+        Wait for up to `limit` messages.
+
+        Once the first message arrived, this waits at most `timeout` seconds
+        for the batch to fill up. The batch may be empty if interrupted.
+        """
+        loop = asyncio.get_running_loop()
+        messages: list[QueueMessage] = []
+        started = None
+        deadline = None
+
+        while len(messages) < limit:
+            # Take what is already buffered without suspending for each message
+            message = self._pop()
+            if message is not None:
+                messages.append(message)
+                if started is None:
+                    started = loop.time()
+                    deadline = started + timeout
+                continue
+
+            if self._interrupted:
+                break
+
+            self._changed.clear()
+            try:
+                async with asyncio.timeout_at(deadline):
+                    await self._changed.wait()
+            except TimeoutError:
+                break
+
+        self._interrupted = False
+        self.fill_time = loop.time() - started if started is not None else 0.0
+        return messages
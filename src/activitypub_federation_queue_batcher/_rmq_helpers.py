@@ -1,12 +1,23 @@
-from aio_pika import connect_robust
+import asyncio
+import contextlib
+import itertools
+from collections import deque
+from collections.abc import Awaitable, Callable, Sequence
+from typing import Any
+
+from aio_pika import DeliveryMode, Message, connect_robust
 from aio_pika.abc import (
     AbstractChannel,
+    AbstractIncomingMessage,
+    AbstractMessage,
     AbstractQueue,
     AbstractRobustConnection,
 )
 
 from activitypub_federation_queue_batcher.constants import (
-    RABBITMQ_CHANNEL_ROUTING_KEY,
+    INBOX_RECEIVER_PUBLISH_BATCH_SIZE,
+    INBOX_RECEIVER_PUBLISH_CHANNELS,
+    QUEUE_NAMES,
     RABBITMQ_HOSTNAME,
 )
 
@@ -14,10 +25,11 @@ from activitypub_federation_queue_batcher.constants import (
 async def declare_activity_queue(
     channel: AbstractChannel,
     *,
+    name: str = QUEUE_NAMES[0],
     passive: bool = False,
 ) -> AbstractQueue:
     return await channel.declare_queue(
-        name=RABBITMQ_CHANNEL_ROUTING_KEY,
+        name=name,
         durable=True,
         exclusive=False,
         auto_delete=False,
@@ -31,6 +43,187 @@ async def bootstrap_rmq() -> AbstractRobustConnection:
     )
 
     async with rmq.channel() as channel:
-        await declare_activity_queue(channel)
+        for name in QUEUE_NAMES:
+            await declare_activity_queue(channel, name=name)
 
     return rmq
+
+
+class BatchPublisher:
+    """
+    Publishes messages with publisher confirms on a pool of channels.
+
+    Each channel publishes the messages which queued up while it was waiting
+    for confirms all at once and then waits for their confirms together.
+    Messages passed to the same `publish` call are published on the same
+    channel in order.
+    """
+
+    def __init__(
+        self,
+        channels: Sequence[AbstractChannel],
+        *,
+        max_batch_size: int,
+        timeout: float,
+    ) -> None:
+        self._channels = channels
+        self._max_batch_size = max_batch_size
+        self._timeout = timeout
+        self._pending: deque[
+            tuple[Sequence[AbstractMessage], str, asyncio.Future[None]]
+        ] = deque()
+        self._changed = asyncio.Event()
+
+    async def publish(
+        self,
+        messages: Sequence[AbstractMessage],
+        routing_key: str,
+    ) -> None:
+        """Publish messages and wait until the broker confirmed all of them."""
+        future = asyncio.get_running_loop().create_future()
+        entry = (messages, routing_key, future)
+        self._pending.append(entry)
+        self._changed.set()
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Don't publish messages which nobody waits for anymore, unless
+            # they're already being published.
+            with contextlib.suppress(ValueError):
+                self._pending.remove(entry)
+            raise
+
+    async def run(self) -> None:
+        async with asyncio.TaskGroup() as tg:
+            for channel in self._channels:
+                tg.create_task(self._publish_batches(channel))
+
+    async def _publish_batches(self, channel: AbstractChannel) -> None:
+        while True:
+            while len(self._pending) == 0:
+                self._changed.clear()
+                await self._changed.wait()
+
+            batch = [self._pending.popleft()]
+            size = len(batch[0][0])
+            while (
+                len(self._pending) > 0
+                and size + len(self._pending[0][0]) <= self._max_batch_size
+            ):
+                batch.append(self._pending.popleft())
+                size += len(batch[-1][0])
+
+            results = iter(
+                await asyncio.gather(
+                    *(
+                        channel.default_exchange.publish(
+                            message,
+                            routing_key=routing_key,
+                            timeout=self._timeout,
+                        )
+                        for messages, routing_key, _ in batch
+                        for message in messages
+                    ),
+                    return_exceptions=True,
+                ),
+            )
+
+            for messages, _, future in batch:
+                errors = [
+                    result
+                    for result in itertools.islice(results, len(messages))
+                    if isinstance(result, BaseException)
+                ]
+
+                # The request may have been cancelled in the meantime
+                if future.done():
+                    continue
+
+                if len(errors) == 0:
+                    future.set_result(None)
+                elif isinstance(errors[0], Exception):
+                    future.set_exception(errors[0])
+                else:
+                    future.cancel()
+
+
+class RabbitMQActivityQueue:
+    """Activity queue stored in RabbitMQ, with one RabbitMQ queue per partition."""
+
+    def __init__(self, rmq: AbstractRobustConnection, names: Sequence[str]) -> None:
+        self._rmq = rmq
+        # Queue name of each partition
+        self._names = names
+        self._channels: list[AbstractChannel] = []
+        self._tasks: list[asyncio.Task[None]] = []
+        self._lock = asyncio.Lock()
+        self._publisher: BatchPublisher | None = None
+        self._queues: list[AbstractQueue] | None = None
+
+    async def _open_channel(self, **kwargs: Any) -> AbstractChannel:  # noqa: ANN401
+        channel = await self._rmq.channel(**kwargs)
+        self._channels.append(channel)
+        return channel
+
+    async def _get_publisher(self) -> BatchPublisher:
+        async with self._lock:
+            if self._publisher is None:
+                # Channels are opened once instead of for every message
+                self._publisher = BatchPublisher(
+                    [
+                        await self._open_channel(on_return_raises=True)
+                        for _ in range(INBOX_RECEIVER_PUBLISH_CHANNELS)
+                    ],
+                    max_batch_size=INBOX_RECEIVER_PUBLISH_BATCH_SIZE,
+                    timeout=5.0,
+                )
+                self._tasks.append(asyncio.create_task(self._publisher.run()))
+
+        return self._publisher
+
+    async def publish(self, bodies: Sequence[bytes], partition: int = 0) -> None:
+        publisher = await self._get_publisher()
+        await publisher.publish(
+            [
+                Message(body=body, delivery_mode=DeliveryMode.PERSISTENT)
+                for body in bodies
+            ],
+            self._names[partition],
+        )
+
+    async def get_message_count(self) -> int | None:
+        async with self._lock:
+            if self._queues is None:
+                channel = await self._open_channel()
+                self._queues = [
+                    await declare_activity_queue(channel, name=name, passive=True)
+                    for name in self._names
+                ]
+                return sum(
+                    queue.declaration_result.message_count or 0
+                    for queue in self._queues
+                )
+
+        results = await asyncio.gather(*(queue.declare() for queue in self._queues))
+        return sum(result.message_count or 0 for result in results)
+
+    async def consume(
+        self,
+        callback: Callable[[AbstractIncomingMessage], Awaitable[Any]],
+        prefetch_count: int,
+        partition: int = 0,
+    ) -> None:
+        # Each partition has its own channel, so that the prefetch count
+        # applies to them separately.
+        channel = await self._open_channel()
+        await channel.set_qos(prefetch_count=prefetch_count)
+        queue = await declare_activity_queue(channel, name=self._names[partition])
+        await queue.consume(callback)
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+        await self._rmq.close()
@@ -0,0 +1,212 @@
+import asyncio
+import logging
+import mmap
+import os
+import struct
+import zlib
+from collections import deque
+from collections.abc import Awaitable, Callable, Iterable, Iterator
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Length and CRC32 of the record data, which allows detecting records that
+# were only partially written before a crash.
+SPOOL_RECORD_PREFIX = struct.Struct(">II")
+
+
+def iter_spool_records(path: Path, offset: int = 0) -> Iterator[tuple[int, bytes]]:
+    """Yield the data of each record in a segment together with its end offset."""
+    with path.open("rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            while offset + SPOOL_RECORD_PREFIX.size <= size:
+                length, crc = SPOOL_RECORD_PREFIX.unpack_from(m, offset)
+                start = offset + SPOOL_RECORD_PREFIX.size
+                end = start + length
+
+                data = m[start:end] if end <= size else b""
+                # Records are never empty, a zeroed prefix is where the file
+                # was extended but its data didn't make it to disk.
+                if length == 0 or end > size or zlib.crc32(data) != crc:
+                    logger.warning(
+                        "Ignoring incomplete record at offset %s of %s",
+                        offset,
+                        path,
+                    )
+                    return
+
+                offset = end
+                yield offset, data
+
+            if offset < size:
+                logger.warning(
+                    "Ignoring trailing data at offset %s of %s",
+                    offset,
+                    path,
+                )
+
+
+class ActivitySpool:
+    """
+    Append-only on-disk buffer for activities which couldn't be queued.
+
+    Records are appended to segment files and synced to disk in batches,
+    `append` only returns once its record is durable. Segments are replayed in
+    order and deleted once all of their records were published. If the process
+    stops while a segment is being replayed, its records are replayed again
+    from the start of the segment on the next run.
+
+    Segments which other processes left behind can be adopted, they're
+    replayed before the segments of this spool.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        segment_size: int,
+        adopted: Iterable[Path] = (),
+    ) -> None:
+        directory.mkdir(parents=True, exist_ok=True)
+        self._directory = directory
+        self._segment_size = segment_size
+
+        segments = sorted(directory.glob("*.spool"))
+        # Completed segments waiting to be replayed, oldest first
+        self._segments = deque([*adopted, *segments])
+        # Offset up to which the oldest segment has been replayed already
+        self._replayed_offset = 0
+
+        self._index = int(segments[-1].stem) + 1 if segments else 0
+        self._path, self._fd = self._open_segment()
+        self._size = 0
+
+        self._waiters: list[asyncio.Future[None]] = []
+        self._sync_needed = asyncio.Event()
+        self._appended = asyncio.Event()
+        self._rotation_requested = False
+        self._rotated = asyncio.Event()
+
+        if len(self._segments) > 0:
+            logger.warning(
+                "Found %s spool segments from a previous run",
+                len(self._segments),
+            )
+
+    def _open_segment(self) -> tuple[Path, int]:
+        path = self._directory / f"{self._index:020d}.spool"
+        return path, os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+
+    def _rotate(self) -> None:
+        # This blocks the event loop, but only happens once per segment
+        os.fsync(self._fd)
+        os.close(self._fd)
+        self._release_waiters()
+
+        self._segments.append(self._path)
+        self._index += 1
+        self._path, self._fd = self._open_segment()
+        self._size = 0
+
+    def _release_waiters(self) -> None:
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def close(self) -> None:
+        os.fsync(self._fd)
+        os.close(self._fd)
+        self._release_waiters()
+
+        if self._size == 0:
+            self._path.unlink()
+
+    def is_empty(self) -> bool:
+        """Whether all spooled activities have been replayed."""
+        return len(self._segments) == 0 and self._size == 0
+
+    async def append(self, data: bytes) -> None:
+        """Append a record and wait until it has been synced to disk."""
+        os.write(
+            self._fd,
+            SPOOL_RECORD_PREFIX.pack(len(data), zlib.crc32(data)) + data,
+        )
+        self._size += SPOOL_RECORD_PREFIX.size + len(data)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._sync_needed.set()
+        self._appended.set()
+        await waiter
+
+    async def run(self) -> None:
+        """Sync records to disk, together with all others appended meanwhile."""
+        while True:
+            await self._sync_needed.wait()
+            self._sync_needed.clear()
+
+            waiters, self._waiters = self._waiters, []
+            # Segments are only rotated here, so the file descriptor can't be
+            # closed while it's being synced.
+            await asyncio.to_thread(os.fsync, self._fd)
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+            if self._size >= self._segment_size or (
+                self._rotation_requested and self._size > 0
+            ):
+                self._rotate()
+
+            if self._rotation_requested:
+                self._rotation_requested = False
+                self._rotated.set()
+
+    async def wait(self) -> None:
+        """Wait until there are spooled activities to replay."""
+        while self.is_empty():
+            self._appended.clear()
+            await self._appended.wait()
+
+    async def replay(
+        self,
+        publish: Callable[[list[bytes]], Awaitable[None]],
+        chunk_size: int,
+    ) -> None:
+        """
+        Publish all spooled records in order, in chunks of up to `chunk_size`.
+
+        This includes records appended while replaying. If `publish` raises,
+        replaying continues after the last successfully published chunk on the
+        next call.
+        """
+        while not self.is_empty():
+            if len(self._segments) == 0:
+                # Records of the current segment can only be read once it's
+                # complete, as reads are limited to the size at mmap time.
+                self._rotation_requested = True
+                self._rotated.clear()
+                self._sync_needed.set()
+                await self._rotated.wait()
+                continue
+
+            path = self._segments[0]
+            chunk: list[bytes] = []
+            for offset, data in iter_spool_records(path, self._replayed_offset):
+                chunk.append(data)
+                if len(chunk) >= chunk_size:
+                    await publish(chunk)
+                    chunk = []
+                    self._replayed_offset = offset
+
+            if len(chunk) > 0:
+                await publish(chunk)
+
+            logger.info("Replayed spool segment %s", path)
+            path.unlink()
+            self._segments.popleft()
+            self._replayed_offset = 0
@@ -0,0 +1,328 @@
+import asyncio
+import heapq
+import logging
+import sqlite3
+from collections.abc import Awaitable, Callable, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any
+
+from activitypub_federation_queue_batcher.constants import QUEUE_SQLITE_POLL_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteQueueMessage:
+    def __init__(
+        self,
+        queue: "SQLiteActivityQueue",
+        partition: int,
+        message_id: int,
+        body: bytes,
+    ) -> None:
+        self._queue = queue
+        self.partition = partition
+        self.message_id = message_id
+        self.body = body
+
+    async def ack(self) -> None:
+        self._queue.delete_message(self)
+
+    async def nack(self, *, requeue: bool = True) -> None:
+        if requeue:
+            self._queue.requeue_message(self)
+        else:
+            self._queue.delete_message(self)
+
+
+@dataclass
+class _Consumer:
+    """Delivery state of a consumed partition."""
+
+    unacked: dict[int, SQLiteQueueMessage] = field(default_factory=dict)
+    requeued: list[tuple[int, SQLiteQueueMessage]] = field(default_factory=list)
+    changed: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+class SQLiteActivityQueue:
+    """
+    Activity queue stored in an SQLite database in WAL mode.
+
+    Each partition is stored as a separate queue within the same table. Its
+    messages are delivered in the order they were published to a single
+    consumer, which keeps track of delivered messages in memory. Messages are
+    only deleted once acknowledged, so unacknowledged messages are delivered
+    again after a restart. Acknowledgements are written together with the
+    messages published meanwhile in one transaction, but like with RabbitMQ
+    acknowledging doesn't wait for that.
+
+    Consumers are woken up right away by messages published or requeued
+    through the same instance. Messages published by other processes are
+    noticed through the data version of the database, which is checked
+    periodically without reading any messages.
+    """
+
+    def __init__(self, path: str, names: Sequence[str]) -> None:
+        # Queue name of each partition
+        self._names = names
+
+        # Each connection is only used from its own thread, which also keeps
+        # reads and writes from blocking the event loop.
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix="sqlite-writer")
+        self._reader = ThreadPoolExecutor(1, thread_name_prefix="sqlite-reader")
+        self._write_db = self._connect(path)
+        self._read_db = self._connect(path)
+
+        self._write_db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, queue TEXT NOT NULL, "
+            "body BLOB NOT NULL)",
+        )
+        self._write_db.execute(
+            "CREATE INDEX IF NOT EXISTS messages_queue ON messages (queue, id)",
+        )
+
+        self._inserts: list[tuple[str, Sequence[bytes], asyncio.Future[None]]] = []
+        self._deletes: list[int] = []
+        self._write_needed = asyncio.Event()
+        self._closing = False
+
+        self._consumers: dict[int, _Consumer] = {}
+
+        self._tasks: list[asyncio.Task[None]] = []
+        self._write_task: asyncio.Task[None] | None = None
+        self._watch_task: asyncio.Task[None] | None = None
+
+    @staticmethod
+    def _connect(path: str) -> sqlite3.Connection:
+        db = sqlite3.connect(
+            path,
+            timeout=30,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=FULL")
+        return db
+
+    def _start_writing(self) -> None:
+        if self._write_task is None:
+            self._write_task = asyncio.create_task(self._write_changes())
+        self._write_needed.set()
+
+    def _write(self, inserts: list[tuple[str, bytes]], deletes: list[int]) -> None:
+        self._write_db.execute("BEGIN IMMEDIATE")
+        try:
+            self._write_db.executemany(
+                "INSERT INTO messages (queue, body) VALUES (?, ?)",
+                inserts,
+            )
+            self._write_db.executemany(
+                "DELETE FROM messages WHERE id = ?",
+                ((message_id,) for message_id in deletes),
+            )
+        except:
+            self._write_db.execute("ROLLBACK")
+            raise
+        self._write_db.execute("COMMIT")
+
+    async def _write_changes(self) -> None:
+        loop = asyncio.get_running_loop()
+
+        while True:
+            if len(self._inserts) == 0 and len(self._deletes) == 0:
+                if self._closing:
+                    return
+                self._write_needed.clear()
+                await self._write_needed.wait()
+                continue
+
+            inserts, self._inserts = self._inserts, []
+            deletes, self._deletes = self._deletes, []
+
+            error = None
+            try:
+                await loop.run_in_executor(
+                    self._writer,
+                    self._write,
+                    [(name, body) for name, bodies, _ in inserts for body in bodies],
+                    deletes,
+                )
+            except sqlite3.Error as e:
+                # Messages which couldn't be deleted are delivered again later
+                logger.exception("Failed to write to queue database")
+                error = e
+
+            self._finish_inserts([future for _, _, future in inserts], error)
+
+    def _finish_inserts(
+        self,
+        futures: list[asyncio.Future[None]],
+        error: sqlite3.Error | None,
+    ) -> None:
+        for future in futures:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(None)
+
+        if error is None and len(futures) > 0:
+            for consumer in self._consumers.values():
+                consumer.changed.set()
+
+    async def publish(self, bodies: Sequence[bytes], partition: int = 0) -> None:
+        future = asyncio.get_running_loop().create_future()
+        self._inserts.append((self._names[partition], bodies, future))
+        self._start_writing()
+        await future
+
+    def delete_message(self, message: SQLiteQueueMessage) -> None:
+        consumer = self._consumers[message.partition]
+        if consumer.unacked.pop(message.message_id, None) is None:
+            return
+
+        self._deletes.append(message.message_id)
+        self._start_writing()
+        consumer.changed.set()
+
+    def requeue_message(self, message: SQLiteQueueMessage) -> None:
+        consumer = self._consumers[message.partition]
+        if consumer.unacked.pop(message.message_id, None) is None:
+            return
+
+        heapq.heappush(consumer.requeued, (message.message_id, message))
+        consumer.changed.set()
+
+    def _count(self) -> int:
+        count = 0
+        for name in self._names:
+            (partition_count,) = self._read_db.execute(
+                "SELECT count(*) FROM messages WHERE queue = ?",
+                (name,),
+            ).fetchone()
+            count += int(partition_count)
+        return count
+
+    async def get_message_count(self) -> int | None:
+        return await asyncio.get_running_loop().run_in_executor(
+            self._reader,
+            self._count,
+        )
+
+    def _get_data_version(self) -> int:
+        # Only changes with commits of other connections, the write connection
+        # is the only one of this instance which commits anything.
+        (version,) = self._write_db.execute("PRAGMA data_version").fetchone()
+        return int(version)
+
+    async def _watch_other_writers(self) -> None:
+        loop = asyncio.get_running_loop()
+        version = None
+
+        while True:
+            try:
+                current = await loop.run_in_executor(
+                    self._writer,
+                    self._get_data_version,
+                )
+            except sqlite3.Error:
+                logger.exception("Failed to check queue database for changes")
+                current = None
+
+            if current is None or current != version:
+                version = current
+                for consumer in self._consumers.values():
+                    consumer.changed.set()
+
+            await asyncio.sleep(QUEUE_SQLITE_POLL_INTERVAL)
+
+    def _read(self, name: str, after: int, limit: int) -> list[tuple[int, bytes]]:
+        return self._read_db.execute(
+            "SELECT id, body FROM messages WHERE queue = ? AND id > ? "
+            "ORDER BY id LIMIT ?",
+            (name, after, limit),
+        ).fetchall()
+
+    async def _deliver(
+        self,
+        callback: Callable[[SQLiteQueueMessage], Awaitable[Any]],
+        prefetch_count: int,
+        partition: int,
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        consumer = self._consumers[partition]
+        # Highest id delivered so far, older messages are only delivered again
+        # when requeued.
+        cursor = 0
+
+        while True:
+            # Cleared before checking, so changes while reading aren't missed
+            consumer.changed.clear()
+
+            if len(consumer.unacked) >= prefetch_count:
+                await consumer.changed.wait()
+                continue
+
+            if len(consumer.requeued) > 0:
+                _, message = heapq.heappop(consumer.requeued)
+                consumer.unacked[message.message_id] = message
+                await callback(message)
+                continue
+
+            try:
+                rows = await loop.run_in_executor(
+                    self._reader,
+                    self._read,
+                    self._names[partition],
+                    cursor,
+                    prefetch_count - len(consumer.unacked),
+                )
+            except sqlite3.Error:
+                logger.exception("Failed to read from queue database")
+                rows = []
+
+            if len(rows) == 0:
+                await consumer.changed.wait()
+                continue
+
+            for message_id, body in rows:
+                cursor = message_id
+                message = SQLiteQueueMessage(self, partition, message_id, body)
+                consumer.unacked[message_id] = message
+                await callback(message)
+
+    async def consume(
+        self,
+        callback: Callable[[SQLiteQueueMessage], Awaitable[Any]],
+        prefetch_count: int,
+        partition: int = 0,
+    ) -> None:
+        self._consumers[partition] = _Consumer()
+        self._tasks.append(
+            asyncio.create_task(self._deliver(callback, prefetch_count, partition)),
+        )
+
+        if self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch_other_writers())
+            self._tasks.append(self._watch_task)
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+        # Write outstanding acknowledgements before closing
+        self._closing = True
+        if self._write_task is not None:
+            self._write_needed.set()
+            await self._write_task
+
+        # Connections are closed on their own threads after any pending reads
+        for executor, db in (
+            (self._writer, self._write_db),
+            (self._reader, self._read_db),
+        ):
+            await asyncio.get_running_loop().run_in_executor(executor, db.close)
+            executor.shutdown()
@@ -0,0 +1,127 @@
+from types import SimpleNamespace
+
+import aiohttp
+from prometheus_client import Counter, Histogram
+
+from activitypub_federation_queue_batcher._metrics_helpers import DURATION_BUCKETS
+from activitypub_federation_queue_batcher.constants import (
+    BATCH_RECEIVER_UPSTREAM_CONNECT_TIMEOUT,
+    BATCH_RECEIVER_UPSTREAM_CONNECTIONS,
+    BATCH_RECEIVER_UPSTREAM_CONNECTIONS_PER_HOST,
+    BATCH_RECEIVER_UPSTREAM_DNS_CACHE_TTL,
+    BATCH_RECEIVER_UPSTREAM_KEEPALIVE_TIMEOUT,
+    BATCH_RECEIVER_UPSTREAM_READ_TIMEOUT,
+    BATCH_RECEIVER_UPSTREAM_UNIX_SOCKET,
+)
+
+UPSTREAM_CONNECTIONS_METRIC = Counter(
+    "batch_receiver_upstream_connections",
+    "Upstream requests by whether they opened a new connection or reused one",
+    ["connection"],
+)
+UPSTREAM_CONNECTION_WAIT_METRIC = Histogram(
+    "batch_receiver_upstream_connection_wait_seconds",
+    "Seconds requests waited for a connection because of the pool limits",
+    buckets=DURATION_BUCKETS,
+)
+UPSTREAM_DNS_CACHE_METRIC = Counter(
+    "batch_receiver_upstream_dns_cache",
+    "Upstream host name lookups by whether they were cached",
+    ["result"],
+)
+
+
+async def _on_connection_create_end(
+    _session: aiohttp.ClientSession,
+    _ctx: SimpleNamespace,
+    _params: aiohttp.TraceConnectionCreateEndParams,
+) -> None:
+    UPSTREAM_CONNECTIONS_METRIC.labels("new").inc()
+
+
+async def _on_connection_reuseconn(
+    _session: aiohttp.ClientSession,
+    _ctx: SimpleNamespace,
+    _params: aiohttp.TraceConnectionReuseconnParams,
+) -> None:
+    UPSTREAM_CONNECTIONS_METRIC.labels("reused").inc()
+
+
+async def _on_connection_queued_start(
+    session: aiohttp.ClientSession,
+    ctx: SimpleNamespace,
+    _params: aiohttp.TraceConnectionQueuedStartParams,
+) -> None:
+    ctx.queued_at = session.loop.time()
+
+
+async def _on_connection_queued_end(
+    session: aiohttp.ClientSession,
+    ctx: SimpleNamespace,
+    _params: aiohttp.TraceConnectionQueuedEndParams,
+) -> None:
+    UPSTREAM_CONNECTION_WAIT_METRIC.observe(session.loop.time() - ctx.queued_at)
+
+
+async def _on_dns_cache_hit(
+    _session: aiohttp.ClientSession,
+    _ctx: SimpleNamespace,
+    _params: aiohttp.TraceDnsCacheHitParams,
+) -> None:
+    UPSTREAM_DNS_CACHE_METRIC.labels("hit").inc()
+
+
+async def _on_dns_cache_miss(
+    _session: aiohttp.ClientSession,
+    _ctx: SimpleNamespace,
+    _params: aiohttp.TraceDnsCacheMissParams,
+) -> None:
+    UPSTREAM_DNS_CACHE_METRIC.labels("miss").inc()
+
+
+def create_upstream_trace_config() -> aiohttp.TraceConfig:
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_end.append(_on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(_on_connection_reuseconn)
+    trace_config.on_connection_queued_start.append(_on_connection_queued_start)
+    trace_config.on_connection_queued_end.append(_on_connection_queued_end)
+    trace_config.on_dns_cache_hit.append(_on_dns_cache_hit)
+    trace_config.on_dns_cache_miss.append(_on_dns_cache_miss)
+    return trace_config
+
+
+def create_upstream_session() -> aiohttp.ClientSession:
+    """
+    Create the client session for submitting activities upstream.
+
+    Connections are kept alive and reused for further activities. aiohttp
+    doesn't pipeline requests, a connection is only returned to the pool once
+    its response has been read completely.
+    """
+    connector: aiohttp.BaseConnector
+    if BATCH_RECEIVER_UPSTREAM_UNIX_SOCKET is not None:
+        # The URL still determines the protocol, while the Host header of the
+        # activity determines the virtual host.
+        connector = aiohttp.UnixConnector(
+            path=BATCH_RECEIVER_UPSTREAM_UNIX_SOCKET,
+            limit=BATCH_RECEIVER_UPSTREAM_CONNECTIONS,
+            limit_per_host=BATCH_RECEIVER_UPSTREAM_CONNECTIONS_PER_HOST,
+            keepalive_timeout=BATCH_RECEIVER_UPSTREAM_KEEPALIVE_TIMEOUT,
+        )
+    else:
+        connector = aiohttp.TCPConnector(
+            limit=BATCH_RECEIVER_UPSTREAM_CONNECTIONS,
+            limit_per_host=BATCH_RECEIVER_UPSTREAM_CONNECTIONS_PER_HOST,
+            keepalive_timeout=BATCH_RECEIVER_UPSTREAM_KEEPALIVE_TIMEOUT,
+            use_dns_cache=BATCH_RECEIVER_UPSTREAM_DNS_CACHE_TTL != 0,
+            ttl_dns_cache=BATCH_RECEIVER_UPSTREAM_DNS_CACHE_TTL,
+        )
+
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(
+            connect=BATCH_RECEIVER_UPSTREAM_CONNECT_TIMEOUT,
+            sock_read=BATCH_RECEIVER_UPSTREAM_READ_TIMEOUT,
+        ),
+        trace_configs=[create_upstream_trace_config()],
+    )
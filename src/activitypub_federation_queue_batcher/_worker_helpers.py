@@ -0,0 +1,76 @@
+import logging
+import multiprocessing
+import multiprocessing.connection
+import multiprocessing.sharedctypes
+import signal
+from collections.abc import Callable
+from dataclasses import dataclass
+from types import FrameType
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class WorkerContext:
+    index: int
+    count: int
+    # Last known queue depth shared by all workers, -1 if unknown
+    queue_depth: "multiprocessing.sharedctypes.Synchronized[int]"
+
+
+def run_workers(count: int, target: Callable[[WorkerContext], None]) -> int:
+    """
+    Run `target` in `count` worker processes until one of them exits.
+
+    SIGINT and SIGTERM are passed on to the workers for a graceful shutdown.
+    If a worker exits on its own, the remaining ones are stopped as well and
+    the exit code indicates a failure, so that the service gets restarted.
+    """
+    # Nothing but logging has been set up at this point, so forking is safe.
+    # Spawning would require `target` to be importable outside of __main__.
+    context = multiprocessing.get_context("fork")
+    stopping = False
+
+    queue_depth = context.Value("q", -1)
+    processes = [
+        context.Process(
+            target=target,
+            args=(
+                WorkerContext(
+                    index=index,
+                    count=count,
+                    queue_depth=queue_depth,
+                ),
+            ),
+            name=f"worker-{index}",
+        )
+        for index in range(count)
+    ]
+
+    def stop(signum: int, _frame: FrameType | None) -> None:
+        nonlocal stopping
+        stopping = True
+        logger.info("Stopping workers after signal %s", signum)
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    for process in processes:
+        process.start()
+    logger.info("Started %s workers", count)
+
+    # Only installed now, as workers would inherit the handlers otherwise
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    multiprocessing.connection.wait([process.sentinel for process in processes])
+    if not stopping:
+        logger.error("A worker exited unexpectedly, stopping all workers")
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    for process in processes:
+        process.join()
+
+    return 0 if stopping else 1
@@ -1,31 +1,82 @@
+import asyncio
 import logging
-from base64 import b64decode
+import sys
+import time
+from collections import OrderedDict, deque
+from collections.abc import AsyncIterator, Coroutine
+from dataclasses import dataclass, field
 from datetime import UTC, datetime
+from typing import Any, TypeAlias, TypeVar
 from urllib.parse import urlunsplit
 
 import aiohttp.web
 import multidict
+from prometheus_client import Counter, Histogram
 
 from activitypub_federation_queue_batcher._aiohttp_helpers import (
     ALLOWED_IPS_APP_KEY,
+    IPMatcher,
     is_allowed_ip,
     parse_trusted_ips,
 )
 from activitypub_federation_queue_batcher._apub_helpers import (
+    ACTIVITY_ORDERING_KEYS,
+    get_activity_ordering_key,
     is_permanent_activity_submission_failure,
     is_tolerable_activity_submission_status_code,
 )
+from activitypub_federation_queue_batcher._batch_helpers import (
+    BATCH_CONTENT_ENCODING_HEADER,
+    BATCH_PARTITIONING_HEADER,
+    BATCH_RESUME_HEADER,
+    BATCH_SEQUENCE_HEADER,
+    BATCH_SESSION_HEADER,
+    BINARY_BATCH_CONTENT_TYPE,
+    NDJSON_CONTENT_TYPE,
+)
+from activitypub_federation_queue_batcher._compression_helpers import (
+    BatchDecompressionError,
+    BatchDecompressor,
+    BatchTooLargeError,
+    StreamingBatchDecompressor,
+    UnsupportedBatchEncodingError,
+    load_zstd_dictionary,
+)
 from activitypub_federation_queue_batcher._logging_helpers import setup_logging
+from activitypub_federation_queue_batcher._metrics_helpers import (
+    DELAY_BUCKETS,
+    DURATION_BUCKETS,
+    metrics_response,
+)
+from activitypub_federation_queue_batcher._upstream_helpers import (
+    create_upstream_session,
+)
+from activitypub_federation_queue_batcher.codec import (
+    BinaryBatchParser,
+    JSONBatchParser,
+    encode_activity_submission_metadata,
+    encode_upstream_submission_response,
+    encode_upstream_submission_responses,
+    iter_binary_batch,
+)
 from activitypub_federation_queue_batcher.constants import (
+    BATCH_RECEIVER_MAX_BATCH_SIZE,
+    BATCH_RECEIVER_MAX_SESSIONS,
+    BATCH_RECEIVER_ORDERING_KEY,
+    BATCH_RECEIVER_PARTITION_CONCURRENCY,
     BATCH_RECEIVER_PATH,
+    BATCH_RECEIVER_RESPONSE_COMPRESSION,
+    BATCH_RECEIVER_SEQUENCE_TIMEOUT,
     HTTP_ALLOWED_IPS,
     HTTP_BATCH_AUTHORIZATION,
+    HTTP_BATCH_ZSTD_DICTIONARY,
     HTTP_TRUSTED_PROXIES,
     OVERRIDE_DESTINATION_DOMAIN,
     OVERRIDE_DESTINATION_PROTOCOL,
+    WEBSOCKET_HEARTBEAT,
 )
 from activitypub_federation_queue_batcher.types import (
-    SerializableActivitySubmission,
+    ActivitySubmissionMetadata,
     UpstreamSubmissionResponse,
 )
 
@@ -35,15 +86,128 @@ if HTTP_TRUSTED_PROXIES is not None:
 logger = logging.getLogger(__name__)
 
 
+BatchParser: TypeAlias = BinaryBatchParser | JSONBatchParser
+
+# Bytes of a batch parsed at once, compressed batches are read in smaller
+# chunks as they expand to several times their size
+BATCH_READ_SIZE = 2**16
+COMPRESSED_BATCH_READ_SIZE = 2**13
+
+# Activities of a partitioned batch received ahead of their submission, per
+# partition submitted concurrently
+PARTITION_READ_AHEAD = 4
+
 AIOHTTP_CLIENTSESSION = aiohttp.web.AppKey(
     "AIOHTTP_CLIENTSESSION",
     aiohttp.ClientSession,
 )
 
 
+@dataclass
+class BatchSession:
+    next_sequence: int = 0
+    # Once a batch of a session stopped early, no later batches of the same
+    # session may be processed as that would break the activity order.
+    failed: bool = False
+    condition: asyncio.Condition = field(default_factory=asyncio.Condition)
+    # Requests of the session which are waiting for their turn or in progress
+    requests: int = 0
+    # Requests with a lower sequence number have been superseded by the batch
+    # sender resuming after a failure, or by a newer websocket connection.
+    resumed_at: int = 0
+    # Submits the activities of the request whose turn it is
+    processing: asyncio.Task[Any] | None = None
+
+
+T = TypeVar("T")
+
+
+SUBMISSION_DELAY_METRIC = Histogram(
+    "batch_receiver_submission_delay_seconds",
+    "Seconds between inbox-receiver accepting an activity and submitting it upstream",
+    buckets=DELAY_BUCKETS,
+)
+UPSTREAM_DURATION_METRIC = Histogram(
+    "batch_receiver_upstream_duration_seconds",
+    "Seconds until upstream responded to an activity",
+    buckets=DURATION_BUCKETS,
+)
+UPSTREAM_RESPONSES_METRIC = Counter(
+    "batch_receiver_upstream_responses",
+    "Upstream responses to activities by status code",
+    ["status"],
+)
+UPSTREAM_ERRORS_METRIC = Counter(
+    "batch_receiver_upstream_errors",
+    "Activities which couldn't be submitted upstream by error",
+    ["error"],
+)
+RECEIVED_BYTES_METRIC = Counter(
+    "batch_receiver_received_bytes",
+    "Bytes of received batches and websocket messages, before decompression",
+)
+
+BATCH_DECOMPRESSOR_APP_KEY = aiohttp.web.AppKey(
+    "BATCH_DECOMPRESSOR_APP_KEY",
+    BatchDecompressor,
+)
+
+BATCH_SESSIONS_APP_KEY = aiohttp.web.AppKey(
+    "BATCH_SESSIONS_APP_KEY",
+    OrderedDict[str, BatchSession],
+)
+
+
+def get_batch_session(
+    sessions: OrderedDict[str, BatchSession],
+    session_id: str,
+) -> BatchSession:
+    session = sessions.get(session_id)
+
+    if session is not None:
+        sessions.move_to_end(session_id)
+        return session
+
+    if len(sessions) >= BATCH_RECEIVER_MAX_SESSIONS:
+        # Drops the least recently used session, unless all of them have
+        # requests which still rely on it.
+        idle = next((k for k, v in sessions.items() if v.requests == 0), None)
+        if idle is not None:
+            del sessions[idle]
+
+    session = sessions[session_id] = BatchSession()
+    return session
+
+
+async def run_session_task(
+    session: BatchSession,
+    coro: Coroutine[Any, Any, T],
+) -> asyncio.Task[T]:
+    """Run `coro` as the processing task of a session until it's done."""
+    task = session.processing = asyncio.create_task(coro)
+    try:
+        await asyncio.wait([task])
+    finally:
+        # Also stops the task if the request itself got cancelled
+        task.cancel()
+        session.processing = None
+
+    return task
+
+
+def resume_session(session: BatchSession, sequence: int) -> None:
+    """Supersede all requests of a session before `sequence`."""
+    if sequence > session.resumed_at:
+        session.resumed_at = sequence
+        # Requests which are waiting for their turn skip themselves
+        if session.processing is not None:
+            session.processing.cancel()
+
+
 async def submit(
     cs: aiohttp.ClientSession,
-    activity: SerializableActivitySubmission,
+    activity: ActivitySubmissionMetadata,
+    data: bytes,
 ) -> UpstreamSubmissionResponse:
     req_headers: multidict.CIMultiDict[str] = multidict.CIMultiDict()
     for header in activity.headers:
@@ -63,6 +227,7 @@ async def submit(
 
     now = datetime.now(UTC)
     submission_delay = now - activity.time
+    SUBMISSION_DELAY_METRIC.observe(submission_delay.total_seconds())
 
     logger.info(
         "Submitting activity id %s after a delay of %s",
@@ -70,53 +235,219 @@ async def submit(
         submission_delay,
     )
 
-    async with cs.post(
-        url,
-        data=b64decode(activity.b64_body),
-        headers=req_headers,
-    ) as resp:
-        body = (
-            await resp.text()
-            if resp.content_length is not None and resp.content_length > 0
-            else None
+    start = time.perf_counter()
+    try:
+        async with cs.post(
+            url,
+            data=data,
+            headers=req_headers,
+        ) as resp:
+            body = (
+                await resp.text()
+                if resp.content_length is not None and resp.content_length > 0
+                else None
+            )
+    except (aiohttp.ClientError, TimeoutError) as e:
+        # Reported like an upstream failure, so that batch-sender sends this
+        # and all following activities again.
+        logger.warning(
+            "Failed to submit activity id %s: %r",
+            activity.activity_id,
+            e,
         )
-
-        usr = UpstreamSubmissionResponse(
+        UPSTREAM_ERRORS_METRIC.labels(type(e).__name__).inc()
+        status = (
+            aiohttp.web.HTTPGatewayTimeout.status_code
+            if isinstance(e, TimeoutError)
+            else aiohttp.web.HTTPBadGateway.status_code
+        )
+        return UpstreamSubmissionResponse(
             time=datetime.now(UTC),
             activity_id=activity.activity_id,
-            status=resp.status,
-            headers=[[k, v] for k, v in resp.headers.items()],
-            content_type=resp.headers.get(aiohttp.hdrs.CONTENT_TYPE),
-            body=body,
+            status=status,
+            headers=[],
+            content_type="text/plain",
+            body=f"Failed to submit activity: {e!r}",
         )
 
-        if is_permanent_activity_submission_failure(resp.status):
-            logger.warning(
-                "Got status %s for activity id %s",
-                resp.status,
-                activity.activity_id,
-            )
-            logger.warning(
-                "Activity %s request: %s",
-                activity.activity_id,
-                SerializableActivitySubmission.schema().dumps(activity),
-            )
-            logger.warning(
-                "Activity %s response: %s",
-                activity.activity_id,
-                UpstreamSubmissionResponse.schema().dumps(usr),
-            )
-        else:
-            logger.info(
-                "Got status %s for activity id %s",
-                resp.status,
-                activity.activity_id,
+    UPSTREAM_DURATION_METRIC.observe(time.perf_counter() - start)
+    UPSTREAM_RESPONSES_METRIC.labels(resp.status).inc()
+
+    usr = UpstreamSubmissionResponse(
+        time=datetime.now(UTC),
+        activity_id=activity.activity_id,
+        status=resp.status,
+        headers=[[k, v] for k, v in resp.headers.items()],
+        content_type=resp.headers.get(aiohttp.hdrs.CONTENT_TYPE),
+        body=body,
+    )
+
+    if is_permanent_activity_submission_failure(resp.status):
+        logger.warning(
+            "Got status %s for activity id %s",
+            resp.status,
+            activity.activity_id,
+        )
+        logger.warning(
+            "Activity %s request: %s",
+            activity.activity_id,
+            encode_activity_submission_metadata(activity).decode(),
+        )
+        logger.warning(
+            "Activity %s request body: %s",
+            activity.activity_id,
+            data.decode(errors="replace"),
+        )
+        logger.warning(
+            "Activity %s response: %s",
+            activity.activity_id,
+            encode_upstream_submission_response(usr).decode(),
+        )
+    else:
+        logger.info(
+            "Got status %s for activity id %s",
+            resp.status,
+            activity.activity_id,
+        )
+
+    return usr
+
+
+class BatchReader:
+    """
+    Yields the activities of a batch while its request body is being received.
+
+    Each activity is only kept until it has been taken from the reader, so
+    memory usage doesn't grow with the size of the batch. Errors before the
+    first activity are raised by `start()` to reject the batch as a whole,
+    later ones end the batch early like a failed submission and the batch
+    sender sends activities without a result again.
+    """
+
+    def __init__(
+        self,
+        chunks: AsyncIterator[bytes],
+        parser: BatchParser,
+        decompressor: StreamingBatchDecompressor | None,
+    ) -> None:
+        self._chunks = chunks
+        self._parser = parser
+        self._decompressor = decompressor
+        self._activities: deque[tuple[ActivitySubmissionMetadata, bytes]] = deque()
+        self._received = 0
+        self._done = False
+        self.count = 0
+        self.failed = False
+
+    async def _read(self) -> None:
+        """Read until at least one activity is available or the batch ended."""
+        while len(self._activities) == 0 and not self._done:
+            chunk = await anext(self._chunks, None)
+
+            if chunk is None:
+                self._done = True
+                if self._decompressor is not None:
+                    self._decompressor.finish()
+                self._parser.close()
+                return
+
+            RECEIVED_BYTES_METRIC.inc(len(chunk))
+            self._received += len(chunk)
+            if self._received > BATCH_RECEIVER_MAX_BATCH_SIZE:
+                raise BatchTooLargeError(BATCH_RECEIVER_MAX_BATCH_SIZE)
+
+            if self._decompressor is not None:
+                chunk = self._decompressor.decompress(chunk)
+
+            self._activities.extend(self._parser.feed(chunk))
+
+    async def start(self) -> None:
+        await self._read()
+
+    def __aiter__(self) -> "BatchReader":
+        return self
+
+    async def __anext__(self) -> tuple[ActivitySubmissionMetadata, bytes]:
+        try:
+            await self._read()
+        except ValueError:
+            logger.exception(
+                "Received invalid batch, stopping after %s activities",
+                self.count,
             )
+            self._done = True
+            self.failed = True
+
+        if len(self._activities) == 0:
+            raise StopAsyncIteration
+
+        self.count += 1
+        return self._activities.popleft()
+
+
+def create_batch_parser(content_type: str) -> BatchParser | None:
+    if content_type == BINARY_BATCH_CONTENT_TYPE:
+        return BinaryBatchParser()
+
+    if content_type == "application/json":
+        return JSONBatchParser()
+
+    return None
 
-        return usr
 
+async def open_batch(request: aiohttp.web.Request) -> BatchReader:
+    parser = create_batch_parser(request.content_type)
+    if parser is None:
+        raise aiohttp.web.HTTPUnsupportedMediaType(
+            text="Unsupported batch content-type",
+        )
+
+    if (
+        request.content_length is not None
+        and request.content_length > BATCH_RECEIVER_MAX_BATCH_SIZE
+    ):
+        raise aiohttp.web.HTTPRequestEntityTooLarge(
+            max_size=BATCH_RECEIVER_MAX_BATCH_SIZE,
+            actual_size=request.content_length,
+        )
 
-async def handler(request: aiohttp.web.Request) -> aiohttp.web.Response:
+    encoding = request.headers.get(BATCH_CONTENT_ENCODING_HEADER)
+
+    try:
+        reader = (
+            BatchReader(
+                request.content.iter_chunked(BATCH_READ_SIZE),
+                parser,
+                None,
+            )
+            if encoding is None
+            else BatchReader(
+                request.content.iter_chunked(COMPRESSED_BATCH_READ_SIZE),
+                parser,
+                request.app[BATCH_DECOMPRESSOR_APP_KEY].decompressobj(encoding),
+            )
+        )
+        await reader.start()
+    except UnsupportedBatchEncodingError as e:
+        raise aiohttp.web.HTTPUnsupportedMediaType(
+            text="Unsupported batch encoding",
+        ) from e
+    except BatchTooLargeError as e:
+        raise aiohttp.web.HTTPRequestEntityTooLarge(
+            max_size=BATCH_RECEIVER_MAX_BATCH_SIZE,
+            actual_size=BATCH_RECEIVER_MAX_BATCH_SIZE + 1,
+        ) from e
+    except BatchDecompressionError as e:
+        logger.warning("Failed to decompress %s batch: %s", encoding, e)
+        raise aiohttp.web.HTTPBadRequest(text="Invalid batch encoding") from e
+    except ValueError as e:
+        logger.exception("Received invalid batch")
+        raise aiohttp.web.HTTPBadRequest(text="Invalid batch") from e
+
+    return reader
+
+
+def check_access(request: aiohttp.web.Request) -> None:
     if ALLOWED_IPS_APP_KEY in request.app:
         if request.remote is None:
             logger.warning("Allowed IPs configured but source IP was None")
@@ -132,40 +463,421 @@ async def handler(request: aiohttp.web.Request) -> aiohttp.web.Response:
     if HTTP_BATCH_AUTHORIZATION is not None and (
         request.headers.get(aiohttp.hdrs.AUTHORIZATION) != HTTP_BATCH_AUTHORIZATION
     ):
-        return aiohttp.web.HTTPUnauthorized(text="Missing authorization header")
+        raise aiohttp.web.HTTPUnauthorized(text="Missing authorization header")
 
-    body = await request.read()
 
-    activities: list[SerializableActivitySubmission] = (
-        SerializableActivitySubmission.schema().loads(body, many=True)
+async def metrics_handler(request: aiohttp.web.Request) -> aiohttp.web.Response:
+    check_access(request)
+    return metrics_response()
+
+
+async def handler(request: aiohttp.web.Request) -> aiohttp.web.StreamResponse:
+    check_access(request)
+
+    # Only the start of the batch has been received at this point
+    activities = await open_batch(request)
+
+    writer = (
+        StreamingBatchResponseWriter(request)
+        if NDJSON_CONTENT_TYPE in request.headers.get(aiohttp.hdrs.ACCEPT, "")
+        else BatchResponseWriter(request)
     )
 
-    responses = []
+    partitioned = (
+        BATCH_RECEIVER_ORDERING_KEY != "none"
+        and BATCH_PARTITIONING_HEADER in request.headers
+    )
+
+    session_id = request.headers.get(BATCH_SESSION_HEADER)
+    sequence = request.headers.get(BATCH_SEQUENCE_HEADER)
+
+    if session_id is None or sequence is None:
+        await submit_activities(
+            request.app[AIOHTTP_CLIENTSESSION],
+            activities,
+            writer,
+            partitioned=partitioned,
+        )
+    elif not sequence.isdecimal():
+        return aiohttp.web.HTTPBadRequest(text="Invalid batch sequence")
+    else:
+        try:
+            await submit_sequenced_activities(
+                request.app[AIOHTTP_CLIENTSESSION],
+                request.app[BATCH_SESSIONS_APP_KEY],
+                activities,
+                writer,
+                partitioned=partitioned,
+                session_id=session_id,
+                sequence=int(sequence),
+                resume=BATCH_RESUME_HEADER in request.headers,
+            )
+        except TimeoutError:
+            logger.warning(
+                "Timed out waiting for batch %s of session %s to be next",
+                sequence,
+                session_id,
+            )
+            return aiohttp.web.HTTPConflict(text="Previous batch did not arrive")
+
+    return await writer.finish()
+
+
+class BatchResponseWriter:
+    """Collects all responses and sends them as one JSON array at the end."""
+
+    def __init__(self, request: aiohttp.web.Request) -> None:
+        self._request = request
+        self._responses: list[UpstreamSubmissionResponse] = []
+
+    async def write(self, usr: UpstreamSubmissionResponse) -> None:
+        self._responses.append(usr)
+
+    async def finish(self) -> aiohttp.web.StreamResponse:
+        response = aiohttp.web.json_response(
+            body=encode_upstream_submission_responses(self._responses),
+        )
+
+        if BATCH_RECEIVER_RESPONSE_COMPRESSION:
+            # Uses whatever the batch sender supports according to its
+            # Accept-Encoding header.
+            response.enable_compression()
+
+        return response
+
+
+class StreamingBatchResponseWriter(BatchResponseWriter):
+    """Sends each response as a separate line as soon as it is known."""
+
+    def __init__(self, request: aiohttp.web.Request) -> None:
+        super().__init__(request)
+        self._response: aiohttp.web.StreamResponse | None = None
+        # Partitions of a batch write their results concurrently
+        self._lock = asyncio.Lock()
+
+    async def _prepare(self) -> aiohttp.web.StreamResponse:
+        # Preparing lazily allows returning a regular error response for
+        # batches which turn out to not be processable at all.
+        if self._response is None:
+            self._response = aiohttp.web.StreamResponse()
+            self._response.content_type = NDJSON_CONTENT_TYPE
+            await self._response.prepare(self._request)
+
+        return self._response
+
+    async def write(self, usr: UpstreamSubmissionResponse) -> None:
+        async with self._lock:
+            response = await self._prepare()
+            await response.write(
+                encode_upstream_submission_response(usr) + b"\n",
+            )
+
+    async def finish(self) -> aiohttp.web.StreamResponse:
+        async with self._lock:
+            response = await self._prepare()
+            await response.write_eof()
+            return response
+
+
+async def submit_partition(
+    cs: aiohttp.ClientSession,
+    partition: asyncio.Queue[tuple[int, ActivitySubmissionMetadata, bytes] | None],
+    writer: BatchResponseWriter,
+    semaphore: asyncio.Semaphore,
+    read_ahead: asyncio.Semaphore,
+) -> bool:
+    completed = True
+
+    while (entry := await partition.get()) is not None:
+        index, activity, data = entry
+
+        try:
+            if completed:
+                async with semaphore:
+                    resp = await submit(cs, activity, data)
+                resp.index = index
+                await writer.write(resp)
+
+                if not is_tolerable_activity_submission_status_code(resp.status):
+                    logger.info(
+                        "Skipping remaining activities of partition after %s",
+                        activity.activity_id,
+                    )
+                    completed = False
+        finally:
+            read_ahead.release()
+
+    return completed
+
+
+async def submit_partitioned_activities(
+    cs: aiohttp.ClientSession,
+    activities: BatchReader,
+    writer: BatchResponseWriter,
+) -> bool:
+    partitions: dict[
+        str | None,
+        asyncio.Queue[tuple[int, ActivitySubmissionMetadata, bytes] | None],
+    ] = {}
+    semaphore = asyncio.Semaphore(BATCH_RECEIVER_PARTITION_CONCURRENCY)
+    # Stops receiving the batch while upstream is falling behind
+    read_ahead = asyncio.Semaphore(
+        BATCH_RECEIVER_PARTITION_CONCURRENCY * PARTITION_READ_AHEAD,
+    )
 
-    for activity in activities:
-        resp = await submit(request.app[AIOHTTP_CLIENTSESSION], activity)
-        responses.append(resp)
+    async with asyncio.TaskGroup() as tg:
+        tasks = []
+        index = 0
+
+        await read_ahead.acquire()
+        async for activity, data in activities:
+            # Activities without ordering key end up in the same partition
+            key = get_activity_ordering_key(data, BATCH_RECEIVER_ORDERING_KEY)
+            partition = partitions.get(key)
+            if partition is None:
+                partition = partitions[key] = asyncio.Queue()
+                tasks.append(
+                    tg.create_task(
+                        submit_partition(cs, partition, writer, semaphore, read_ahead),
+                    ),
+                )
+
+            partition.put_nowait((index, activity, data))
+            index += 1
+            await read_ahead.acquire()
+
+        for partition in partitions.values():
+            partition.put_nowait(None)
+
+    # Other partitions are submitted completely even if one of them failed,
+    # the batch sender only acknowledges activities with a result.
+    return not activities.failed and all(task.result() for task in tasks)
+
+
+async def submit_activities(
+    cs: aiohttp.ClientSession,
+    activities: BatchReader,
+    writer: BatchResponseWriter,
+    *,
+    partitioned: bool = False,
+) -> bool:
+    if partitioned:
+        return await submit_partitioned_activities(cs, activities, writer)
+
+    async for activity, data in activities:
+        resp = await submit(cs, activity, data)
+        await writer.write(resp)
 
         if not is_tolerable_activity_submission_status_code(resp.status):
+            return False
+
+    return not activities.failed
+
+
+async def submit_sequenced_activities(
+    cs: aiohttp.ClientSession,
+    sessions: OrderedDict[str, BatchSession],
+    activities: BatchReader,
+    writer: BatchResponseWriter,
+    *,
+    partitioned: bool,
+    session_id: str,
+    sequence: int,
+    resume: bool = False,
+) -> None:
+    session = get_batch_session(sessions, session_id)
+    if resume:
+        resume_session(session, sequence)
+
+    # Keeps the session from being evicted while it's needed
+    session.requests += 1
+    try:
+        async with session.condition:
+            if sequence < session.next_sequence:
+                logger.warning(
+                    "Ignoring batch %s of session %s, it was already processed",
+                    sequence,
+                    session_id,
+                )
+                return
+
+            if resume and sequence == session.resumed_at:
+                # Earlier batches have been stopped at this point, the batch
+                # sender sends their remaining activities again.
+                session.next_sequence = sequence
+                session.failed = False
+                session.condition.notify_all()
+
+            async with asyncio.timeout(BATCH_RECEIVER_SEQUENCE_TIMEOUT):
+                await session.condition.wait_for(
+                    lambda: (
+                        session.next_sequence == sequence
+                        or sequence < session.resumed_at
+                    ),
+                )
+
+            if sequence < session.resumed_at:
+                logger.info(
+                    "Skipping batch %s of session %s, the sender resumed after it",
+                    sequence,
+                    session_id,
+                )
+                return
+
+            completed = False
+            try:
+                if session.failed:
+                    logger.info(
+                        "Skipping batch %s of failed session %s",
+                        sequence,
+                        session_id,
+                    )
+                    completed = True
+                else:
+                    task = await run_session_task(
+                        session,
+                        submit_activities(
+                            cs,
+                            activities,
+                            writer,
+                            partitioned=partitioned,
+                        ),
+                    )
+                    # Cancelled if the sender resumed meanwhile
+                    completed = not task.cancelled() and task.result()
+            finally:
+                # If the request got cancelled halfway, we can't tell how far we
+                # got, so any later batches must not be processed either.
+                session.failed = session.failed or not completed
+                session.next_sequence += 1
+                session.condition.notify_all()
+    finally:
+        session.requests -= 1
+
+
+async def process_websocket_activities(
+    request: aiohttp.web.Request,
+    ws: aiohttp.web.WebSocketResponse,
+) -> None:
+    # Activities are processed one at a time in the order they arrive in, while
+    # further activities sent by the batch sender are buffered by aiohttp.
+    async for msg in ws:
+        if msg.type != aiohttp.WSMsgType.BINARY:
+            logger.warning("Ignoring unexpected websocket message type %s", msg.type)
+            continue
+
+        RECEIVED_BYTES_METRIC.inc(len(msg.data))
+
+        try:
+            ((activity, data),) = iter_binary_batch(msg.data)
+        except ValueError:
+            logger.exception("Received invalid activity via websocket")
+            await ws.close(
+                code=aiohttp.WSCloseCode.UNSUPPORTED_DATA,
+                message=b"Invalid activity",
+            )
+            break
+
+        usr = await submit(request.app[AIOHTTP_CLIENTSESSION], activity, data)
+        await ws.send_bytes(encode_upstream_submission_response(usr))
+
+        if not is_tolerable_activity_submission_status_code(usr.status):
+            # Closing the connection ensures no further activities are
+            # processed, the batch sender will send them again.
+            await ws.close(message=b"Activity submission failed")
             break
 
-    return aiohttp.web.json_response(
-        text=UpstreamSubmissionResponse.schema().dumps(responses, many=True),
-    )
+
+async def process_websocket_session(
+    request: aiohttp.web.Request,
+    ws: aiohttp.web.WebSocketResponse,
+    session_id: str,
+) -> None:
+    session = get_batch_session(request.app[BATCH_SESSIONS_APP_KEY], session_id)
+    # The batch sender only reconnects after giving up on its previous
+    # connection, activities still buffered there are sent again over this one.
+    sequence = session.resumed_at + 1
+    resume_session(session, sequence)
+
+    session.requests += 1
+    try:
+        async with session.condition:
+            # Another connection may have arrived while waiting
+            if sequence == session.resumed_at:
+                task = await run_session_task(
+                    session,
+                    process_websocket_activities(request, ws),
+                )
+                if not task.cancelled():
+                    task.result()
+                    return
+
+            await ws.close(message=b"Superseded by a newer connection")
+    finally:
+        session.requests -= 1
+
+
+async def websocket_handler(
+    request: aiohttp.web.Request,
+) -> aiohttp.web.StreamResponse:
+    check_access(request)
+
+    ws = aiohttp.web.WebSocketResponse(heartbeat=WEBSOCKET_HEARTBEAT)
+    await ws.prepare(request)
+
+    logger.info("Accepted websocket connection from %s", request.remote)
+
+    # Connections of a session are processed one after the other
+    session_id = request.headers.get(BATCH_SESSION_HEADER)
+    if session_id is None:
+        await process_websocket_activities(request, ws)
+    else:
+        await process_websocket_session(request, ws, session_id)
+
+    logger.info("Websocket connection from %s closed", request.remote)
+
+    return ws
+
+
+async def close_upstream_session(app: aiohttp.web.Application) -> None:
+    await app[AIOHTTP_CLIENTSESSION].close()
 
 
 async def init() -> aiohttp.web.Application:
     setup_logging()
 
-    app = aiohttp.web.Application(
-        # set body size limit to 20MB to allow processing large batches
-        client_max_size=20 * (1024**2),
+    if (
+        BATCH_RECEIVER_ORDERING_KEY != "none"
+        and BATCH_RECEIVER_ORDERING_KEY not in ACTIVITY_ORDERING_KEYS
+    ):
+        logger.error(
+            "Unsupported BATCH_RECEIVER_ORDERING_KEY %r",
+            BATCH_RECEIVER_ORDERING_KEY,
+        )
+        sys.exit(1)
+
+    # Batches are streamed, BATCH_RECEIVER_MAX_BATCH_SIZE is checked while
+    # receiving them instead of using client_max_size.
+    app = aiohttp.web.Application()
+    app[AIOHTTP_CLIENTSESSION] = create_upstream_session()
+    app.on_cleanup.append(close_upstream_session)
+    app[BATCH_DECOMPRESSOR_APP_KEY] = BatchDecompressor(
+        max_size=BATCH_RECEIVER_MAX_BATCH_SIZE,
+        zstd_dictionary=(
+            load_zstd_dictionary(HTTP_BATCH_ZSTD_DICTIONARY)
+            if HTTP_BATCH_ZSTD_DICTIONARY is not None
+            else None
+        ),
     )
-    app[AIOHTTP_CLIENTSESSION] = aiohttp.ClientSession()
+    app[BATCH_SESSIONS_APP_KEY] = OrderedDict()
 
     # just handle all paths in the same handler
     app.add_routes(
-        [aiohttp.web.post(BATCH_RECEIVER_PATH, handler)],
+        [
+            aiohttp.web.post(BATCH_RECEIVER_PATH, handler),
+            aiohttp.web.get(BATCH_RECEIVER_PATH, websocket_handler),
+            aiohttp.web.get("/metrics", metrics_handler),
+        ],
     )
 
     if HTTP_TRUSTED_PROXIES is not None:
@@ -177,7 +889,7 @@ async def init() -> aiohttp.web.Application:
         )
 
     if HTTP_ALLOWED_IPS is not None:
-        app[ALLOWED_IPS_APP_KEY] = parse_trusted_ips(HTTP_ALLOWED_IPS)
+        app[ALLOWED_IPS_APP_KEY] = IPMatcher(parse_trusted_ips(HTTP_ALLOWED_IPS))
 
     return app
 
@@ -1,82 +1,243 @@
 import asyncio
 import logging
+import math
 import sys
-from datetime import UTC, datetime, timedelta
+import time
+from collections import deque
+from collections.abc import Sequence
+from dataclasses import dataclass, field
+from datetime import UTC, datetime
+from typing import TypeAlias
 from urllib.parse import urlunsplit
+from uuid import uuid4
 
-import aio_pika
 import aiohttp.client
-from aio_pika.abc import AbstractIncomingMessage
+import aiohttp.web
 from multidict import istr
+from prometheus_client import Counter, Gauge, Histogram
 
+from activitypub_federation_queue_batcher._adaptive_batch_helpers import (
+    AdaptiveBatchController,
+)
 from activitypub_federation_queue_batcher._apub_helpers import (
+    get_retry_after,
     is_tolerable_activity_submission_status_code,
 )
+from activitypub_federation_queue_batcher._batch_helpers import (
+    BATCH_CONTENT_ENCODING_HEADER,
+    BATCH_PARTITIONING_HEADER,
+    BATCH_RESUME_HEADER,
+    BATCH_SEQUENCE_HEADER,
+    BATCH_SESSION_HEADER,
+    BINARY_BATCH_CONTENT_TYPE,
+    NDJSON_CONTENT_TYPE,
+)
+from activitypub_federation_queue_batcher._compression_helpers import (
+    BatchCompressor,
+    load_zstd_dictionary,
+)
+from activitypub_federation_queue_batcher._dedup_helpers import (
+    ActivityDeduplicator,
+    create_activity_deduplicator,
+    get_activity_key,
+)
 from activitypub_federation_queue_batcher._logging_helpers import setup_logging
-from activitypub_federation_queue_batcher._rmq_helpers import (
-    bootstrap_rmq,
-    declare_activity_queue,
+from activitypub_federation_queue_batcher._metrics_helpers import (
+    DELAY_BUCKETS,
+    DURATION_BUCKETS,
+    SIZE_BUCKETS,
+    start_metrics_server,
+)
+from activitypub_federation_queue_batcher._queue_helpers import (
+    ActivityQueue,
+    BatchAccumulator,
+    QueueMessage,
+    get_message_lane,
+    get_queue_lane_weights,
+    get_queue_partition,
+    is_valid_queue_lanes,
+    open_activity_queue,
+)
+from activitypub_federation_queue_batcher.codec import (
+    decode_queued_activity,
+    decode_upstream_submission_response,
+    decode_upstream_submission_responses,
+    encode_binary_batch,
+    encode_json_batch,
+    is_binary_queued_activity,
 )
 from activitypub_federation_queue_batcher.constants import (
     BATCH_RECEIVER_DOMAIN,
     BATCH_RECEIVER_PATH,
     BATCH_RECEIVER_PROTOCOL,
+    BATCH_SENDER_METRICS_PORT,
+    BATCH_SENDER_PARTITIONS,
+    BATCH_TRANSPORT,
+    HTTP_BATCH_ADAPTIVE,
     HTTP_BATCH_AUTHORIZATION,
+    HTTP_BATCH_COMPRESSION,
+    HTTP_BATCH_COMPRESSION_LEVEL,
+    HTTP_BATCH_FORMAT,
     HTTP_BATCH_MAX_WAIT,
+    HTTP_BATCH_MIN_SIZE,
+    HTTP_BATCH_MIN_WAIT,
+    HTTP_BATCH_PIPELINE_DEPTH,
+    HTTP_BATCH_RETRY_DELAY,
+    HTTP_BATCH_RETRY_MAX_DELAY,
     HTTP_BATCH_SIZE,
+    HTTP_BATCH_ZSTD_DICTIONARY,
     HTTP_USER_AGENT,
+    QUEUE_LANE_NAMES,
+    QUEUE_PARTITIONS,
+    WEBSOCKET_HEARTBEAT,
+    WEBSOCKET_WINDOW_SIZE,
 )
 from activitypub_federation_queue_batcher.types import (
-    SerializableActivitySubmission,
+    ActivitySubmissionMetadata,
     UpstreamSubmissionResponse,
 )
 
 logger = logging.getLogger(__name__)
 
+BATCH_SIZE_METRIC = Histogram(
+    "batch_sender_batch_size",
+    "Activities per batch",
+    buckets=SIZE_BUCKETS,
+)
+BATCH_FILL_WAIT_METRIC = Histogram(
+    "batch_sender_batch_fill_wait_seconds",
+    "Seconds a batch waited for further activities after its first one",
+    buckets=DURATION_BUCKETS,
+)
+BATCH_DURATION_METRIC = Histogram(
+    "batch_sender_batch_duration_seconds",
+    "Seconds between sending a batch and receiving its last result",
+    buckets=DURATION_BUCKETS,
+)
+REQUEUED_ACTIVITIES_METRIC = Counter(
+    "batch_sender_requeued_activities",
+    "Activities which are sent again after a failure",
+)
+BATCH_SIZE_LIMIT_METRIC = Gauge(
+    "batch_sender_batch_size_limit",
+    "Current maximum number of activities per batch",
+    ["partition"],
+)
+BATCH_WAIT_LIMIT_METRIC = Gauge(
+    "batch_sender_batch_wait_limit_seconds",
+    "Current maximum time a batch waits for further activities",
+    ["partition"],
+)
+ROUND_TRIP_METRIC = Gauge(
+    "batch_sender_round_trip_seconds",
+    "Estimated round-trip time to batch-receiver, if adaptive",
+    ["partition"],
+)
+PROCESSING_TIME_METRIC = Gauge(
+    "batch_sender_activity_processing_seconds",
+    "Estimated time upstream takes per activity, if adaptive",
+    ["partition"],
+)
+ACTIVITY_LATENCY_METRIC = Histogram(
+    "batch_sender_activity_latency_seconds",
+    "Seconds from receiving an activity until it was submitted, by lane",
+    ["lane"],
+    buckets=DELAY_BUCKETS,
+)
+SENT_BYTES_METRIC = Counter(
+    "batch_sender_sent_bytes",
+    "Bytes of sent batches and websocket messages, after compression",
+)
+DEDUPLICATION_METRIC = Counter(
+    "batch_sender_deduplication",
+    "Activities by whether they have been sent before, if deduplicating",
+    ["result"],
+)
 
-async def get_rmq_messages(
-    queue: aio_pika.abc.AbstractQueue,
-    limit: int,
-    timeout: float,  # noqa: ASYNC109
-) -> list[AbstractIncomingMessage]:
-    max_wait_until = None
 
-    messages: list[AbstractIncomingMessage] = []
-    while len(messages) == 0 or (
-        len(messages) < limit
-        and max_wait_until is not None
-        and datetime.now(UTC) < max_wait_until
-    ):
-        consume_timeout = (
-            None
-            if max_wait_until is None
-            else (max_wait_until - datetime.now(UTC)).total_seconds()
+@dataclass
+class InFlightBatch:
+    sequence: int
+    # Monotonic time at which the batch was sent
+    sent_at: float
+    messages: list[QueueMessage]
+    activities: list[ActivitySubmissionMetadata]
+    # Bodies of the activities as received by inbox-receiver
+    bodies: list[bytes]
+    # Deduplication keys of the activities, empty unless deduplicating
+    keys: list[bytes]
+    # Filled by the request task as responses arrive, None marks the end
+    responses: asyncio.Queue[UpstreamSubmissionResponse | None]
+
+
+@dataclass
+class RetryState:
+    # Unacknowledged messages of failed batches in queue order, they're kept
+    # until they can be sent again instead of returning them to the queue.
+    messages: list[QueueMessage] = field(default_factory=list)
+    # Number of consecutive failed attempts
+    attempt: int = 0
+    # Longest delay requested by upstream through Retry-After headers
+    retry_after: float | None = None
+
+    def get_delay(self) -> float:
+        delay = min(
+            HTTP_BATCH_RETRY_DELAY * 2.0 ** (self.attempt - 1),
+            HTTP_BATCH_RETRY_MAX_DELAY,
         )
 
-        # We want to get up to `limit` messages instead of just taking as many as we
-        # can get from the server.
-        # See also https://github.com/mosquito/aio-pika/issues/131
-        msg = await queue.get(fail=False, timeout=consume_timeout)
-
-        if msg is None:
-            if len(messages) > 0:
-                return messages
-
-            await asyncio.sleep(0.1)
-            continue
+        if self.retry_after is not None:
+            delay = max(delay, min(self.retry_after, HTTP_BATCH_RETRY_MAX_DELAY))
+
+        return delay
+
+
+async def decode_messages(
+    messages: list[QueueMessage],
+    deduplicator: ActivityDeduplicator | None,
+) -> tuple[
+    list[QueueMessage],
+    list[ActivitySubmissionMetadata],
+    list[bytes],
+    list[bytes],
+]:
+    """
+    Decode queued activities, dropping those which have been sent before.
+
+    Returns the remaining messages, their activities, bodies and deduplication
+    keys. Duplicates are acknowledged right away.
+    """
+    remaining: list[QueueMessage] = []
+    activities: list[ActivitySubmissionMetadata] = []
+    bodies: list[bytes] = []
+    keys: list[bytes] = []
+
+    for msg in messages:
+        activity, body = decode_queued_activity(msg.body)
+
+        if deduplicator is not None:
+            key = get_activity_key(activity.activity_id, body)
+            if deduplicator.is_duplicate(key):
+                logger.info("Dropping duplicate activity %s", activity.activity_id)
+                await msg.ack()
+                continue
 
-        messages.append(msg)
+            deduplicator.add(key)
+            keys.append(key)
 
-        if max_wait_until is None and len(messages) > 0 and limit > 1:
-            max_wait_until = datetime.now(UTC) + timedelta(seconds=timeout)
+        remaining.append(msg)
+        activities.append(activity)
+        bodies.append(body)
 
-    return messages
+    return remaining, activities, bodies, keys
 
 
 def get_batch_request_headers() -> dict[istr, str]:
     headers = {
         aiohttp.hdrs.USER_AGENT: HTTP_USER_AGENT,
-        aiohttp.hdrs.CONTENT_TYPE: "application/json",
+        aiohttp.hdrs.ACCEPT: f"{NDJSON_CONTENT_TYPE}, application/json",
+        # Results are matched to activities by their index if present
+        BATCH_PARTITIONING_HEADER: "1",
     }
 
     if HTTP_BATCH_AUTHORIZATION is not None:
@@ -85,19 +246,18 @@ def get_batch_request_headers() -> dict[istr, str]:
     return headers
 
 
-async def requeue_messages(messages: list[AbstractIncomingMessage]) -> None:
-    # This ensures that all messages we previously started processing are
-    # returned to the queue
-    await messages[-1].nack(multiple=True, requeue=True)
-
-    # TODO: Figure out how we can ensure ordered queue if we have buffered
-    #  messages when requeueing nack'ed messages
-    sys.exit(1)
+def observe_latency(
+    message: QueueMessage,
+    activity: ActivitySubmissionMetadata,
+) -> None:
+    ACTIVITY_LATENCY_METRIC.labels(
+        QUEUE_LANE_NAMES[get_message_lane(message)],
+    ).observe((datetime.now(UTC) - activity.time).total_seconds())
 
 
 def is_acceptable_batch_entry(
     index: int,
-    activity: SerializableActivitySubmission,
+    activity: ActivitySubmissionMetadata,
     response: UpstreamSubmissionResponse,
 ) -> bool:
     if activity.activity_id != response.activity_id:
@@ -123,13 +283,284 @@ def is_acceptable_batch_entry(
     return True
 
 
+def get_binary_batch_record(
+    msg: QueueMessage,
+    activity: ActivitySubmissionMetadata,
+    body: bytes,
+) -> bytes:
+    # Queued messages are already binary batch records, unless they have been
+    # queued by an older inbox-receiver.
+    if is_binary_queued_activity(msg.body):
+        return msg.body
+
+    return encode_binary_batch([(activity, body)])
+
+
+@dataclass
+class BatchEncoder:
+    binary: bool
+    compressor: BatchCompressor | None = None
+
+    def encode(self, batch: InFlightBatch) -> tuple[dict[istr, str], bytes]:
+        if self.binary:
+            content_type = BINARY_BATCH_CONTENT_TYPE
+            body = b"".join(
+                get_binary_batch_record(msg, activity, data)
+                for msg, activity, data in zip(
+                    batch.messages,
+                    batch.activities,
+                    batch.bodies,
+                    strict=True,
+                )
+            )
+        else:
+            content_type = "application/json"
+            body = encode_json_batch(zip(batch.activities, batch.bodies, strict=True))
+
+        headers = {aiohttp.hdrs.CONTENT_TYPE: content_type}
+
+        if self.compressor is not None:
+            uncompressed_size = len(body)
+            body = self.compressor.compress(body)
+            headers[BATCH_CONTENT_ENCODING_HEADER] = self.compressor.encoding
+            logger.debug(
+                "Compressed batch %s from %s to %s bytes",
+                batch.sequence,
+                uncompressed_size,
+                len(body),
+            )
+
+        return headers, body
+
+
+async def post_batch(
+    cs: aiohttp.ClientSession,
+    url: str,
+    headers: dict[istr, str],
+    batch: InFlightBatch,
+    encoder: BatchEncoder,
+) -> aiohttp.ClientResponse:
+    batch_headers, body = encoder.encode(batch)
+    SENT_BYTES_METRIC.inc(len(body))
+    resp = await cs.post(url, headers={**headers, **batch_headers}, data=body)
+
+    if (
+        resp.status == aiohttp.web.HTTPUnsupportedMediaType.status_code
+        and batch_headers[aiohttp.hdrs.CONTENT_TYPE] == BINARY_BATCH_CONTENT_TYPE
+    ):
+        resp.release()
+        logger.warning(
+            "Batch receiver does not support binary batches, falling back to JSON",
+        )
+        encoder.binary = False
+        return await post_batch(cs, url, headers, batch, encoder)
+
+    return resp
+
+
+async def send_batch(
+    cs: aiohttp.ClientSession,
+    url: str,
+    headers: dict[istr, str],
+    batch: InFlightBatch,
+    encoder: BatchEncoder,
+) -> None:
+    responses = batch.responses
+    start = time.perf_counter()
+
+    try:
+        async with await post_batch(cs, url, headers, batch, encoder) as resp:
+            resp.raise_for_status()
+
+            if resp.content_type == NDJSON_CONTENT_TYPE:
+                # Lines are split manually as StreamReader.readline() limits
+                # the line length, while upstream response bodies may be large.
+                buf = b""
+                async for chunk in resp.content.iter_any():
+                    buf += chunk
+                    *lines, buf = buf.split(b"\n")
+                    for line in lines:
+                        responses.put_nowait(
+                            decode_upstream_submission_response(line),
+                        )
+
+                # The last result may not be followed by a newline
+                if len(buf.strip()) > 0:
+                    try:
+                        responses.put_nowait(decode_upstream_submission_response(buf))
+                    except (ValueError, KeyError, TypeError):
+                        logger.warning(
+                            "Ignoring incomplete result at the end of batch %s",
+                            batch.sequence,
+                        )
+            else:
+                for usr in decode_upstream_submission_responses(await resp.read()):
+                    responses.put_nowait(usr)
+
+        BATCH_DURATION_METRIC.observe(time.perf_counter() - start)
+    except (aiohttp.ClientError, TimeoutError) as e:
+        # Activities without a result are sent again later
+        logger.warning("Failed to send batch %s: %r", batch.sequence, e)
+    finally:
+        responses.put_nowait(None)
+
+
+def defer_failed_messages(
+    batch: InFlightBatch,
+    acked: list[bool],
+    retry: RetryState,
+    deduplicator: ActivityDeduplicator | None,
+) -> None:
+    retry.messages.extend(
+        msg for msg, ok in zip(batch.messages, acked, strict=True) if not ok
+    )
+
+    # Failed activities are sent again and must not count as duplicates
+    if deduplicator is not None:
+        for key, ok in zip(batch.keys, acked, strict=True):
+            if not ok:
+                deduplicator.discard(key)
+
+
+async def ack_batches(
+    in_flight: asyncio.Queue[InFlightBatch],
+    slots: asyncio.Semaphore,
+    retry: RetryState,
+    accumulator: BatchAccumulator,
+    controller: AdaptiveBatchController | None,
+    deduplicator: ActivityDeduplicator | None,
+) -> None:
+    loop = asyncio.get_running_loop()
+
+    # Batches are taken from the queue in the order they have been sent in,
+    # which ensures that messages are acknowledged in queue order.
+    while True:
+        batch = await in_flight.get()
+        messages = batch.messages
+
+        acked = [False] * len(messages)
+        responses_received = 0
+        failed = False
+        first_result_after = last_result_after = 0.0
+        async with asyncio.TaskGroup() as tg:
+            # Messages are acknowledged as soon as their response arrives
+            while (response := await batch.responses.get()) is not None:
+                last_result_after = loop.time() - batch.sent_at
+                if responses_received == 0:
+                    first_result_after = last_result_after
+
+                # Results of partitioned batches arrive in the order they
+                # complete in and carry the index of their activity.
+                index = (
+                    response.index if response.index is not None else responses_received
+                )
+                responses_received += 1
+
+                if (
+                    # Unpartitioned batches end at their first failure
+                    not (failed and response.index is None)
+                    and 0 <= index < len(messages)
+                    and not acked[index]
+                    and is_acceptable_batch_entry(
+                        index,
+                        batch.activities[index],
+                        response,
+                    )
+                ):
+                    tg.create_task(messages[index].ack())
+                    acked[index] = True
+                    observe_latency(messages[index], batch.activities[index])
+                    continue
+
+                failed = True
+
+                retry_after = get_retry_after(response.headers, datetime.now(UTC))
+                if retry_after is not None:
+                    retry.retry_after = max(retry.retry_after or 0, retry_after)
+
+        # Batches following a failed one are skipped by batch-receiver
+        if responses_received > len(messages) or (
+            not failed
+            and len(retry.messages) == 0
+            and responses_received < len(messages)
+        ):
+            logger.warning(
+                "Batch response count does not match message count: %s != %s",
+                responses_received,
+                len(messages),
+            )
+
+        if all(acked):
+            retry.attempt = 0
+
+            if controller is not None:
+                controller.record_completed(
+                    len(messages),
+                    first_result_after,
+                    last_result_after,
+                )
+        else:
+            defer_failed_messages(batch, acked, retry, deduplicator)
+            # Stop collecting the next batch, failed messages need to go first
+            accumulator.interrupt()
+
+        logger.info(
+            "Finished batch %s of %s messages, %s acknowledged",
+            batch.sequence,
+            len(messages),
+            sum(acked),
+        )
+        slots.release()
+        in_flight.task_done()
+
+
+def get_sender_partitions() -> list[int]:
+    if BATCH_SENDER_PARTITIONS is None:
+        return list(range(QUEUE_PARTITIONS))
+
+    try:
+        partitions = sorted(
+            {int(partition) for partition in BATCH_SENDER_PARTITIONS.split(",")},
+        )
+    except ValueError:
+        partitions = []
+
+    if len(partitions) == 0 or not all(
+        0 <= partition < QUEUE_PARTITIONS for partition in partitions
+    ):
+        logger.error(
+            "BATCH_SENDER_PARTITIONS must be a comma separated list of"
+            " partitions below QUEUE_PARTITIONS (%s)",
+            QUEUE_PARTITIONS,
+        )
+        sys.exit(1)
+
+    return partitions
+
+
+async def run_forwarders(
+    queue: ActivityQueue,
+    url: str,
+    headers: dict[istr, str],
+    deduplicator: ActivityDeduplicator | None,
+    partitions: Sequence[int],
+) -> None:
+    """Forward each partition independently, with its own batch-receiver session."""
+    forwarder = (
+        websocket_forwarder if BATCH_TRANSPORT == "websocket" else http_forwarder
+    )
+    async with asyncio.TaskGroup() as tg:
+        for partition in partitions:
+            tg.create_task(
+                forwarder(queue, url, headers, deduplicator, partition=partition),
+            )
+
+
 async def forwarder() -> None:
     if BATCH_RECEIVER_DOMAIN is None or len(BATCH_RECEIVER_DOMAIN) == 0:
         logger.error("BATCH_RECEIVER_DOMAIN must be set")
         sys.exit(1)
 
-    rmq = await bootstrap_rmq()
-
     url = urlunsplit(
         (
             BATCH_RECEIVER_PROTOCOL,
@@ -140,78 +571,368 @@ async def forwarder() -> None:
         ),
     )
 
+    if not is_valid_queue_lanes():
+        logger.error("Invalid QUEUE_LANES or QUEUE_LANE_WEIGHTS")
+        sys.exit(1)
+
     headers = get_batch_request_headers()
+    partitions = get_sender_partitions()
 
-    async with rmq.channel() as channel, aiohttp.ClientSession() as cs:
-        await channel.set_qos(prefetch_count=HTTP_BATCH_SIZE)
-        queue = await declare_activity_queue(channel)
+    if BATCH_SENDER_METRICS_PORT is not None:
+        await start_metrics_server(BATCH_SENDER_METRICS_PORT)
 
-        while True:
-            messages = await get_rmq_messages(
-                queue,
-                HTTP_BATCH_SIZE,
-                HTTP_BATCH_MAX_WAIT,
-            )
+    queue = await open_activity_queue()
+    deduplicator = create_activity_deduplicator(DEDUPLICATION_METRIC)
 
-            if len(messages) == 0:
-                logger.warning("Ended up with zero messages, how??")
-                continue
+    try:
+        await run_forwarders(queue, url, headers, deduplicator, partitions)
+    finally:
+        await queue.close()
 
-            logger.info("Processing batch of %s messages", len(messages))
 
-            activities: list[SerializableActivitySubmission] = []
+WebsocketPending: TypeAlias = deque[
+    tuple[QueueMessage, ActivitySubmissionMetadata, bytes]
+]
 
-            for msg in messages:
-                activity: SerializableActivitySubmission = (
-                    # TODO: Figure out if this type check is fixable
-                    SerializableActivitySubmission.schema().loads(  # type: ignore[assignment]
-                        msg.body.decode(),
+
+async def ack_websocket_results(
+    ws: aiohttp.ClientWebSocketResponse,
+    pending: WebsocketPending,
+    retry: RetryState,
+) -> None:
+    index = 0
+    async for ws_msg in ws:
+        if ws_msg.type != aiohttp.WSMsgType.BINARY:
+            logger.warning("Ignoring unexpected websocket message type %s", ws_msg.type)
+            continue
+
+        if len(pending) == 0:
+            logger.error("Received result without pending activity")
+            break
+
+        msg, activity, _ = pending[0]
+        response = decode_upstream_submission_response(ws_msg.data)
+        if not is_acceptable_batch_entry(index, activity, response):
+            retry.retry_after = get_retry_after(response.headers, datetime.now(UTC))
+            break
+
+        pending.popleft()
+        await msg.ack()
+        observe_latency(msg, activity)
+        retry.attempt = 0
+        index += 1
+
+
+async def send_websocket_activities(
+    ws: aiohttp.ClientWebSocketResponse,
+    pending: WebsocketPending,
+    accumulator: BatchAccumulator,
+    deduplicator: ActivityDeduplicator | None,
+) -> None:
+    while not ws.closed:
+        # Activities are sent as soon as they arrive
+        messages, activities, bodies, _ = await decode_messages(
+            await accumulator.get_batch(WEBSOCKET_WINDOW_SIZE, 0),
+            deduplicator,
+        )
+
+        # Activities are pending before sending them, so that none of them get
+        # lost if the connection closes meanwhile.
+        entries = list(zip(messages, activities, bodies, strict=True))
+        pending.extend(entries)
+        try:
+            for msg, activity, body in entries:
+                logger.info("Sending activity %s", activity.activity_id)
+
+                data = get_binary_batch_record(msg, activity, body)
+                SENT_BYTES_METRIC.inc(len(data))
+                await ws.send_bytes(data)
+        except (aiohttp.ClientError, ConnectionError) as e:
+            logger.warning("Failed to send activity: %r", e)
+            return
+
+
+async def forward_websocket(
+    ws: aiohttp.ClientWebSocketResponse,
+    pending: WebsocketPending,
+    retry: RetryState,
+    accumulator: BatchAccumulator,
+    deduplicator: ActivityDeduplicator | None,
+) -> None:
+    """Forward activities over a websocket connection until it closes."""
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(
+            send_websocket_activities(ws, pending, accumulator, deduplicator),
+        )
+        await ack_websocket_results(ws, pending, retry)
+
+        await ws.close()
+        # Stops waiting for further activities to send
+        accumulator.interrupt()
+
+
+def defer_pending_activities(
+    pending: WebsocketPending,
+    retry: RetryState,
+    deduplicator: ActivityDeduplicator | None,
+) -> None:
+    retry.messages.extend(msg for msg, _, _ in pending)
+
+    # Pending activities are sent again and must not count as duplicates
+    if deduplicator is not None:
+        for _, activity, body in pending:
+            deduplicator.discard(get_activity_key(activity.activity_id, body))
+
+
+async def websocket_forwarder(
+    queue: ActivityQueue,
+    url: str,
+    headers: dict[istr, str],
+    deduplicator: ActivityDeduplicator | None = None,
+    *,
+    partition: int = 0,
+) -> None:
+    retry = RetryState()
+
+    # The queue doesn't deliver further messages until earlier ones are
+    # acknowledged, which limits how many activities of each lane are in
+    # flight.
+    accumulator = BatchAccumulator(get_queue_lane_weights())
+    for lane in range(len(QUEUE_LANE_NAMES)):
+        await queue.consume(
+            accumulator.lane_callback(lane),
+            prefetch_count=WEBSOCKET_WINDOW_SIZE,
+            partition=get_queue_partition(lane, partition),
+        )
+
+    # batch-receiver stops processing activities of earlier connections of the
+    # same session once a new connection arrives.
+    headers = {**headers, BATCH_SESSION_HEADER: uuid4().hex}
+
+    async with aiohttp.ClientSession() as cs:
+        while True:
+            # Activities which have been sent but have no result yet, in queue
+            # order
+            pending: WebsocketPending = deque()
+
+            try:
+                async with cs.ws_connect(
+                    url,
+                    headers=headers,
+                    heartbeat=WEBSOCKET_HEARTBEAT,
+                    # permessage-deflate is the only compression supported here
+                    compress=15 if HTTP_BATCH_COMPRESSION != "none" else 0,
+                ) as ws:
+                    await forward_websocket(
+                        ws,
+                        pending,
+                        retry,
+                        accumulator,
+                        deduplicator,
                     )
-                )
-                logger.info("Including activity %s in batch", activity.activity_id)
-                activities.append(activity)
+            except (aiohttp.ClientError, TimeoutError) as e:
+                logger.warning("Websocket connection failed: %r", e)
+
+            logger.warning(
+                "Websocket connection closed with %s activities pending",
+                len(pending),
+            )
+            defer_pending_activities(pending, retry, deduplicator)
+            await prepare_retry(retry, accumulator)
+
+
+async def prepare_retry(retry: RetryState, accumulator: BatchAccumulator) -> None:
+    retry.attempt += 1
+    delay = retry.get_delay()
+    logger.warning(
+        "Sending %s failed messages again in %.1f seconds, attempt %s",
+        len(retry.messages),
+        delay,
+        retry.attempt,
+    )
+    await asyncio.sleep(delay)
+
+    REQUEUED_ACTIVITIES_METRIC.inc(len(retry.messages))
+    accumulator.requeue(retry.messages)
+    retry.messages = []
+    retry.retry_after = None
+
+
+def create_batch_controller(partition: int) -> AdaptiveBatchController | None:
+    """Create the adaptive batch controller of a partition, if enabled."""
+    controller = (
+        AdaptiveBatchController(
+            min_size=min(HTTP_BATCH_MIN_SIZE, HTTP_BATCH_SIZE),
+            max_size=HTTP_BATCH_SIZE,
+            min_wait=min(HTTP_BATCH_MIN_WAIT, HTTP_BATCH_MAX_WAIT),
+            max_wait=HTTP_BATCH_MAX_WAIT,
+            pipeline_depth=HTTP_BATCH_PIPELINE_DEPTH,
+        )
+        if HTTP_BATCH_ADAPTIVE
+        else None
+    )
+    label = str(partition)
+    if controller is not None:
+        BATCH_SIZE_LIMIT_METRIC.labels(label).set_function(lambda: controller.size)
+        BATCH_WAIT_LIMIT_METRIC.labels(label).set_function(lambda: controller.wait)
+        # Estimates are exposed as NaN until the first successful batch
+        ROUND_TRIP_METRIC.labels(label).set_function(
+            lambda: controller.rtt if controller.rtt is not None else math.nan,
+        )
+        PROCESSING_TIME_METRIC.labels(label).set_function(
+            lambda: (
+                controller.processing_time
+                if controller.processing_time is not None
+                else math.nan
+            ),
+        )
+    else:
+        BATCH_SIZE_LIMIT_METRIC.labels(label).set(HTTP_BATCH_SIZE)
+        BATCH_WAIT_LIMIT_METRIC.labels(label).set(HTTP_BATCH_MAX_WAIT)
+        ROUND_TRIP_METRIC.labels(label).set(math.nan)
+        PROCESSING_TIME_METRIC.labels(label).set(math.nan)
+
+    return controller
+
+
+async def http_forwarder(
+    queue: ActivityQueue,
+    url: str,
+    headers: dict[istr, str],
+    deduplicator: ActivityDeduplicator | None = None,
+    *,
+    partition: int = 0,
+) -> None:
+    encoder = BatchEncoder(
+        binary=HTTP_BATCH_FORMAT == "binary",
+        compressor=(
+            BatchCompressor(
+                encoding=HTTP_BATCH_COMPRESSION,
+                level=HTTP_BATCH_COMPRESSION_LEVEL,
+                zstd_dictionary=(
+                    load_zstd_dictionary(HTTP_BATCH_ZSTD_DICTIONARY)
+                    if HTTP_BATCH_ZSTD_DICTIONARY is not None
+                    else None
+                ),
+            )
+            if HTTP_BATCH_COMPRESSION != "none"
+            else None
+        ),
+    )
+    in_flight: asyncio.Queue[InFlightBatch] = asyncio.Queue()
+    slots = asyncio.Semaphore(HTTP_BATCH_PIPELINE_DEPTH)
+    retry = RetryState()
+    loop = asyncio.get_running_loop()
+
+    controller = create_batch_controller(partition)
 
-            body = (
-                SerializableActivitySubmission.schema()
-                .dumps(activities, many=True)
-                .encode()
+    async with (
+        aiohttp.ClientSession() as cs,
+        asyncio.TaskGroup() as tg,
+    ):
+        # Each lane buffers up to a full pipeline, so that the lanes don't
+        # have to wait for each other's messages.
+        accumulator = BatchAccumulator(get_queue_lane_weights())
+        for lane in range(len(QUEUE_LANE_NAMES)):
+            await queue.consume(
+                accumulator.lane_callback(lane),
+                prefetch_count=HTTP_BATCH_SIZE * HTTP_BATCH_PIPELINE_DEPTH,
+                partition=get_queue_partition(lane, partition),
             )
 
-            async with cs.post(url, headers=headers, data=body) as resp:
-                resp.raise_for_status()
-                t = await resp.text()
+        tg.create_task(
+            ack_batches(
+                in_flight,
+                slots,
+                retry,
+                accumulator,
+                controller,
+                deduplicator,
+            ),
+        )
+
+        # A new session ensures that the batch receiver doesn't wait for
+        # batches of a previous run which will never arrive.
+        session = uuid4().hex
+        sequence = 0
+        resume = False
+        while True:
+            await slots.acquire()
+
+            if len(retry.messages) > 0:
+                slots.release()
+                # batch-receiver skips batches of a session after one of them
+                # failed, so messages of all batches still in flight need to
+                # be sent again as well.
+                await in_flight.join()
+                await prepare_retry(retry, accumulator)
+                # batch-receiver stops any earlier batches which it is still
+                # processing before continuing the session with this batch.
+                resume = True
+                continue
 
-            responses: list[UpstreamSubmissionResponse] = (
-                UpstreamSubmissionResponse.schema().loads(t, many=True)
+            messages = await accumulator.get_batch(
+                controller.size if controller is not None else HTTP_BATCH_SIZE,
+                controller.wait if controller is not None else HTTP_BATCH_MAX_WAIT,
             )
 
-            if len(responses) != len(messages):
-                logger.warning(
-                    "Batch response count does not match message count: %s != %s",
-                    len(responses),
+            if len(messages) == 0 or len(retry.messages) > 0:
+                # A batch failed while this one was being collected
+                accumulator.requeue(messages)
+                slots.release()
+                continue
+
+            BATCH_FILL_WAIT_METRIC.observe(accumulator.fill_time)
+            if controller is not None:
+                controller.record_collected(
                     len(messages),
+                    accumulator.buffered,
+                    loop.time(),
                 )
 
-            activities_ok = 0
-            async with asyncio.TaskGroup() as tg:
-                for i in range(len(messages)):
-                    try:
-                        if not is_acceptable_batch_entry(
-                            i,
-                            activities[i],
-                            responses[i],
-                        ):
-                            break
-
-                        tg.create_task(messages[i].ack())
-                        activities_ok += 1
-                    except IndexError:
-                        break
-
-            if activities_ok < len(messages):
-                await requeue_messages(messages[activities_ok:])
-
-            logger.info("Finished batch of %s messages", len(messages))
+            batch_messages, activities, bodies, keys = await decode_messages(
+                messages,
+                deduplicator,
+            )
+            if len(batch_messages) == 0:
+                slots.release()
+                continue
+
+            BATCH_SIZE_METRIC.observe(len(batch_messages))
+            logger.info(
+                "Processing batch %s of %s messages",
+                sequence,
+                len(batch_messages),
+            )
+            for activity in activities:
+                logger.info("Including activity %s in batch", activity.activity_id)
+
+            batch = InFlightBatch(
+                sequence=sequence,
+                sent_at=loop.time(),
+                messages=batch_messages,
+                activities=activities,
+                bodies=bodies,
+                keys=keys,
+                responses=asyncio.Queue(),
+            )
+            tg.create_task(
+                send_batch(
+                    cs,
+                    url,
+                    {
+                        **headers,
+                        BATCH_SESSION_HEADER: session,
+                        BATCH_SEQUENCE_HEADER: str(sequence),
+                        **({BATCH_RESUME_HEADER: "1"} if resume else {}),
+                    },
+                    batch,
+                    encoder,
+                ),
+            )
+            in_flight.put_nowait(batch)
+            sequence += 1
+            resume = False
 
 
 async def main() -> None:
@@ -0,0 +1,395 @@
+"""Wire formats for activity submissions and upstream responses.
+
+The JSON format is compatible with what dataclasses-json produced for the types
+in `activitypub_federation_queue_batcher.types`, but encoding and decoding works
+on plain dicts without building a marshmallow schema for every call.
+Unknown keys are ignored when decoding.
+
+The binary batch format avoids base64 encoding activity bodies. It consists of
+one record per activity, each made up of the length of the JSON encoded
+metadata and the length of the body as unsigned 32 bit big endian integers,
+followed by the metadata and the raw body.
+
+Both batch formats can also be parsed incrementally while a batch is being
+received, yielding each activity as soon as it is complete.
+
+Queued activities are stored as a single binary batch record, so the body is
+queued as received and can be sent in binary batches without decoding it.
+Activities queued as JSON encoded activity submissions can still be decoded.
+"""
+
+import codecs
+import json
+import re
+import struct
+import sys
+from base64 import b64decode, b64encode
+from collections.abc import Iterable, Iterator
+from datetime import datetime
+from typing import Any
+
+from activitypub_federation_queue_batcher.types import (
+    ActivitySubmissionMetadata,
+    SerializableActivitySubmission,
+    UpstreamSubmissionResponse,
+)
+
+_encoder = json.JSONEncoder(separators=(",", ":"))
+_decoder = json.JSONDecoder()
+
+BINARY_BATCH_RECORD_PREFIX = struct.Struct(">II")
+
+_NON_WHITESPACE = re.compile(r"[^ \t\n\r]")
+
+
+class TruncatedBinaryBatchError(ValueError):
+    def __init__(self) -> None:
+        super().__init__("Truncated binary batch record")
+
+
+class TruncatedJSONBatchError(ValueError):
+    def __init__(self) -> None:
+        super().__init__("Truncated JSON batch")
+
+
+class UnexpectedJSONBatchCharacterError(ValueError):
+    def __init__(self, char: str) -> None:
+        super().__init__(f"Unexpected {char!r} in JSON batch")
+
+
+class InvalidBatchActivityError(ValueError):
+    def __init__(self) -> None:
+        super().__init__("Batch entry is not a valid activity submission")
+
+
+def _encode(obj: Any) -> bytes:  # noqa: ANN401
+    return _encoder.encode(obj).encode()
+
+
+def _decode(data: bytes | str) -> Any:  # noqa: ANN401
+    return _decoder.decode(data if isinstance(data, str) else data.decode())
+
+
+def _intern_header_names(headers: list[list[str]]) -> list[list[str]]:
+    # Batches repeat the same few header names for every activity
+    return [[sys.intern(name), value] for name, value in headers]
+
+
+def _activity_submission_metadata_to_dict(
+    activity: ActivitySubmissionMetadata,
+) -> dict[str, Any]:
+    return {
+        "time": activity.time.isoformat(),
+        "activity_id": activity.activity_id,
+        "host": activity.host,
+        "path": activity.path,
+        "headers": activity.headers,
+    }
+
+
+def _activity_submission_metadata_from_dict(
+    d: dict[str, Any],
+) -> ActivitySubmissionMetadata:
+    return ActivitySubmissionMetadata(
+        time=datetime.fromisoformat(d["time"]),
+        activity_id=d["activity_id"],
+        host=d["host"],
+        path=d["path"],
+        headers=_intern_header_names(d["headers"]),
+    )
+
+
+def _batch_activity_from_dict(d: Any) -> ActivitySubmissionMetadata:  # noqa: ANN401
+    # Batches are parsed while submitting their activities, where anything but
+    # a ValueError would abort the request instead of ending the batch early.
+    try:
+        return _activity_submission_metadata_from_dict(d)
+    except (KeyError, TypeError) as e:
+        raise InvalidBatchActivityError from e
+
+
+def _activity_submission_from_dict(
+    d: dict[str, Any],
+) -> SerializableActivitySubmission:
+    return SerializableActivitySubmission(
+        time=datetime.fromisoformat(d["time"]),
+        activity_id=d["activity_id"],
+        host=d["host"],
+        path=d["path"],
+        headers=_intern_header_names(d["headers"]),
+        b64_body=d["b64_body"],
+    )
+
+
+def _upstream_submission_response_to_dict(
+    usr: UpstreamSubmissionResponse,
+) -> dict[str, Any]:
+    d: dict[str, Any] = {
+        "time": usr.time.isoformat(),
+        "activity_id": usr.activity_id,
+        "status": usr.status,
+        "headers": usr.headers,
+        "content_type": usr.content_type,
+        "body": usr.body,
+    }
+
+    if usr.index is not None:
+        d["index"] = usr.index
+
+    return d
+
+
+def _upstream_submission_response_from_dict(
+    d: dict[str, Any],
+) -> UpstreamSubmissionResponse:
+    return UpstreamSubmissionResponse(
+        time=datetime.fromisoformat(d["time"]),
+        activity_id=d["activity_id"],
+        status=d["status"],
+        headers=d["headers"],
+        content_type=d.get("content_type"),
+        body=d.get("body"),
+        index=d.get("index"),
+    )
+
+
+def decode_activity_submission(data: bytes | str) -> SerializableActivitySubmission:
+    return _activity_submission_from_dict(_decode(data))
+
+
+def encode_activity_submission_metadata(
+    activity: ActivitySubmissionMetadata,
+) -> bytes:
+    return _encode(_activity_submission_metadata_to_dict(activity))
+
+
+def encode_binary_batch(
+    activities: Iterable[tuple[ActivitySubmissionMetadata, bytes]],
+) -> bytes:
+    chunks: list[bytes] = []
+
+    for activity, body in activities:
+        metadata = encode_activity_submission_metadata(activity)
+        chunks.append(BINARY_BATCH_RECORD_PREFIX.pack(len(metadata), len(body)))
+        chunks.append(metadata)
+        chunks.append(body)
+
+    return b"".join(chunks)
+
+
+def encode_json_batch(
+    activities: Iterable[tuple[ActivitySubmissionMetadata, bytes]],
+) -> bytes:
+    """Encode activities as a JSON batch, which base64 encodes their bodies."""
+    encoded = []
+    for activity, body in activities:
+        d = _activity_submission_metadata_to_dict(activity)
+        d["b64_body"] = b64encode(body).decode()
+        encoded.append(d)
+
+    return _encode(encoded)
+
+
+def _parse_binary_batch_record(
+    view: memoryview,
+    offset: int,
+) -> tuple[tuple[ActivitySubmissionMetadata, bytes], int] | None:
+    """Parse the record at `offset`, returning it with its end offset.
+
+    Returns None if the record isn't complete.
+    """
+    if offset + BINARY_BATCH_RECORD_PREFIX.size > len(view):
+        return None
+
+    metadata_length, body_length = BINARY_BATCH_RECORD_PREFIX.unpack_from(
+        view,
+        offset,
+    )
+    offset += BINARY_BATCH_RECORD_PREFIX.size
+
+    body_offset = offset + metadata_length
+    end = body_offset + body_length
+    if end > len(view):
+        return None
+
+    return (
+        _batch_activity_from_dict(_decode(bytes(view[offset:body_offset]))),
+        bytes(view[body_offset:end]),
+    ), end
+
+
+def iter_binary_batch(
+    data: bytes,
+) -> Iterator[tuple[ActivitySubmissionMetadata, bytes]]:
+    view = memoryview(data)
+    offset = 0
+
+    while offset < len(view):
+        record = _parse_binary_batch_record(view, offset)
+        if record is None:
+            raise TruncatedBinaryBatchError
+
+        activity, offset = record
+        yield activity
+
+
+def encode_queued_activity(activity: ActivitySubmissionMetadata, body: bytes) -> bytes:
+    return encode_binary_batch([(activity, body)])
+
+
+def is_binary_queued_activity(data: bytes) -> bool:
+    """Check whether a queued activity is a binary batch record."""
+    # Metadata lengths below 16MiB start with a zero byte, unlike JSON
+    return data[:1] != b"{"
+
+
+def decode_queued_activity(data: bytes) -> tuple[ActivitySubmissionMetadata, bytes]:
+    if not is_binary_queued_activity(data):
+        activity = decode_activity_submission(data)
+        return activity, b64decode(activity.b64_body)
+
+    record = _parse_binary_batch_record(memoryview(data), 0)
+    if record is None or record[1] != len(data):
+        raise TruncatedBinaryBatchError
+
+    return record[0]
+
+
+class BinaryBatchParser:
+    """Parses a binary batch incrementally, see `iter_binary_batch`."""
+
+    def __init__(self) -> None:
+        self._buffer = bytearray()
+
+    def feed(self, data: bytes) -> list[tuple[ActivitySubmissionMetadata, bytes]]:
+        """Add received data, returning all activities completed by it."""
+        self._buffer += data
+        activities = []
+        offset = 0
+
+        with memoryview(self._buffer) as view:
+            while (record := _parse_binary_batch_record(view, offset)) is not None:
+                activity, offset = record
+                activities.append(activity)
+
+        del self._buffer[:offset]
+        return activities
+
+    def close(self) -> None:
+        """Check that the batch didn't end within a record."""
+        if len(self._buffer) > 0:
+            raise TruncatedBinaryBatchError
+
+
+class JSONBatchParser:
+    """
+    Parses a JSON batch of activity submissions incrementally.
+
+    Activities are decoded as soon as their element of the array is complete,
+    including their base64 encoded body, so that only the element currently
+    being received is buffered.
+    """
+
+    def __init__(self) -> None:
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        # Offset in the buffer up to which the current element was incomplete
+        self._resume = 0
+        # Expected next: "[", an element or "]" ("first"), "," or "]" ("next"),
+        # an element after "," ("element") or nothing at all ("end")
+        self._state = "start"
+
+    def _parse_element(
+        self,
+        pos: int,
+    ) -> tuple[tuple[ActivitySubmissionMetadata, bytes], int] | None:
+        # Elements are objects, which can only be complete once another
+        # closing brace has been received.
+        if self._buffer.find("}", max(pos, self._resume)) == -1:
+            return None
+
+        try:
+            d, end = _decoder.raw_decode(self._buffer, pos)
+        except json.JSONDecodeError:
+            # Invalid elements are only reported by close()
+            self._resume = len(self._buffer)
+            return None
+
+        if not isinstance(d, dict) or not isinstance(d.get("b64_body"), str):
+            raise InvalidBatchActivityError
+
+        self._resume = 0
+        activity = _batch_activity_from_dict(d)
+        return (activity, b64decode(d["b64_body"])), end
+
+    def feed(self, data: bytes) -> list[tuple[ActivitySubmissionMetadata, bytes]]:
+        """Add received data, returning all activities completed by it."""
+        self._buffer += self._text_decoder.decode(data)
+        activities = []
+        pos = 0
+
+        while (match := _NON_WHITESPACE.search(self._buffer, pos)) is not None:
+            pos = match.start()
+            char = self._buffer[pos]
+
+            if self._state == "end":
+                raise UnexpectedJSONBatchCharacterError(char)
+
+            if self._state == "start":
+                if char != "[":
+                    raise UnexpectedJSONBatchCharacterError(char)
+                self._state = "first"
+                pos += 1
+            elif self._state in {"first", "next"} and char == "]":
+                self._state = "end"
+                pos += 1
+            elif self._state == "next":
+                if char != ",":
+                    raise UnexpectedJSONBatchCharacterError(char)
+                self._state = "element"
+                pos += 1
+            elif (element := self._parse_element(pos)) is not None:
+                activity, pos = element
+                activities.append(activity)
+                self._state = "next"
+            else:
+                break
+
+        # Only the incomplete element is kept
+        self._buffer = self._buffer[pos:]
+        self._resume = max(0, self._resume - pos)
+        return activities
+
+    def close(self) -> None:
+        """Check that the batch is complete."""
+        self._buffer += self._text_decoder.decode(b"", final=True)
+
+        if self._state in {"first", "element"} and self._buffer.strip() != "":
+            # Raises the actual error if the element is invalid
+            _decoder.raw_decode(self._buffer.lstrip())
+            raise InvalidBatchActivityError
+
+        if self._state != "end":
+            raise TruncatedJSONBatchError
+
+
+def encode_upstream_submission_response(usr: UpstreamSubmissionResponse) -> bytes:
+    return _encode(_upstream_submission_response_to_dict(usr))
+
+
+def decode_upstream_submission_response(
+    data: bytes | str,
+) -> UpstreamSubmissionResponse:
+    return _upstream_submission_response_from_dict(_decode(data))
+
+
+def encode_upstream_submission_responses(
+    usrs: Iterable[UpstreamSubmissionResponse],
+) -> bytes:
+    return _encode([_upstream_submission_response_to_dict(usr) for usr in usrs])
+
+
+def decode_upstream_submission_responses(
+    data: bytes | str,
+) -> list[UpstreamSubmissionResponse]:
+    return [_upstream_submission_response_from_dict(d) for d in _decode(data)]
@@ -3,6 +3,9 @@ import os
 BATCH_RECEIVER_PROTOCOL = os.environ.get("BATCH_RECEIVER_PROTOCOL", "https")
 BATCH_RECEIVER_DOMAIN = os.environ.get("BATCH_RECEIVER_DOMAIN")
 BATCH_RECEIVER_PATH = os.environ.get("BATCH_RECEIVER_PATH", "/batch")
+# Either "http" for sending batches as individual requests or "websocket" for
+# continuously streaming activities over a long-lived connection.
+BATCH_TRANSPORT = os.environ.get("BATCH_TRANSPORT", "http").lower()
 
 HTTP_BATCH_AUTHORIZATION = os.environ.get("HTTP_BATCH_AUTHORIZATION")
 if (
@@ -16,18 +19,173 @@ if (
 HTTP_ALLOWED_IPS = os.environ.get("HTTP_ALLOWED_IPS")
 HTTP_BATCH_MAX_WAIT = int(os.environ.get("HTTP_BATCH_MAX_WAIT", "3"))
 HTTP_BATCH_SIZE = int(os.environ.get("HTTP_BATCH_SIZE", "100"))
+# Number of batches the batch sender keeps in flight at the same time.
+# 1 waits for each batch to be fully processed before sending the next one.
+HTTP_BATCH_PIPELINE_DEPTH = max(
+    1,
+    int(os.environ.get("HTTP_BATCH_PIPELINE_DEPTH", "1")),
+)
+# Adjust the batch size between HTTP_BATCH_MIN_SIZE and HTTP_BATCH_SIZE and the
+# wait time between HTTP_BATCH_MIN_WAIT and HTTP_BATCH_MAX_WAIT based on the
+# measured round-trip time and upstream processing time.
+HTTP_BATCH_ADAPTIVE = os.environ.get("HTTP_BATCH_ADAPTIVE", "false").lower() in {
+    "1",
+    "true",
+    "yes",
+}
+HTTP_BATCH_MIN_SIZE = max(1, int(os.environ.get("HTTP_BATCH_MIN_SIZE", "1")))
+HTTP_BATCH_MIN_WAIT = float(os.environ.get("HTTP_BATCH_MIN_WAIT", "0"))
+# Delay before sending failed activities again, doubled for every consecutive
+# failure up to the maximum delay or longer if upstream asks for it.
+HTTP_BATCH_RETRY_DELAY = float(os.environ.get("HTTP_BATCH_RETRY_DELAY", "1"))
+HTTP_BATCH_RETRY_MAX_DELAY = float(
+    os.environ.get("HTTP_BATCH_RETRY_MAX_DELAY", "300"),
+)
+# Either "json" or "binary", binary batches avoid base64 encoding activities.
+# batch-sender falls back to json if the batch-receiver doesn't support it.
+HTTP_BATCH_FORMAT = os.environ.get("HTTP_BATCH_FORMAT", "json").lower()
+# Either "none", "gzip", "br" or "zstd", zstd requires the zstd extra.
+HTTP_BATCH_COMPRESSION = os.environ.get("HTTP_BATCH_COMPRESSION", "none").lower()
+HTTP_BATCH_COMPRESSION_LEVEL = (
+    int(os.environ["HTTP_BATCH_COMPRESSION_LEVEL"])
+    if "HTTP_BATCH_COMPRESSION_LEVEL" in os.environ
+    else None
+)
+# Path to a zstd dictionary, this must be the same for batch-sender and
+# batch-receiver.
+HTTP_BATCH_ZSTD_DICTIONARY = os.environ.get("HTTP_BATCH_ZSTD_DICTIONARY")
 HTTP_TRUSTED_PROXIES = os.environ.get("HTTP_TRUSTED_PROXIES")
+# Maximum number of activities sent via websocket without a result yet
+WEBSOCKET_WINDOW_SIZE = int(os.environ.get("WEBSOCKET_WINDOW_SIZE", HTTP_BATCH_SIZE))
+WEBSOCKET_HEARTBEAT = float(os.environ.get("WEBSOCKET_HEARTBEAT", "30"))
+# Port for serving /metrics from batch-sender, which isn't served unless set
+BATCH_SENDER_METRICS_PORT = (
+    int(os.environ["BATCH_SENDER_METRICS_PORT"])
+    if "BATCH_SENDER_METRICS_PORT" in os.environ
+    else None
+)
 HTTP_USER_AGENT = os.environ.get(
     "HTTP_USER_AGENT",
     "ActivityPub-Federation-Queue-Batcher (+https://github.com/Nothing4You/activitypub-federation-queue-batcher)",
 )
 
+BATCH_RECEIVER_SEQUENCE_TIMEOUT = float(
+    os.environ.get("BATCH_RECEIVER_SEQUENCE_TIMEOUT", "300"),
+)
+BATCH_RECEIVER_MAX_SESSIONS = int(os.environ.get("BATCH_RECEIVER_MAX_SESSIONS", "64"))
+# Upper limit for batches, after decompression
+BATCH_RECEIVER_MAX_BATCH_SIZE = int(
+    os.environ.get("BATCH_RECEIVER_MAX_BATCH_SIZE", str(20 * (1024**2))),
+)
+# Activities of a batch are split into partitions by this key, which are
+# submitted concurrently while keeping the order within each partition.
+# Either "none", "actor", "object" or "community".
+BATCH_RECEIVER_ORDERING_KEY = os.environ.get(
+    "BATCH_RECEIVER_ORDERING_KEY",
+    "none",
+).lower()
+# Maximum number of activities from different partitions of a batch being
+# submitted at the same time
+BATCH_RECEIVER_PARTITION_CONCURRENCY = max(
+    1,
+    int(os.environ.get("BATCH_RECEIVER_PARTITION_CONCURRENCY", "8")),
+)
+# Compress batch responses which aren't streamed if supported by batch-sender
+BATCH_RECEIVER_RESPONSE_COMPRESSION = os.environ.get(
+    "BATCH_RECEIVER_RESPONSE_COMPRESSION",
+    "false",
+).lower() in {"1", "true", "yes"}
+
+# Connection pool limits for submitting activities upstream, 0 means unlimited
+BATCH_RECEIVER_UPSTREAM_CONNECTIONS = int(
+    os.environ.get("BATCH_RECEIVER_UPSTREAM_CONNECTIONS", "100"),
+)
+BATCH_RECEIVER_UPSTREAM_CONNECTIONS_PER_HOST = int(
+    os.environ.get("BATCH_RECEIVER_UPSTREAM_CONNECTIONS_PER_HOST", "0"),
+)
+# Seconds idle upstream connections are kept open for reuse
+BATCH_RECEIVER_UPSTREAM_KEEPALIVE_TIMEOUT = float(
+    os.environ.get("BATCH_RECEIVER_UPSTREAM_KEEPALIVE_TIMEOUT", "15"),
+)
+BATCH_RECEIVER_UPSTREAM_CONNECT_TIMEOUT = float(
+    os.environ.get("BATCH_RECEIVER_UPSTREAM_CONNECT_TIMEOUT", "10"),
+)
+# Maximum seconds without receiving any data from upstream
+BATCH_RECEIVER_UPSTREAM_READ_TIMEOUT = float(
+    os.environ.get("BATCH_RECEIVER_UPSTREAM_READ_TIMEOUT", "60"),
+)
+# Seconds upstream host name lookups are cached for, 0 disables the cache
+BATCH_RECEIVER_UPSTREAM_DNS_CACHE_TTL = int(
+    os.environ.get("BATCH_RECEIVER_UPSTREAM_DNS_CACHE_TTL", "10"),
+)
+# Connect to upstream via this unix socket instead of TCP, e.g. for a
+# co-located reverse proxy. OVERRIDE_DESTINATION_PROTOCOL still applies.
+BATCH_RECEIVER_UPSTREAM_UNIX_SOCKET = os.environ.get(
+    "BATCH_RECEIVER_UPSTREAM_UNIX_SOCKET",
+)
+
 OVERRIDE_DESTINATION_PROTOCOL = os.environ.get("OVERRIDE_DESTINATION_PROTOCOL", "https")
 OVERRIDE_DESTINATION_DOMAIN = os.environ.get("OVERRIDE_DESTINATION_DOMAIN")
 
 INBOX_RECEIVER_MESSAGE_QUEUE_LIMIT = int(
     os.environ.get("INBOX_RECEIVER_MESSAGE_QUEUE_LIMIT", HTTP_BATCH_SIZE * 2),
 )
+# Number of channels used for publishing activities concurrently
+INBOX_RECEIVER_PUBLISH_CHANNELS = max(
+    1,
+    int(os.environ.get("INBOX_RECEIVER_PUBLISH_CHANNELS", "4")),
+)
+# Maximum number of activities published together on a single channel
+INBOX_RECEIVER_PUBLISH_BATCH_SIZE = max(
+    1,
+    int(os.environ.get("INBOX_RECEIVER_PUBLISH_BATCH_SIZE", "100")),
+)
+# Port for serving /metrics from inbox-receiver, which isn't served unless set
+INBOX_RECEIVER_METRICS_PORT = (
+    int(os.environ["INBOX_RECEIVER_METRICS_PORT"])
+    if "INBOX_RECEIVER_METRICS_PORT" in os.environ
+    else None
+)
+# Number of inbox-receiver processes sharing the listening port via
+# SO_REUSEPORT, each with its own broker connection.
+INBOX_RECEIVER_WORKERS = max(1, int(os.environ.get("INBOX_RECEIVER_WORKERS", "1")))
+# Directory for spooling activities to disk while RabbitMQ is unavailable,
+# spooling is disabled if this is not set.
+INBOX_RECEIVER_SPOOL_DIR = os.environ.get("INBOX_RECEIVER_SPOOL_DIR")
+INBOX_RECEIVER_SPOOL_SEGMENT_SIZE = int(
+    os.environ.get("INBOX_RECEIVER_SPOOL_SEGMENT_SIZE", str(64 * (1024**2))),
+)
+# Seconds to wait for RabbitMQ to confirm an activity before spooling it
+INBOX_RECEIVER_SPOOL_PUBLISH_TIMEOUT = float(
+    os.environ.get("INBOX_RECEIVER_SPOOL_PUBLISH_TIMEOUT", "1"),
+)
+# Either "all" or "signature", which only queues the headers needed for
+# verifying HTTP signatures. Hop-by-hop headers are never queued.
+INBOX_RECEIVER_HEADER_POLICY = os.environ.get(
+    "INBOX_RECEIVER_HEADER_POLICY",
+    "all",
+).lower()
+# Seconds between refreshing the queue depth used for INBOX_RECEIVER_MESSAGE_QUEUE_LIMIT
+INBOX_RECEIVER_QUEUE_DEPTH_INTERVAL = float(
+    os.environ.get("INBOX_RECEIVER_QUEUE_DEPTH_INTERVAL", "1"),
+)
+
+# Either "rabbitmq" or "sqlite", which stores the queue in a local database
+# file that inbox-receiver and batch-sender both need access to.
+QUEUE_BACKEND = os.environ.get("QUEUE_BACKEND", "rabbitmq").lower()
+QUEUE_SQLITE_PATH = os.environ.get("QUEUE_SQLITE_PATH", "activities.sqlite3")
+# How often batch-sender checks whether another process changed the queue
+QUEUE_SQLITE_POLL_INTERVAL = float(
+    os.environ.get("QUEUE_SQLITE_POLL_INTERVAL", "0.1"),
+)
+
+# Seconds inbox-receiver and batch-sender remember activities for dropping
+# duplicate deliveries with the same id and body, 0 disables deduplication.
+ACTIVITY_DEDUPLICATION_TTL = float(os.environ.get("ACTIVITY_DEDUPLICATION_TTL", "0"))
+# Maximum number of remembered activities, about 200 bytes each
+ACTIVITY_DEDUPLICATION_MAX_ENTRIES = int(
+    os.environ.get("ACTIVITY_DEDUPLICATION_MAX_ENTRIES", "100000"),
+)
 
 RABBITMQ_HOSTNAME = os.environ.get("RABBITMQ_HOSTNAME", "localhost")
 RABBITMQ_CHANNEL_ROUTING_KEY = os.environ.get(
@@ -35,6 +193,49 @@ RABBITMQ_CHANNEL_ROUTING_KEY = os.environ.get(
     "apub-queue",
 )
 
+# Number of queues activities are distributed across by QUEUE_PARTITION_KEY,
+# batch-sender sends the activities of each of them in order on its own.
+# Changing it while activities are queued breaks their order.
+QUEUE_PARTITIONS = max(1, int(os.environ.get("QUEUE_PARTITIONS", "1")))
+# Either "actor", "object" or "community" like BATCH_RECEIVER_ORDERING_KEY
+QUEUE_PARTITION_KEY = os.environ.get("QUEUE_PARTITION_KEY", "actor").lower()
+# Additional lanes with their own queues as "name=Type,Type;name=Type",
+# activities of any other type use the "default" lane.
+QUEUE_LANES = {
+    name.strip(): frozenset(t.strip() for t in types.split(",") if t.strip())
+    for name, _, types in (
+        lane.partition("=")
+        for lane in os.environ.get("QUEUE_LANES", "").split(";")
+        if lane.strip()
+    )
+}
+QUEUE_LANE_NAMES = ["default", *QUEUE_LANES]
+# Share of each lane in batches as "name=weight,name=weight", 1 by default
+QUEUE_LANE_WEIGHTS = {
+    name.strip(): float(weight)
+    for name, _, weight in (
+        lane.partition("=")
+        for lane in os.environ.get("QUEUE_LANE_WEIGHTS", "").split(",")
+        if lane.strip()
+    )
+}
+# Queues of all partitions of each lane. The first partition of the default lane
+# keeps using the queue of setups without either, so that activities queued
+# before adding partitions or lanes are still sent.
+QUEUE_NAMES = [
+    ".".join(
+        [
+            RABBITMQ_CHANNEL_ROUTING_KEY,
+            *([lane] if lane != "default" else []),
+            *([str(i)] if i else []),
+        ],
+    )
+    for lane in QUEUE_LANE_NAMES
+    for i in range(QUEUE_PARTITIONS)
+]
+# Comma separated partitions consumed by this batch-sender, all by default
+BATCH_SENDER_PARTITIONS = os.environ.get("BATCH_SENDER_PARTITIONS")
+
 # https://www.w3.org/TR/activitypub/#server-to-server-interactions
 VALID_ACTIVITY_CONTENT_TYPES = {
     "application/ld+json",
@@ -1,43 +1,333 @@
+import asyncio
 import json
 import logging
-from base64 import b64encode
+import math
+import sqlite3
+import sys
+from collections import defaultdict
+from collections.abc import AsyncIterator
 from datetime import UTC, datetime
+from functools import partial
+from pathlib import Path
 
 import aio_pika
 import aiohttp.web
 import aiohttp_remotes
+from prometheus_client import Counter, Gauge
 
 from activitypub_federation_queue_batcher._aiohttp_helpers import (
     ALLOWED_IPS_APP_KEY,
+    IPMatcher,
     is_allowed_ip,
     parse_trusted_ips,
 )
+from activitypub_federation_queue_batcher._apub_helpers import (
+    ACTIVITY_ORDERING_KEYS,
+)
+from activitypub_federation_queue_batcher._dedup_helpers import (
+    ActivityDeduplicator,
+    create_activity_deduplicator,
+    get_activity_key,
+)
+from activitypub_federation_queue_batcher._header_helpers import (
+    HEADER_POLICIES,
+    compact_headers,
+)
 from activitypub_federation_queue_batcher._logging_helpers import setup_logging
-from activitypub_federation_queue_batcher._rmq_helpers import (
-    bootstrap_rmq,
-    declare_activity_queue,
+from activitypub_federation_queue_batcher._metrics_helpers import (
+    METRICS_MULTIPROC_DIR_ENV,
+    clear_multiprocess_metrics,
+    get_metrics_multiproc_dir,
+    start_metrics_server,
+)
+from activitypub_federation_queue_batcher._queue_helpers import (
+    ActivityQueue,
+    get_activity_partition,
+    is_valid_queue_lanes,
+    open_activity_queue,
+)
+from activitypub_federation_queue_batcher._spool_helpers import ActivitySpool
+from activitypub_federation_queue_batcher._worker_helpers import (
+    WorkerContext,
+    run_workers,
+)
+from activitypub_federation_queue_batcher.codec import (
+    decode_queued_activity,
+    encode_queued_activity,
 )
 from activitypub_federation_queue_batcher.constants import (
     HTTP_ALLOWED_IPS,
     HTTP_TRUSTED_PROXIES,
+    INBOX_RECEIVER_HEADER_POLICY,
     INBOX_RECEIVER_MESSAGE_QUEUE_LIMIT,
-    RABBITMQ_CHANNEL_ROUTING_KEY,
+    INBOX_RECEIVER_METRICS_PORT,
+    INBOX_RECEIVER_PUBLISH_BATCH_SIZE,
+    INBOX_RECEIVER_QUEUE_DEPTH_INTERVAL,
+    INBOX_RECEIVER_SPOOL_DIR,
+    INBOX_RECEIVER_SPOOL_PUBLISH_TIMEOUT,
+    INBOX_RECEIVER_SPOOL_SEGMENT_SIZE,
+    INBOX_RECEIVER_WORKERS,
+    QUEUE_PARTITION_KEY,
     VALID_ACTIVITY_CONTENT_TYPES,
 )
-from activitypub_federation_queue_batcher.types import SerializableActivitySubmission
+from activitypub_federation_queue_batcher.types import ActivitySubmissionMetadata
 
 logger = logging.getLogger(__name__)
 
 
-RABBITMQ_CONNECTION_APP_KEY: aiohttp.web.AppKey[
-    aio_pika.abc.AbstractRobustConnection
-] = aiohttp.web.AppKey(
-    "RABBITMQ_CONNECTION_APP_KEY",
-    aio_pika.abc.AbstractRobustConnection,
+ACTIVITY_QUEUE_APP_KEY: aiohttp.web.AppKey[ActivityQueue] = aiohttp.web.AppKey(
+    "ACTIVITY_QUEUE_APP_KEY",
+    ActivityQueue,
 )
 
 
-async def handler(request: aiohttp.web.Request) -> aiohttp.web.Response:
+class QueueDepth:
+    """
+    Last known number of queued messages, None until the first refresh.
+
+    Workers share the queue depth, so that activities queued by any of them
+    count towards the limit until the next refresh.
+    """
+
+    def __init__(self, worker: WorkerContext | None = None) -> None:
+        self._shared = worker.queue_depth if worker is not None else None
+        self._message_count: int | None = None
+
+    @property
+    def message_count(self) -> int | None:
+        if self._shared is None:
+            return self._message_count
+
+        value = self._shared.value
+        return value if value >= 0 else None
+
+    @message_count.setter
+    def message_count(self, message_count: int | None) -> None:
+        if self._shared is None:
+            self._message_count = message_count
+        else:
+            self._shared.value = message_count if message_count is not None else -1
+
+    def increment(self) -> None:
+        if self._shared is None:
+            if self._message_count is not None:
+                self._message_count += 1
+            return
+
+        with self._shared.get_lock():
+            if self._shared.value >= 0:
+                self._shared.value += 1
+
+
+QUEUE_DEPTH_APP_KEY = aiohttp.web.AppKey("QUEUE_DEPTH_APP_KEY", QueueDepth)
+
+WORKER_APP_KEY = aiohttp.web.AppKey("WORKER_APP_KEY", WorkerContext)
+
+ACTIVITY_SPOOL_APP_KEY = aiohttp.web.AppKey("ACTIVITY_SPOOL_APP_KEY", ActivitySpool)
+
+ACTIVITY_DEDUPLICATOR_APP_KEY = aiohttp.web.AppKey(
+    "ACTIVITY_DEDUPLICATOR_APP_KEY",
+    ActivityDeduplicator,
+)
+
+QUEUE_DEPTH_METRIC = Gauge(
+    "inbox_receiver_queue_depth",
+    "Last known number of queued activities",
+    # Workers refresh the same queue depth
+    multiprocess_mode="mostrecent",
+)
+QUEUED_ACTIVITIES_METRIC = Counter(
+    "inbox_receiver_queued_activities",
+    "Accepted activities by where they were stored",
+    ["destination"],
+)
+REJECTED_ACTIVITIES_METRIC = Counter(
+    "inbox_receiver_rejected_activities",
+    "Activities which were not accepted",
+    ["reason"],
+)
+RECEIVED_BYTES_METRIC = Counter(
+    "inbox_receiver_received_bytes",
+    "Bytes of received activity bodies",
+)
+DEDUPLICATION_METRIC = Counter(
+    "inbox_receiver_deduplication",
+    "Activities by whether they have been received before, if deduplicating",
+    ["result"],
+)
+
+# Errors after which activities are spooled instead of failing the request
+PUBLISH_ERRORS = (
+    aio_pika.exceptions.AMQPError,
+    sqlite3.Error,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+def update_queue_depth(depth: QueueDepth, message_count: int | None) -> None:
+    depth.message_count = message_count
+    QUEUE_DEPTH_METRIC.set(message_count if message_count is not None else math.nan)
+
+
+async def refresh_queue_depth(queue: ActivityQueue, depth: QueueDepth) -> None:
+    while True:
+        try:
+            message_count = await queue.get_message_count()
+        except (aio_pika.exceptions.AMQPError, sqlite3.Error, ConnectionError):
+            # The robust connection takes care of reconnecting, until then
+            # the last known queue depth is used.
+            logger.exception("Failed to refresh queue depth")
+        else:
+            update_queue_depth(depth, message_count)
+
+        await asyncio.sleep(INBOX_RECEIVER_QUEUE_DEPTH_INTERVAL)
+
+
+async def activity_queue_ctx(app: aiohttp.web.Application) -> AsyncIterator[None]:
+    queue = app[ACTIVITY_QUEUE_APP_KEY]
+
+    depth = app[QUEUE_DEPTH_APP_KEY] = QueueDepth(app.get(WORKER_APP_KEY))
+    update_queue_depth(depth, await queue.get_message_count())
+    task = asyncio.create_task(refresh_queue_depth(queue, depth))
+
+    yield
+
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+    await queue.close()
+
+
+def get_submission_partition(data: bytes) -> int:
+    _, body = decode_queued_activity(data)
+    try:
+        activity = json.loads(body)
+    except ValueError:
+        return 0
+    return get_activity_partition(activity)
+
+
+async def publish_spooled(queue: ActivityQueue, bodies: list[bytes]) -> None:
+    """Publish spooled activities, keeping their order within each partition."""
+    partitions: defaultdict[int, list[bytes]] = defaultdict(list)
+    for body in bodies:
+        partitions[get_submission_partition(body)].append(body)
+
+    await asyncio.gather(
+        *(
+            queue.publish(partition_bodies, partition)
+            for partition, partition_bodies in partitions.items()
+        ),
+    )
+
+
+async def replay_spool(spool: ActivitySpool, queue: ActivityQueue) -> None:
+    while True:
+        await spool.wait()
+
+        try:
+            # Each chunk is queued in order
+            await spool.replay(
+                partial(publish_spooled, queue),
+                INBOX_RECEIVER_PUBLISH_BATCH_SIZE,
+            )
+        except PUBLISH_ERRORS:
+            logger.exception("Failed to replay spooled activities")
+            await asyncio.sleep(INBOX_RECEIVER_SPOOL_PUBLISH_TIMEOUT)
+
+
+def find_orphaned_spool_segments(
+    spool_root: Path,
+    worker: WorkerContext | None,
+) -> list[Path]:
+    """
+    Find segments in spool directories which no current process writes to.
+
+    These are left behind after changing the number of workers, they're
+    adopted by the first worker or the only process.
+    """
+    if worker is not None and worker.index != 0:
+        return []
+
+    directories = [spool_root] if worker is not None else []
+    for directory in sorted(spool_root.glob("worker-*")):
+        index = directory.name.removeprefix("worker-")
+        if worker is None or not index.isdecimal() or int(index) >= worker.count:
+            directories.append(directory)
+
+    return [
+        segment
+        for directory in directories
+        for segment in sorted(directory.glob("*.spool"))
+    ]
+
+
+async def spool_ctx(app: aiohttp.web.Application) -> AsyncIterator[None]:
+    if INBOX_RECEIVER_SPOOL_DIR is None:
+        yield
+        return
+
+    spool_root = spool_dir = Path(INBOX_RECEIVER_SPOOL_DIR)
+    # Spool segments can only be written by a single process
+    worker = app.get(WORKER_APP_KEY)
+    if worker is not None:
+        spool_dir /= f"worker-{worker.index}"
+
+    spool = app[ACTIVITY_SPOOL_APP_KEY] = ActivitySpool(
+        spool_dir,
+        INBOX_RECEIVER_SPOOL_SEGMENT_SIZE,
+        find_orphaned_spool_segments(spool_root, worker),
+    )
+
+    tasks = [
+        asyncio.create_task(spool.run()),
+        asyncio.create_task(replay_spool(spool, app[ACTIVITY_QUEUE_APP_KEY])),
+    ]
+
+    yield
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    spool.close()
+
+
+async def queue_activity(
+    app: aiohttp.web.Application,
+    body: bytes,
+    partition: int,
+) -> None:
+    queue = app[ACTIVITY_QUEUE_APP_KEY]
+    spool = app.get(ACTIVITY_SPOOL_APP_KEY)
+
+    if spool is None:
+        # Only returns once the message is stored durably
+        await queue.publish([body], partition)
+    elif not spool.is_empty():
+        # New activities must not overtake activities which are still spooled
+        await spool.append(body)
+        QUEUED_ACTIVITIES_METRIC.labels("spool").inc()
+        return
+    else:
+        try:
+            async with asyncio.timeout(INBOX_RECEIVER_SPOOL_PUBLISH_TIMEOUT):
+                await queue.publish([body], partition)
+        except PUBLISH_ERRORS:
+            logger.warning("Failed to queue activity, spooling it", exc_info=True)
+            await spool.append(body)
+            QUEUED_ACTIVITIES_METRIC.labels("spool").inc()
+            return
+
+    QUEUED_ACTIVITIES_METRIC.labels("queue").inc()
+
+    # Account for our own messages until the next refresh, so that bursts
+    # can't overshoot the limit by much.
+    app[QUEUE_DEPTH_APP_KEY].increment()
+
+
+def check_access(request: aiohttp.web.Request) -> None:
     if ALLOWED_IPS_APP_KEY in request.app:
         if request.remote is None:
             logger.warning("Allowed IPs configured but source IP was None")
@@ -50,76 +340,138 @@ async def handler(request: aiohttp.web.Request) -> aiohttp.web.Response:
             logger.info("Allowed IPs configured but %r is not allowed", request.remote)
             raise aiohttp.web.HTTPServiceUnavailable(text="Source IP not permitted")
 
-    async with request.app[RABBITMQ_CONNECTION_APP_KEY].channel(
-        on_return_raises=True,
-    ) as channel:
-        queue = await declare_activity_queue(channel, passive=True)
 
-        if (
-            queue.declaration_result.message_count is not None
-            and queue.declaration_result.message_count
-            >= INBOX_RECEIVER_MESSAGE_QUEUE_LIMIT
-        ):
-            logger.info(
-                "RabbitMQ has %s messages queued,"
-                " deferring further requests until more buffer space is "
-                "available",
-                queue.declaration_result.message_count,
-            )
-            return aiohttp.web.HTTPServiceUnavailable()
+async def handler(request: aiohttp.web.Request) -> aiohttp.web.Response:
+    check_access(request)
 
-        if request.content_type not in VALID_ACTIVITY_CONTENT_TYPES:
-            logger.info("Received invalid content-type header %r", request.content_type)
-            return aiohttp.web.HTTPUnsupportedMediaType(
-                text="Invalid content-type header",
-            )
+    depth = request.app[QUEUE_DEPTH_APP_KEY]
+
+    # The queue depth is refreshed in the background, which avoids a broker
+    # round trip for every request.
+    if (
+        depth.message_count is not None
+        and depth.message_count >= INBOX_RECEIVER_MESSAGE_QUEUE_LIMIT
+    ):
+        logger.info(
+            "Queue has %s messages,"
+            " deferring further requests until more buffer space is "
+            "available",
+            depth.message_count,
+        )
+        REJECTED_ACTIVITIES_METRIC.labels("queue_full").inc()
+        return aiohttp.web.HTTPServiceUnavailable()
 
-        body = await request.read()
+    if request.content_type not in VALID_ACTIVITY_CONTENT_TYPES:
+        logger.info("Received invalid content-type header %r", request.content_type)
+        REJECTED_ACTIVITIES_METRIC.labels("content_type").inc()
+        return aiohttp.web.HTTPUnsupportedMediaType(
+            text="Invalid content-type header",
+        )
 
-        try:
-            j = json.loads(body)
-        except json.JSONDecodeError:
-            logger.info("Received invalid JSON body")
-            return aiohttp.web.HTTPUnsupportedMediaType(text="Body is not JSON")
-
-        if "id" not in j:
-            logger.warning("Missing activity id in JSON body")
-            return aiohttp.web.HTTPServiceUnavailable(
-                text="Missing activity id in JSON body",
-            )
+    body = await request.read()
+    RECEIVED_BYTES_METRIC.inc(len(body))
 
-        logger.info("Queueing activity %s", j["id"])
-        activity_id = j["id"]
+    try:
+        j = json.loads(body)
+    except json.JSONDecodeError:
+        logger.info("Received invalid JSON body")
+        REJECTED_ACTIVITIES_METRIC.labels("invalid_json").inc()
+        return aiohttp.web.HTTPUnsupportedMediaType(text="Body is not JSON")
 
-        serializable_request = SerializableActivitySubmission(
-            time=datetime.now(UTC),
-            activity_id=activity_id,
-            host=request.headers.getone(aiohttp.hdrs.HOST),
-            path=request.path,
-            headers=[[k, v] for k, v in request.headers.items()],
-            b64_body=b64encode(body).decode(),
+    if "id" not in j:
+        logger.warning("Missing activity id in JSON body")
+        REJECTED_ACTIVITIES_METRIC.labels("missing_id").inc()
+        return aiohttp.web.HTTPServiceUnavailable(
+            text="Missing activity id in JSON body",
         )
 
-        await channel.default_exchange.publish(
-            aio_pika.Message(
-                body=SerializableActivitySubmission.schema()
-                .dumps(serializable_request)
-                .encode(),
-                delivery_mode=aio_pika.abc.DeliveryMode.PERSISTENT,
-            ),
-            routing_key=RABBITMQ_CHANNEL_ROUTING_KEY,
-            timeout=5.0,
-        )
+    activity_id = j["id"]
+
+    deduplicator = request.app.get(ACTIVITY_DEDUPLICATOR_APP_KEY)
+    activity_key = None
+    if deduplicator is not None and isinstance(activity_id, str):
+        activity_key = get_activity_key(activity_id, body)
+        # Senders retry until they get a successful response
+        if deduplicator.is_duplicate(activity_key):
+            logger.info("Dropping duplicate activity %s", activity_id)
+            return aiohttp.web.HTTPNoContent()
+
+    logger.info("Queueing activity %s", activity_id)
+
+    # The body is queued as received, next to its metadata
+    metadata = ActivitySubmissionMetadata(
+        time=datetime.now(UTC),
+        activity_id=activity_id,
+        host=request.headers.getone(aiohttp.hdrs.HOST),
+        path=request.path,
+        headers=compact_headers(
+            request.headers.items(),
+            INBOX_RECEIVER_HEADER_POLICY,
+        ),
+    )
+
+    await queue_activity(
+        request.app,
+        encode_queued_activity(metadata, body),
+        get_activity_partition(j),
+    )
+
+    # Only activities which have been queued count as seen, so that a failed
+    # delivery can be retried.
+    if deduplicator is not None and activity_key is not None:
+        deduplicator.add(activity_key)
 
     return aiohttp.web.HTTPNoContent()
 
 
-async def init() -> aiohttp.web.Application:
+async def metrics_ctx(app: aiohttp.web.Application) -> AsyncIterator[None]:
+    if INBOX_RECEIVER_METRICS_PORT is None:
+        yield
+        return
+
+    # Workers share the port like the public one, any of them responds with
+    # the metrics of all workers.
+    runner = await start_metrics_server(
+        INBOX_RECEIVER_METRICS_PORT,
+        reuse_port=WORKER_APP_KEY in app,
+    )
+
+    yield
+
+    await runner.cleanup()
+
+
+async def init(worker: WorkerContext | None = None) -> aiohttp.web.Application:
     setup_logging()
 
+    if INBOX_RECEIVER_HEADER_POLICY not in HEADER_POLICIES:
+        logger.error(
+            "Unsupported INBOX_RECEIVER_HEADER_POLICY %r",
+            INBOX_RECEIVER_HEADER_POLICY,
+        )
+        sys.exit(1)
+
+    if QUEUE_PARTITION_KEY not in ACTIVITY_ORDERING_KEYS:
+        logger.error("Unsupported QUEUE_PARTITION_KEY %r", QUEUE_PARTITION_KEY)
+        sys.exit(1)
+
+    if not is_valid_queue_lanes():
+        logger.error("Invalid QUEUE_LANES or QUEUE_LANE_WEIGHTS")
+        sys.exit(1)
+
     app = aiohttp.web.Application()
 
-    app[RABBITMQ_CONNECTION_APP_KEY] = await bootstrap_rmq()
+    if worker is not None:
+        app[WORKER_APP_KEY] = worker
+    app.cleanup_ctx.append(metrics_ctx)
+
+    app[ACTIVITY_QUEUE_APP_KEY] = await open_activity_queue()
+
+    deduplicator = create_activity_deduplicator(DEDUPLICATION_METRIC)
+    if deduplicator is not None:
+        app[ACTIVITY_DEDUPLICATOR_APP_KEY] = deduplicator
+    app.cleanup_ctx.append(activity_queue_ctx)
+    app.cleanup_ctx.append(spool_ctx)
 
     # just handle all paths in the same handler
     app.add_routes([aiohttp.web.post("/{path:.*}", handler)])
@@ -133,10 +485,35 @@ async def init() -> aiohttp.web.Application:
         )
 
     if HTTP_ALLOWED_IPS is not None:
-        app[ALLOWED_IPS_APP_KEY] = parse_trusted_ips(HTTP_ALLOWED_IPS)
+        app[ALLOWED_IPS_APP_KEY] = IPMatcher(parse_trusted_ips(HTTP_ALLOWED_IPS))
 
     return app
 
 
-if __name__ == "__main__":
+def run_worker(worker: WorkerContext) -> None:
+    # Each worker listens on its own socket, the kernel distributes connections
+    aiohttp.web.run_app(init(worker), reuse_port=True)
+
+
+def main() -> None:
+    if INBOX_RECEIVER_WORKERS > 1:
+        setup_logging()
+
+        if (
+            INBOX_RECEIVER_METRICS_PORT is not None
+            and get_metrics_multiproc_dir() is None
+        ):
+            logger.error(
+                "%s needs to be set for metrics of multiple workers",
+                METRICS_MULTIPROC_DIR_ENV,
+            )
+            sys.exit(1)
+        clear_multiprocess_metrics()
+
+        sys.exit(run_workers(INBOX_RECEIVER_WORKERS, run_worker))
+
     aiohttp.web.run_app(init())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Train a zstd dictionary for batch compression from queued activities.
+
+This requires the zstd extra to be installed.
+Messages are only borrowed from the queue and returned afterwards, but to keep
+them in order batch-sender should be stopped while this is running.
+"""
+
+import argparse
+import asyncio
+import logging
+from pathlib import Path
+
+import zstandard
+
+from activitypub_federation_queue_batcher._logging_helpers import setup_logging
+from activitypub_federation_queue_batcher._queue_helpers import (
+    QueueMessage,
+    open_activity_queue,
+)
+from activitypub_federation_queue_batcher.codec import (
+    decode_queued_activity,
+    encode_binary_batch,
+    encode_json_batch,
+)
+from activitypub_federation_queue_batcher.constants import (
+    HTTP_BATCH_FORMAT,
+    QUEUE_NAMES,
+)
+
+logger = logging.getLogger(__name__)
+
+# Gives up waiting for further messages if none arrived for this many seconds,
+# e.g. because another consumer took them.
+SAMPLE_IDLE_TIMEOUT = 10.0
+
+
+def get_sample(msg: QueueMessage) -> bytes:
+    # Samples should look like what ends up being compressed
+    activity, body = decode_queued_activity(msg.body)
+    if HTTP_BATCH_FORMAT == "binary":
+        return encode_binary_batch([(activity, body)])
+
+    return encode_json_batch([(activity, body)])
+
+
+async def collect_samples(limit: int) -> list[bytes]:
+    queue = await open_activity_queue()
+    try:
+        count = await queue.get_message_count()
+        expected = limit if count is None else min(limit, count)
+
+        messages: list[QueueMessage] = []
+        received = asyncio.Event()
+
+        async def on_message(msg: QueueMessage) -> None:
+            if len(messages) < limit:
+                messages.append(msg)
+            received.set()
+
+        # All partitions are sampled at once until enough were delivered
+        for partition in range(len(QUEUE_NAMES)):
+            await queue.consume(on_message, limit, partition)
+
+        while len(messages) < expected:
+            received.clear()
+            try:
+                async with asyncio.timeout(SAMPLE_IDLE_TIMEOUT):
+                    await received.wait()
+            except TimeoutError:
+                logger.warning("Stopped waiting for further queued activities")
+                break
+    finally:
+        # Messages are never acknowledged, closing the queue returns them
+        await queue.close()
+
+    return [get_sample(msg) for msg in messages]
+
+
+async def main() -> None:
+    setup_logging()
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("output", type=Path, help="where to write the dictionary")
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=1000,
+        help="maximum number of queued activities to train on",
+    )
+    parser.add_argument(
+        "--dictionary-size",
+        type=int,
+        default=112640,
+        help="dictionary size in bytes",
+    )
+    args = parser.parse_args()
+
+    samples = await collect_samples(args.samples)
+    logger.info("Collected %s samples", len(samples))
+
+    dictionary = zstandard.train_dictionary(args.dictionary_size, samples)
+    args.output.write_bytes(dictionary.as_bytes())
+
+    logger.info(
+        "Wrote dictionary %s with %s bytes to %s",
+        dictionary.dict_id(),
+        len(dictionary),
+        args.output,
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
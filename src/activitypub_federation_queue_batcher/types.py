@@ -1,37 +1,29 @@
-from dataclasses import dataclass, field
+from dataclasses import dataclass
 from datetime import datetime
 
-from dataclasses_json import DataClassJsonMixin, config
-from marshmallow import fields
 
-
-@dataclass
-class SerializableActivitySubmission(DataClassJsonMixin):
-    time: datetime = field(
-        metadata=config(
-            encoder=datetime.isoformat,
-            decoder=datetime.fromisoformat,
-            mm_field=fields.DateTime(format="iso"),
-        ),
-    )
+@dataclass(slots=True)
+class ActivitySubmissionMetadata:
+    time: datetime
     activity_id: str
     host: str
     path: str
     headers: list[list[str]]
+
+
+@dataclass(slots=True)
+class SerializableActivitySubmission(ActivitySubmissionMetadata):
     b64_body: str
 
 
-@dataclass
-class UpstreamSubmissionResponse(DataClassJsonMixin):
-    time: datetime = field(
-        metadata=config(
-            encoder=datetime.isoformat,
-            decoder=datetime.fromisoformat,
-            mm_field=fields.DateTime(format="iso"),
-        ),
-    )
+@dataclass(slots=True)
+class UpstreamSubmissionResponse:
+    time: datetime
     activity_id: str
     status: int
     headers: list[list[str]]
     content_type: str | None
     body: str | None
+    # Position of the activity within its batch, only set when results of a
+    # partitioned batch are sent in the order they complete in.
+    index: int | None = None
@@ -0,0 +1,256 @@
+"""
+Behaviour shared by all activity queue backends.
+
+The RabbitMQ backend uses the broker at RABBITMQ_HOSTNAME, its tests are
+skipped if it isn't reachable.
+"""
+
+import asyncio
+from collections.abc import AsyncIterator, Iterator
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Protocol
+from uuid import uuid4
+
+import aio_pika
+import pytest
+
+from activitypub_federation_queue_batcher._queue_helpers import (
+    ActivityQueue,
+    QueueMessage,
+)
+from activitypub_federation_queue_batcher._rmq_helpers import (
+    RabbitMQActivityQueue,
+    declare_activity_queue,
+)
+from activitypub_federation_queue_batcher._sqlite_queue_helpers import (
+    SQLiteActivityQueue,
+)
+from activitypub_federation_queue_batcher.constants import RABBITMQ_HOSTNAME
+
+# Seconds to wait for messages which are expected to be delivered
+DELIVERY_TIMEOUT = 5
+# Seconds to wait for messages which are expected not to be delivered
+NO_DELIVERY_WAIT = 0.3
+
+
+class Backend(Protocol):
+    async def open(self) -> ActivityQueue: ...
+
+
+class SQLiteBackend:
+    def __init__(self, path: Path, names: list[str]) -> None:
+        self._path = path
+        self._names = names
+
+    async def open(self) -> ActivityQueue:
+        return SQLiteActivityQueue(str(self._path), self._names)
+
+
+class RabbitMQBackend:
+    def __init__(self, names: list[str]) -> None:
+        self._names = names
+
+    async def open(self) -> ActivityQueue:
+        rmq = await aio_pika.connect_robust(host=RABBITMQ_HOSTNAME)
+        async with rmq.channel() as channel:
+            for name in self._names:
+                await declare_activity_queue(channel, name=name)
+        return RabbitMQActivityQueue(rmq, self._names)
+
+    async def delete_queues(self) -> None:
+        async with (
+            await aio_pika.connect(host=RABBITMQ_HOSTNAME) as rmq,
+            rmq.channel() as channel,
+        ):
+            for name in self._names:
+                await channel.queue_delete(name)
+
+
+async def check_broker() -> None:
+    async with asyncio.timeout(DELIVERY_TIMEOUT):
+        rmq = await aio_pika.connect(host=RABBITMQ_HOSTNAME)
+    await rmq.close()
+
+
+@pytest.fixture(params=["sqlite", "rabbitmq"])
+def backend(request: pytest.FixtureRequest, tmp_path: Path) -> Iterator[Backend]:
+    # Two partitions with names of their own, so tests don't share queues
+    names = [f"test-activities-{uuid4().hex}-{i}" for i in range(2)]
+
+    if request.param == "sqlite":
+        yield SQLiteBackend(tmp_path / "queue.sqlite3", names)
+        return
+
+    try:
+        asyncio.run(check_broker())
+    except (OSError, TimeoutError):
+        pytest.skip(f"RabbitMQ is not available at {RABBITMQ_HOSTNAME}")
+
+    rabbitmq = RabbitMQBackend(names)
+    yield rabbitmq
+    asyncio.run(rabbitmq.delete_queues())
+
+
+@asynccontextmanager
+async def open_queue(backend: Backend) -> AsyncIterator[ActivityQueue]:
+    queue = await backend.open()
+    try:
+        yield queue
+    finally:
+        await queue.close()
+
+
+class Collector:
+    """Consumer callback which keeps the delivered messages."""
+
+    def __init__(self) -> None:
+        self.messages: list[QueueMessage] = []
+        self._changed = asyncio.Event()
+
+    async def __call__(self, message: QueueMessage) -> None:
+        self.messages.append(message)
+        self._changed.set()
+
+    @property
+    def bodies(self) -> list[bytes]:
+        return [message.body for message in self.messages]
+
+    async def wait_for(self, count: int) -> list[bytes]:
+        """Wait until `count` messages have been delivered in total."""
+        async with asyncio.timeout(DELIVERY_TIMEOUT):
+            while len(self.messages) < count:
+                self._changed.clear()
+                await self._changed.wait()
+        return self.bodies
+
+
+def bodies(count: int, prefix: str = "activity") -> list[bytes]:
+    return [f"{prefix}-{i}".encode() for i in range(count)]
+
+
+def test_publish_keeps_order(backend: Backend) -> None:
+    async def scenario() -> None:
+        async with open_queue(backend) as queue:
+            await queue.publish(bodies(10)[:4])
+            await queue.publish(bodies(10)[4:])
+
+            collector = Collector()
+            await queue.consume(collector, prefetch_count=100)
+            assert await collector.wait_for(10) == bodies(10)
+
+    asyncio.run(scenario())
+
+
+def test_consume_respects_prefetch_count(backend: Backend) -> None:
+    async def scenario() -> None:
+        async with open_queue(backend) as queue:
+            await queue.publish(bodies(5))
+
+            collector = Collector()
+            await queue.consume(collector, prefetch_count=2)
+            assert await collector.wait_for(2) == bodies(2)
+
+            await asyncio.sleep(NO_DELIVERY_WAIT)
+            assert len(collector.messages) == 2
+
+            await collector.messages[0].ack()
+            assert await collector.wait_for(3) == bodies(3)
+
+            await asyncio.sleep(NO_DELIVERY_WAIT)
+            assert len(collector.messages) == 3
+
+    asyncio.run(scenario())
+
+
+def test_acknowledged_messages_are_removed(backend: Backend) -> None:
+    async def scenario() -> None:
+        async with open_queue(backend) as queue:
+            await queue.publish(bodies(3))
+
+            collector = Collector()
+            await queue.consume(collector, prefetch_count=10)
+            await collector.wait_for(3)
+            for message in collector.messages:
+                await message.ack()
+
+        async with open_queue(backend) as queue:
+            assert await queue.get_message_count() == 0
+
+            collector = Collector()
+            await queue.consume(collector, prefetch_count=10)
+            await asyncio.sleep(NO_DELIVERY_WAIT)
+            assert collector.messages == []
+
+    asyncio.run(scenario())
+
+
+def test_requeued_message_goes_ahead_of_newer_messages(backend: Backend) -> None:
+    async def scenario() -> None:
+        async with open_queue(backend) as queue:
+            await queue.publish(bodies(4))
+
+            collector = Collector()
+            await queue.consume(collector, prefetch_count=2)
+            await collector.wait_for(2)
+
+            await collector.messages[0].nack(requeue=True)
+            assert (await collector.wait_for(3))[2] == b"activity-0"
+
+            for message in collector.messages[1:]:
+                await message.ack()
+            assert (await collector.wait_for(5))[3:] == bodies(4)[2:]
+
+    asyncio.run(scenario())
+
+
+def test_unacknowledged_messages_are_delivered_again(backend: Backend) -> None:
+    async def scenario() -> None:
+        async with open_queue(backend) as queue:
+            await queue.publish(bodies(3))
+
+            collector = Collector()
+            await queue.consume(collector, prefetch_count=10)
+            await collector.wait_for(3)
+            await collector.messages[0].ack()
+
+        async with open_queue(backend) as queue:
+            collector = Collector()
+            await queue.consume(collector, prefetch_count=10)
+            assert await collector.wait_for(2) == bodies(3)[1:]
+
+    asyncio.run(scenario())
+
+
+def test_message_count_includes_all_partitions(backend: Backend) -> None:
+    async def scenario() -> None:
+        async with open_queue(backend) as queue:
+            assert await queue.get_message_count() == 0
+
+            await queue.publish(bodies(3), partition=0)
+            await queue.publish(bodies(2), partition=1)
+            assert await queue.get_message_count() == 5
+
+    asyncio.run(scenario())
+
+
+def test_partitions_are_isolated(backend: Backend) -> None:
+    async def scenario() -> None:
+        async with open_queue(backend) as queue:
+            await queue.publish(bodies(3, "first"), partition=0)
+            await queue.publish(bodies(2, "second"), partition=1)
+
+            first = Collector()
+            second = Collector()
+            # A full first partition doesn't hold up the second one
+            await queue.consume(first, prefetch_count=1, partition=0)
+            await queue.consume(second, prefetch_count=10, partition=1)
+
+            assert await second.wait_for(2) == bodies(2, "second")
+            assert await first.wait_for(1) == bodies(1, "first")
+
+            await asyncio.sleep(NO_DELIVERY_WAIT)
+            assert len(first.messages) == 1
+            assert len(second.messages) == 2
+
+    asyncio.run(scenario())
@@ -0,0 +1,248 @@
+"""Incremental parsing of batches as batch-receiver receives them."""
+
+import json
+from collections.abc import Callable
+from datetime import UTC, datetime
+from typing import TypeAlias
+
+import pytest
+
+from activitypub_federation_queue_batcher.codec import (
+    BINARY_BATCH_RECORD_PREFIX,
+    BinaryBatchParser,
+    InvalidBatchActivityError,
+    JSONBatchParser,
+    TruncatedBinaryBatchError,
+    TruncatedJSONBatchError,
+    UnexpectedJSONBatchCharacterError,
+    encode_activity_submission_metadata,
+    encode_binary_batch,
+    encode_json_batch,
+)
+from activitypub_federation_queue_batcher.types import ActivitySubmissionMetadata
+
+Activity: TypeAlias = tuple[ActivitySubmissionMetadata, bytes]
+Parser: TypeAlias = BinaryBatchParser | JSONBatchParser
+
+ACTIVITIES: list[Activity] = [
+    (
+        ActivitySubmissionMetadata(
+            time=datetime(2024, 1, 2, 3, 4, 5, 678901, tzinfo=UTC),
+            # Multi-byte characters may be split between chunks
+            activity_id=f"https://example.com/activities/{i}/ü€😀",
+            host="myinstance.tld",
+            path="/inbox",
+            headers=[["Content-Type", "application/activity+json"], ["X-I", str(i)]],
+        ),
+        json.dumps({"id": i, "content": "}]," * i + "ü"}).encode(),
+    )
+    for i in range(3)
+]
+
+FORMATS: dict[str, tuple[Callable[[list[Activity]], bytes], Callable[[], Parser]]] = {
+    "binary": (encode_binary_batch, BinaryBatchParser),
+    "json": (encode_json_batch, JSONBatchParser),
+}
+
+
+def parse(parser: Parser, chunks: list[bytes]) -> list[Activity]:
+    activities = []
+    for chunk in chunks:
+        activities.extend(parser.feed(chunk))
+    parser.close()
+    return activities
+
+
+@pytest.fixture(params=list(FORMATS))
+def batch_format(
+    request: pytest.FixtureRequest,
+) -> tuple[Callable[[list[Activity]], bytes], Callable[[], Parser]]:
+    return FORMATS[request.param]
+
+
+def test_split_at_every_offset(
+    batch_format: tuple[Callable[[list[Activity]], bytes], Callable[[], Parser]],
+) -> None:
+    encode, create_parser = batch_format
+    data = encode(ACTIVITIES)
+
+    for i in range(len(data) + 1):
+        assert parse(create_parser(), [data[:i], data[i:]]) == ACTIVITIES
+
+
+def test_byte_by_byte(
+    batch_format: tuple[Callable[[list[Activity]], bytes], Callable[[], Parser]],
+) -> None:
+    encode, create_parser = batch_format
+    data = encode(ACTIVITIES)
+
+    parser = create_parser()
+    completed_at = [i + 1 for i in range(len(data)) if parser.feed(data[i : i + 1])]
+    parser.close()
+
+    # Each activity is returned as soon as it's complete, for JSON batches
+    # that's before the "]" which ends the encoded batch.
+    assert completed_at == [
+        len(encode(ACTIVITIES[:n])) - (1 if encode is encode_json_batch else 0)
+        for n in range(1, len(ACTIVITIES) + 1)
+    ]
+
+
+def test_empty_batch(
+    batch_format: tuple[Callable[[list[Activity]], bytes], Callable[[], Parser]],
+) -> None:
+    encode, create_parser = batch_format
+    assert parse(create_parser(), [encode([])]) == []
+
+
+def test_truncated(
+    batch_format: tuple[Callable[[list[Activity]], bytes], Callable[[], Parser]],
+) -> None:
+    encode, create_parser = batch_format
+    data = encode(ACTIVITIES)
+    complete = {len(encode(ACTIVITIES[:n])) for n in range(len(ACTIVITIES) + 1)}
+
+    for i in range(len(data)):
+        if encode is encode_binary_batch and i in complete:
+            # A binary batch may end after any record
+            continue
+
+        parser = create_parser()
+        parser.feed(data[:i])
+        with pytest.raises(ValueError):  # noqa: PT011
+            parser.close()
+
+
+def test_truncated_errors() -> None:
+    binary_parser = BinaryBatchParser()
+    binary_parser.feed(encode_binary_batch(ACTIVITIES)[:-1])
+    with pytest.raises(TruncatedBinaryBatchError):
+        binary_parser.close()
+
+    json_parser = JSONBatchParser()
+    json_parser.feed(encode_json_batch(ACTIVITIES)[:-1])
+    with pytest.raises(TruncatedJSONBatchError):
+        json_parser.close()
+
+
+@pytest.mark.parametrize(
+    "suffix",
+    [b"x", b",", b"[]", b' {"b64_body": ""}', b"]"],
+)
+def test_json_trailing_garbage(suffix: bytes) -> None:
+    parser = JSONBatchParser()
+    assert parser.feed(encode_json_batch(ACTIVITIES)) == ACTIVITIES
+    with pytest.raises(UnexpectedJSONBatchCharacterError):
+        parser.feed(b" \n" + suffix)
+
+
+def test_json_trailing_whitespace() -> None:
+    data = b" \n[ " + encode_json_batch(ACTIVITIES)[1:] + b" \r\n\t"
+    assert parse(JSONBatchParser(), [data]) == ACTIVITIES
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        # Trailing comma
+        encode_json_batch(ACTIVITIES)[:-1] + b",]",
+        # Leading and doubled commas
+        b"[," + encode_json_batch(ACTIVITIES)[1:],
+        encode_json_batch(ACTIVITIES[:1])[:-1]
+        + b",,"
+        + encode_json_batch(ACTIVITIES[1:])[1:],
+        # Missing commas
+        encode_json_batch(ACTIVITIES[:1])[:-1] + encode_json_batch(ACTIVITIES[1:])[1:],
+        # Not an array
+        encode_json_batch(ACTIVITIES)[1:-1],
+        b"{}",
+        b"null",
+    ],
+)
+def test_json_malformed(data: bytes) -> None:
+    with pytest.raises(ValueError):  # noqa: PT011
+        parse(JSONBatchParser(), [data])
+
+
+@pytest.mark.parametrize(
+    "element",
+    [
+        b"1",
+        b'"activity"',
+        b"[]",
+        b"{}",
+        # Missing metadata
+        b'{"b64_body": ""}',
+        # Body which isn't base64 encoded
+        json.dumps(
+            {**json.loads(encode_json_batch(ACTIVITIES[:1]))[0], "b64_body": 1},
+        ).encode(),
+        # Unparseable elements
+        b'{"b64_body": }',
+        b'{"b64_body": "" ',
+    ],
+)
+def test_json_invalid_element(element: bytes) -> None:
+    parser = JSONBatchParser()
+    with pytest.raises(ValueError):  # noqa: PT011
+        parse(parser, [b"[", element, b"]"])
+
+
+def test_json_invalid_element_error() -> None:
+    with pytest.raises(InvalidBatchActivityError):
+        parse(JSONBatchParser(), [b'[{"b64_body": ""}]'])
+
+
+def test_json_large_element() -> None:
+    activity = (ACTIVITIES[0][0], b"x" * 1_000_000)
+    data = encode_json_batch([activity, *ACTIVITIES])
+
+    chunks = [data[i : i + 1000] for i in range(0, len(data), 1000)]
+    assert parse(JSONBatchParser(), chunks) == [activity, *ACTIVITIES]
+
+
+def binary_record(metadata: bytes, body: bytes) -> bytes:
+    return BINARY_BATCH_RECORD_PREFIX.pack(len(metadata), len(body)) + metadata + body
+
+
+@pytest.mark.parametrize(
+    "metadata",
+    [
+        b"",
+        b"not json",
+        b"\xff\xfe",
+        b"[]",
+        b"{}",
+        b'{"time": "not a time"}',
+    ],
+)
+def test_binary_invalid_metadata(metadata: bytes) -> None:
+    parser = BinaryBatchParser()
+    with pytest.raises(ValueError):  # noqa: PT011
+        parser.feed(binary_record(metadata, b"{}"))
+
+
+def test_binary_invalid_metadata_error() -> None:
+    with pytest.raises(InvalidBatchActivityError):
+        BinaryBatchParser().feed(binary_record(b"{}", b"{}"))
+
+
+def test_binary_oversized_record() -> None:
+    # A record which claims to be larger than the rest of the batch is never
+    # completed, however much data follows.
+    metadata = encode_activity_submission_metadata(ACTIVITIES[0][0])
+    prefix = BINARY_BATCH_RECORD_PREFIX.pack(len(metadata), 2**32 - 1)
+
+    parser = BinaryBatchParser()
+    assert parser.feed(encode_binary_batch(ACTIVITIES)) == ACTIVITIES
+    assert parser.feed(prefix + metadata + b"x" * 100_000) == []
+    with pytest.raises(TruncatedBinaryBatchError):
+        parser.close()
+
+
+def test_binary_large_record() -> None:
+    activity = (ACTIVITIES[0][0], b"\0" * 1_000_000)
+    data = encode_binary_batch([activity, *ACTIVITIES])
+
+    chunks = [data[i : i + 1000] for i in range(0, len(data), 1000)]
+    assert parse(BinaryBatchParser(), chunks) == [activity, *ACTIVITIES]
@@ -0,0 +1,282 @@
+"""Processing the sequenced batches of a batch sender session in order."""
+
+import asyncio
+from collections import OrderedDict
+from collections.abc import Coroutine
+from typing import Any, cast
+
+import aiohttp
+import pytest
+
+from activitypub_federation_queue_batcher.batch_receiver import (
+    __main__ as batch_receiver,
+)
+from activitypub_federation_queue_batcher.batch_receiver.__main__ import (
+    BatchReader,
+    BatchResponseWriter,
+    BatchSession,
+    get_batch_session,
+    submit_sequenced_activities,
+)
+
+
+class Upstream:
+    """Stands in for submitting the activities of a batch upstream."""
+
+    def __init__(self) -> None:
+        self.submitted: list[int] = []
+        self.cancelled: list[int] = []
+        # Batches which fail, or which wait for their event before completing
+        self.failing: set[int] = set()
+        self.blocked: dict[int, asyncio.Event] = {}
+
+    async def submit_activities(
+        self,
+        _cs: aiohttp.ClientSession,
+        activities: BatchReader,
+        _writer: BatchResponseWriter,
+        *,
+        partitioned: bool,  # noqa: ARG002
+    ) -> bool:
+        # Batches are identified by their sequence number instead
+        sequence = cast("int", activities)
+        self.submitted.append(sequence)
+
+        if sequence in self.blocked:
+            try:
+                await self.blocked[sequence].wait()
+            except asyncio.CancelledError:
+                self.cancelled.append(sequence)
+                raise
+
+        return sequence not in self.failing
+
+
+@pytest.fixture
+def upstream(monkeypatch: pytest.MonkeyPatch) -> Upstream:
+    upstream = Upstream()
+    monkeypatch.setattr(
+        batch_receiver,
+        "submit_activities",
+        upstream.submit_activities,
+    )
+    return upstream
+
+
+def send(
+    sessions: OrderedDict[str, BatchSession],
+    sequence: int,
+    *,
+    resume: bool = False,
+    session_id: str = "session",
+) -> Coroutine[Any, Any, None]:
+    return submit_sequenced_activities(
+        cast("aiohttp.ClientSession", None),
+        sessions,
+        cast("BatchReader", sequence),
+        cast("BatchResponseWriter", None),
+        partitioned=False,
+        session_id=session_id,
+        sequence=sequence,
+        resume=resume,
+    )
+
+
+async def settle() -> None:
+    """Let all requests run until they wait for something."""
+    for _ in range(20):
+        await asyncio.sleep(0)
+
+
+def test_in_order(upstream: Upstream) -> None:
+    async def run() -> None:
+        sessions: OrderedDict[str, BatchSession] = OrderedDict()
+        for sequence in range(3):
+            await send(sessions, sequence)
+
+    asyncio.run(run())
+    assert upstream.submitted == [0, 1, 2]
+
+
+def test_out_of_order(upstream: Upstream) -> None:
+    async def run() -> None:
+        sessions: OrderedDict[str, BatchSession] = OrderedDict()
+        async with asyncio.TaskGroup() as tg:
+            for sequence in [3, 1, 2]:
+                tg.create_task(send(sessions, sequence))
+            await settle()
+
+            # Nothing is processed before the first batch arrives
+            assert upstream.submitted == []
+            tg.create_task(send(sessions, 0))
+
+    asyncio.run(run())
+    assert upstream.submitted == [0, 1, 2, 3]
+
+
+def test_sessions_are_independent(upstream: Upstream) -> None:
+    async def run() -> None:
+        sessions: OrderedDict[str, BatchSession] = OrderedDict()
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(send(sessions, 1, session_id="a"))
+            await settle()
+            await send(sessions, 0, session_id="b")
+            await send(sessions, 1, session_id="b")
+            assert upstream.submitted == [0, 1]
+
+            tg.create_task(send(sessions, 0, session_id="a"))
+
+    asyncio.run(run())
+    assert upstream.submitted == [0, 1, 0, 1]
+
+
+def test_already_processed(upstream: Upstream) -> None:
+    async def run() -> None:
+        sessions: OrderedDict[str, BatchSession] = OrderedDict()
+        await send(sessions, 0)
+        await send(sessions, 1)
+        # E.g. a request the batch sender retried after losing the response
+        await send(sessions, 0)
+        await send(sessions, 1)
+        await send(sessions, 2)
+
+    asyncio.run(run())
+    assert upstream.submitted == [0, 1, 2]
+
+
+def test_failed_batch_stops_session(upstream: Upstream) -> None:
+    upstream.failing.add(1)
+
+    async def run() -> None:
+        sessions: OrderedDict[str, BatchSession] = OrderedDict()
+        async with asyncio.TaskGroup() as tg:
+            for sequence in [3, 2, 1, 0]:
+                tg.create_task(send(sessions, sequence))
+
+        # Later batches are skipped, but still count as processed
+        await send(sessions, 4)
+        assert sessions["session"].next_sequence == 5
+
+    asyncio.run(run())
+    assert upstream.submitted == [0, 1]
+
+
+def test_timeout(upstream: Upstream, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(batch_receiver, "BATCH_RECEIVER_SEQUENCE_TIMEOUT", 0.01)
+
+    async def run() -> None:
+        sessions: OrderedDict[str, BatchSession] = OrderedDict()
+        with pytest.raises(TimeoutError):
+            await send(sessions, 1)
+
+        # The session is still usable afterwards
+        await send(sessions, 0)
+        await send(sessions, 1)
+        assert sessions["session"].requests == 0
+
+    asyncio.run(run())
+    assert upstream.submitted == [0, 1]
+
+
+def test_resume_after_failure(upstream: Upstream) -> None:
+    upstream.failing.add(0)
+
+    async def run() -> None:
+        sessions: OrderedDict[str, BatchSession] = OrderedDict()
+        await send(sessions, 0)
+        await send(sessions, 1)
+
+        # The batch sender sends the remaining activities again
+        await send(sessions, 2, resume=True)
+        await send(sessions, 3)
+
+    asyncio.run(run())
+    assert upstream.submitted == [0, 2, 3]
+
+
+def test_resume_skips_earlier_batches(upstream: Upstream) -> None:
+    async def run() -> None:
+        sessions: OrderedDict[str, BatchSession] = OrderedDict()
+        async with asyncio.TaskGroup() as tg:
+            # Batches which the batch sender gave up on arrive late
+            tg.create_task(send(sessions, 1))
+            tg.create_task(send(sessions, 2))
+            await settle()
+
+            await send(sessions, 3, resume=True)
+            await send(sessions, 4)
+
+        await send(sessions, 0)
+        await send(sessions, 2)
+
+    asyncio.run(run())
+    assert upstream.submitted == [3, 4]
+
+
+def test_resume_cancels_processing(upstream: Upstream) -> None:
+    upstream.blocked[0] = asyncio.Event()
+
+    async def run() -> None:
+        sessions: OrderedDict[str, BatchSession] = OrderedDict()
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(send(sessions, 0))
+            tg.create_task(send(sessions, 1))
+            await settle()
+            assert upstream.submitted == [0]
+
+            # The batch in progress is stopped, the one waiting is skipped
+            await send(sessions, 2, resume=True)
+
+    asyncio.run(run())
+    assert upstream.submitted == [0, 2]
+    assert upstream.cancelled == [0]
+
+
+def test_resumed_again(upstream: Upstream) -> None:
+    upstream.failing.update({0, 2})
+
+    async def run() -> None:
+        sessions: OrderedDict[str, BatchSession] = OrderedDict()
+        await send(sessions, 0)
+        await send(sessions, 1, resume=True)
+        await send(sessions, 2)
+        await send(sessions, 3)
+        await send(sessions, 4, resume=True)
+
+        # A resumed batch which arrives after a later resume is outdated
+        await send(sessions, 1, resume=True)
+        await send(sessions, 5)
+
+    asyncio.run(run())
+    assert upstream.submitted == [0, 1, 2, 4, 5]
+
+
+def test_resume_without_earlier_batches(upstream: Upstream) -> None:
+    async def run() -> None:
+        # E.g. after batch-receiver restarted and lost its sessions
+        sessions: OrderedDict[str, BatchSession] = OrderedDict()
+        await send(sessions, 7, resume=True)
+        await send(sessions, 8)
+
+    asyncio.run(run())
+    assert upstream.submitted == [7, 8]
+
+
+def test_evicts_least_recently_used_idle_session(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(batch_receiver, "BATCH_RECEIVER_MAX_SESSIONS", 2)
+    sessions: OrderedDict[str, BatchSession] = OrderedDict()
+
+    a = get_batch_session(sessions, "a")
+    get_batch_session(sessions, "b")
+    assert get_batch_session(sessions, "a") is a
+
+    get_batch_session(sessions, "c")
+    assert list(sessions) == ["a", "c"]
+
+    # Sessions with requests are kept, even if that exceeds the limit
+    a.requests = 1
+    sessions["c"].requests = 1
+    get_batch_session(sessions, "d")
+    assert list(sessions) == ["a", "c", "d"]
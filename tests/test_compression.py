@@ -0,0 +1,208 @@
+"""Decompressing batches while they are being received."""
+
+import random
+
+import pytest
+import zstandard
+
+from activitypub_federation_queue_batcher._compression_helpers import (
+    BatchCompressor,
+    BatchDecompressionError,
+    BatchDecompressor,
+    BatchTooLargeError,
+    TruncatedBatchError,
+    _ZstdFrameScanner,
+)
+
+MAX_SIZE = 2**20
+
+# Compresses well, so that frames consist of compressed blocks
+TEXT = b"".join(
+    f'{{"id":"https://example.com/{i}","type":"Like"}}\n'.encode() for i in range(200)
+)
+# Doesn't compress at all, so that frames consist of raw blocks
+NOISE = random.Random(0).randbytes(4096)
+# Repeated bytes, which may be encoded as RLE blocks
+ZEROS = bytes(200_000)
+
+SKIPPABLE_FRAME_MAGIC = (0x184D2A50).to_bytes(4, "little")
+
+
+def skippable_frame(payload: bytes) -> bytes:
+    return SKIPPABLE_FRAME_MAGIC + len(payload).to_bytes(4, "little") + payload
+
+
+def zstd_compress(
+    data: bytes,
+    *,
+    checksum: bool = False,
+    content_size: bool = True,
+    dictionary: zstandard.ZstdCompressionDict | None = None,
+) -> bytes:
+    compressor = zstandard.ZstdCompressor(
+        write_checksum=checksum,
+        write_content_size=content_size,
+        dict_data=dictionary,
+    )
+    if content_size:
+        return compressor.compress(data)
+
+    # Streamed frames don't know their size in advance
+    compressobj = compressor.compressobj()
+    return compressobj.compress(data) + compressobj.flush()
+
+
+def decompress(
+    encoding: str,
+    chunks: list[bytes],
+    *,
+    max_size: int = MAX_SIZE,
+    dictionary: zstandard.ZstdCompressionDict | None = None,
+) -> bytes:
+    decompressor = BatchDecompressor(max_size=max_size, zstd_dictionary=dictionary)
+    streaming = decompressor.decompressobj(encoding)
+    data = b"".join(streaming.decompress(chunk) for chunk in chunks)
+    streaming.finish()
+    return data
+
+
+def scan(chunks: list[bytes]) -> bool:
+    scanner = _ZstdFrameScanner()
+    for chunk in chunks:
+        scanner.feed(chunk)
+    return scanner.eof
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "br", "zstd"])
+@pytest.mark.parametrize("data", [b"", TEXT, NOISE], ids=["empty", "text", "noise"])
+def test_split_at_every_offset(encoding: str, data: bytes) -> None:
+    compressed = BatchCompressor(encoding).compress(data)
+
+    for i in range(len(compressed) + 1):
+        assert decompress(encoding, [compressed[:i], compressed[i:]]) == data
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "br", "zstd"])
+def test_truncated(encoding: str) -> None:
+    compressed = BatchCompressor(encoding).compress(TEXT)
+
+    for i in range(len(compressed)):
+        with pytest.raises((TruncatedBatchError, BatchDecompressionError)):
+            decompress(encoding, [compressed[:i]])
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "br", "zstd"])
+def test_too_large(encoding: str) -> None:
+    compressed = BatchCompressor(encoding).compress(ZEROS)
+
+    assert decompress(encoding, [compressed], max_size=len(ZEROS)) == ZEROS
+    with pytest.raises(BatchTooLargeError):
+        decompress(encoding, [compressed], max_size=len(ZEROS) - 1)
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "br", "zstd"])
+def test_garbage(encoding: str) -> None:
+    with pytest.raises(BatchDecompressionError):
+        decompress(encoding, [b"\x00" * 16 + TEXT])
+
+
+@pytest.mark.parametrize("checksum", [False, True])
+@pytest.mark.parametrize("content_size", [False, True])
+@pytest.mark.parametrize(
+    "data",
+    [b"", b"x", TEXT, NOISE, ZEROS, NOISE * 100],
+    ids=["empty", "byte", "text", "noise", "zeros", "large"],
+)
+def test_zstd_frames(*, checksum: bool, content_size: bool, data: bytes) -> None:
+    compressed = zstd_compress(data, checksum=checksum, content_size=content_size)
+
+    assert decompress("zstd", [compressed]) == data
+    assert scan([compressed])
+    assert not scan([compressed[:-1]])
+    assert not scan([compressed + compressed[:1]])
+
+
+@pytest.mark.parametrize("checksum", [False, True])
+def test_zstd_frames_split_at_every_offset(*, checksum: bool) -> None:
+    compressed = zstd_compress(TEXT + NOISE, checksum=checksum, content_size=False)
+
+    for i in range(len(compressed)):
+        assert not scan([compressed[:i]])
+        assert scan([compressed[:i], compressed[i:]])
+
+    assert scan([compressed[i : i + 1] for i in range(len(compressed))])
+
+
+def test_zstd_multiple_frames() -> None:
+    frames = [
+        zstd_compress(TEXT, checksum=True),
+        zstd_compress(NOISE, content_size=False),
+        zstd_compress(b""),
+    ]
+    compressed = b"".join(frames)
+
+    assert decompress("zstd", [compressed]) == TEXT + NOISE
+    assert scan([compressed])
+
+    # Input may end after any complete frame
+    ends = {sum(map(len, frames[:n])) for n in range(1, len(frames) + 1)}
+    for i in range(len(compressed)):
+        assert scan([compressed[:i]]) == (i in ends)
+
+
+def test_zstd_skippable_frames() -> None:
+    frame = zstd_compress(TEXT, checksum=True)
+    compressed = (
+        skippable_frame(b"metadata")
+        + frame
+        + skippable_frame(b"")
+        + skippable_frame(NOISE)
+    )
+
+    assert decompress("zstd", [compressed]) == TEXT
+    for i in range(len(compressed)):
+        assert scan([compressed[:i], compressed[i:]])
+
+    # A skippable frame is only complete with all of its payload
+    assert not scan([frame + skippable_frame(NOISE)[:-1]])
+    with pytest.raises(TruncatedBatchError):
+        decompress("zstd", [frame + skippable_frame(NOISE)[:-1]])
+
+
+def test_zstd_only_skippable_frames() -> None:
+    # Without any actual frame, the batch is missing entirely
+    assert not scan([skippable_frame(b"")])
+    with pytest.raises(TruncatedBatchError):
+        decompress("zstd", [skippable_frame(b"")])
+
+
+def test_zstd_dictionary() -> None:
+    samples = [
+        f'{{"id":"https://example.com/{i}","type":"Like","n":{i * 7}}}'.encode()
+        for i in range(1000)
+    ]
+    dictionary = zstandard.train_dictionary(4096, samples)
+    compressed = zstd_compress(TEXT, checksum=True, dictionary=dictionary)
+
+    assert decompress("zstd", [compressed], dictionary=dictionary) == TEXT
+    # The frame header includes the dictionary id
+    assert scan([compressed])
+    with pytest.raises(BatchDecompressionError):
+        decompress("zstd", [compressed])
+
+
+def test_zstd_too_large_without_content_size() -> None:
+    # Zeros compress well enough to exceed the limit within a single chunk
+    compressed = zstd_compress(ZEROS * 50, content_size=False)
+    assert len(compressed) < MAX_SIZE
+
+    with pytest.raises(BatchTooLargeError):
+        decompress("zstd", [compressed])
+
+
+def test_zstd_too_large_across_frames() -> None:
+    frame = zstd_compress(random.Random(1).randbytes(MAX_SIZE // 2 + 1))
+
+    assert decompress("zstd", [frame]) != b""
+    with pytest.raises(BatchTooLargeError):
+        decompress("zstd", [frame, frame])
@@ -0,0 +1,169 @@
+"""Remembering recently seen activities to drop duplicates."""
+
+import time
+
+import pytest
+from prometheus_client import CollectorRegistry, Counter
+
+from activitypub_federation_queue_batcher._dedup_helpers import (
+    ActivityDeduplicator,
+    get_activity_key,
+)
+
+TTL = 60.0
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(time, "monotonic", clock)
+    return clock
+
+
+@pytest.fixture
+def registry() -> CollectorRegistry:
+    return CollectorRegistry()
+
+
+def create_deduplicator(
+    registry: CollectorRegistry,
+    *,
+    max_entries: int = 100,
+) -> ActivityDeduplicator:
+    metric = Counter("deduplication", "", ["result"], registry=registry)
+    return ActivityDeduplicator(max_entries=max_entries, ttl=TTL, metric=metric)
+
+
+def key(i: int) -> bytes:
+    return get_activity_key(f"https://remote.tld/activities/{i}", b"{}")
+
+
+def get_count(registry: CollectorRegistry, result: str) -> float | None:
+    return registry.get_sample_value("deduplication_total", {"result": result})
+
+
+def test_activity_key() -> None:
+    assert key(1) == key(1)
+    assert key(1) != key(2)
+    # Updated activities which reuse their id aren't duplicates
+    assert get_activity_key("a", b"{}") != get_activity_key("a", b"{ }")
+    # The id and body can't be shifted into each other
+    assert get_activity_key("a", b"b") != get_activity_key("ab", b"")
+
+
+@pytest.mark.usefixtures("clock")
+def test_duplicates(registry: CollectorRegistry) -> None:
+    deduplicator = create_deduplicator(registry)
+
+    assert not deduplicator.is_duplicate(key(1))
+    deduplicator.add(key(1))
+    assert deduplicator.is_duplicate(key(1))
+    assert deduplicator.is_duplicate(key(1))
+    assert not deduplicator.is_duplicate(key(2))
+
+    assert get_count(registry, "hit") == 2
+    assert get_count(registry, "miss") == 2
+
+
+def test_ttl(clock: Clock, registry: CollectorRegistry) -> None:
+    deduplicator = create_deduplicator(registry)
+    deduplicator.add(key(1))
+    clock.now += TTL / 2
+    deduplicator.add(key(2))
+
+    clock.now += TTL / 2 - 0.001
+    assert deduplicator.is_duplicate(key(1))
+    assert deduplicator.is_duplicate(key(2))
+
+    # Entries expire exactly after the TTL, each at its own time
+    clock.now += 0.001
+    assert not deduplicator.is_duplicate(key(1))
+    assert deduplicator.is_duplicate(key(2))
+    assert len(deduplicator) == 1
+
+    clock.now += TTL / 2
+    assert not deduplicator.is_duplicate(key(2))
+    assert len(deduplicator) == 0
+
+
+def test_ttl_not_refreshed(clock: Clock, registry: CollectorRegistry) -> None:
+    deduplicator = create_deduplicator(registry)
+    deduplicator.add(key(1))
+
+    # Seeing or adding an activity again doesn't extend how long it's remembered
+    clock.now += TTL / 2
+    assert deduplicator.is_duplicate(key(1))
+    deduplicator.add(key(1))
+
+    clock.now += TTL / 2
+    assert not deduplicator.is_duplicate(key(1))
+
+
+def test_expired_on_add(clock: Clock, registry: CollectorRegistry) -> None:
+    deduplicator = create_deduplicator(registry)
+    for i in range(10):
+        deduplicator.add(key(i))
+
+    clock.now += TTL
+    deduplicator.add(key(10))
+    assert len(deduplicator) == 1
+
+
+@pytest.mark.usefixtures("clock")
+def test_max_entries(registry: CollectorRegistry) -> None:
+    deduplicator = create_deduplicator(registry, max_entries=3)
+    for i in range(5):
+        deduplicator.add(key(i))
+
+    # The oldest entries are forgotten first
+    assert len(deduplicator) == 3
+    assert [deduplicator.is_duplicate(key(i)) for i in range(5)] == [
+        False,
+        False,
+        True,
+        True,
+        True,
+    ]
+
+
+@pytest.mark.usefixtures("clock")
+def test_max_entries_least_recently_added(registry: CollectorRegistry) -> None:
+    deduplicator = create_deduplicator(registry, max_entries=3)
+    for i in range(3):
+        deduplicator.add(key(i))
+
+    # Neither seeing nor adding the oldest entry again moves it back
+    assert deduplicator.is_duplicate(key(0))
+    deduplicator.add(key(0))
+    deduplicator.add(key(3))
+
+    assert not deduplicator.is_duplicate(key(0))
+    assert deduplicator.is_duplicate(key(1))
+    assert deduplicator.is_duplicate(key(3))
+
+
+@pytest.mark.usefixtures("clock")
+def test_discard(registry: CollectorRegistry) -> None:
+    deduplicator = create_deduplicator(registry, max_entries=2)
+    deduplicator.add(key(1))
+    deduplicator.add(key(2))
+
+    deduplicator.discard(key(1))
+    deduplicator.discard(key(3))
+    assert len(deduplicator) == 1
+    assert not deduplicator.is_duplicate(key(1))
+
+    # A discarded activity can be added again, as the newest entry
+    deduplicator.add(key(1))
+    deduplicator.add(key(3))
+    assert not deduplicator.is_duplicate(key(2))
+    assert deduplicator.is_duplicate(key(1))
+    assert deduplicator.is_duplicate(key(3))
@@ -0,0 +1,191 @@
+"""Compacting the headers of received activities before queueing them."""
+
+from datetime import UTC, datetime
+
+import multidict
+import pytest
+
+from activitypub_federation_queue_batcher._header_helpers import (
+    HEADER_POLICIES,
+    compact_headers,
+    get_signed_header_names,
+)
+from activitypub_federation_queue_batcher.codec import (
+    BinaryBatchParser,
+    JSONBatchParser,
+    decode_queued_activity,
+    encode_binary_batch,
+    encode_json_batch,
+    encode_queued_activity,
+)
+from activitypub_federation_queue_batcher.types import ActivitySubmissionMetadata
+
+CAVAGE_SIGNATURE = (
+    'keyId="https://remote.tld/users/alice#main-key",algorithm="rsa-sha256",'
+    'headers="(request-target) host date digest",signature="c2lnbmF0dXJl"'
+)
+
+SIGNED_HEADERS = [
+    ["Host", "myinstance.tld"],
+    ["Connection", "keep-alive, X-Forwarded-Proto"],
+    ["Keep-Alive", "timeout=5"],
+    ["Transfer-Encoding", "chunked"],
+    ["Date", "Tue, 02 Jan 2024 03:04:05 GMT"],
+    ["Digest", "SHA-256=X48E9qOokqqrvdts8nOJRJN3OWDUoyWxBf7kbu9DBPE="],
+    ["Content-Type", "application/activity+json"],
+    ["User-Agent", "Remote/1.0"],
+    ["X-Forwarded-For", "203.0.113.7"],
+    ["X-Forwarded-Proto", "https"],
+    ["Accept-Encoding", "gzip"],
+    ["Signature", CAVAGE_SIGNATURE],
+]
+
+
+def round_trip(headers: list[list[str]]) -> list[list[str]]:
+    """Queue and batch an activity with these headers, as batch-receiver gets it."""
+    metadata = ActivitySubmissionMetadata(
+        time=datetime(2024, 1, 2, 3, 4, 5, tzinfo=UTC),
+        activity_id="https://remote.tld/activities/1",
+        host="myinstance.tld",
+        path="/inbox",
+        headers=headers,
+    )
+    queued = decode_queued_activity(encode_queued_activity(metadata, b"{}"))
+    assert queued == (metadata, b"{}")
+
+    (binary,) = BinaryBatchParser().feed(encode_binary_batch([queued]))
+    (json,) = JSONBatchParser().feed(encode_json_batch([queued]))
+    assert binary == json == queued
+    return binary[0].headers
+
+
+@pytest.mark.parametrize("policy", HEADER_POLICIES)
+def test_round_trip(policy: str) -> None:
+    headers = compact_headers(SIGNED_HEADERS, policy)
+
+    assert round_trip(headers) == headers
+    # Names are kept as received, as the signature lists them in lowercase
+    assert ["Host", "myinstance.tld"] in headers
+    assert ["Signature", CAVAGE_SIGNATURE] in headers
+
+
+def test_all_policy() -> None:
+    assert compact_headers(SIGNED_HEADERS, "all") == [
+        ["Host", "myinstance.tld"],
+        ["Date", "Tue, 02 Jan 2024 03:04:05 GMT"],
+        ["Digest", "SHA-256=X48E9qOokqqrvdts8nOJRJN3OWDUoyWxBf7kbu9DBPE="],
+        ["Content-Type", "application/activity+json"],
+        ["User-Agent", "Remote/1.0"],
+        ["X-Forwarded-For", "203.0.113.7"],
+        ["Accept-Encoding", "gzip"],
+        ["Signature", CAVAGE_SIGNATURE],
+    ]
+
+
+def test_signature_policy() -> None:
+    assert compact_headers(SIGNED_HEADERS, "signature") == [
+        ["Host", "myinstance.tld"],
+        ["Date", "Tue, 02 Jan 2024 03:04:05 GMT"],
+        ["Digest", "SHA-256=X48E9qOokqqrvdts8nOJRJN3OWDUoyWxBf7kbu9DBPE="],
+        ["Content-Type", "application/activity+json"],
+        ["Signature", CAVAGE_SIGNATURE],
+    ]
+
+
+def test_signature_policy_keeps_signed_headers() -> None:
+    signature = CAVAGE_SIGNATURE.replace("digest", "digest user-agent x-custom")
+    headers = [
+        *SIGNED_HEADERS[:-1],
+        ["x-custom", "1"],
+        ["X-Unsigned", "2"],
+        ["Signature", signature],
+    ]
+
+    compacted = compact_headers(headers, "signature")
+    assert ["User-Agent", "Remote/1.0"] in compacted
+    assert ["x-custom", "1"] in compacted
+    assert ["X-Unsigned", "2"] not in compacted
+    assert round_trip(compacted) == compacted
+
+
+def test_signature_policy_unsigned() -> None:
+    # Without a signature there's nothing to decide by, so all headers are kept
+    headers = [h for h in SIGNED_HEADERS if h[0] != "Signature"]
+
+    assert compact_headers(headers, "signature") == compact_headers(headers, "all")
+
+
+def test_duplicate_headers() -> None:
+    headers = [
+        ["Host", "myinstance.tld"],
+        ["Via", "1.1 a"],
+        ["via", "1.1 b"],
+        ["Via", "1.1 c"],
+    ]
+
+    compacted = compact_headers(headers, "all")
+    assert compacted == headers
+    assert round_trip(compacted) == headers
+
+    # The order of repeated headers matters when they're replayed upstream
+    replayed: multidict.CIMultiDict[str] = multidict.CIMultiDict()
+    for name, value in round_trip(compacted):
+        replayed.add(name, value)
+    assert replayed.getall("via") == ["1.1 a", "1.1 b", "1.1 c"]
+
+
+def test_multidict_items() -> None:
+    # inbox-receiver passes the items of the request headers
+    headers: multidict.CIMultiDict[str] = multidict.CIMultiDict(
+        [(name, value) for name, value in SIGNED_HEADERS],
+    )
+
+    assert compact_headers(headers.items(), "signature") == compact_headers(
+        SIGNED_HEADERS,
+        "signature",
+    )
+
+
+def test_header_names_are_interned() -> None:
+    # Decoded names are distinct objects, like those of received requests
+    first = compact_headers([[b"Content-Type".decode(), "a"]], "all")
+    second = compact_headers([[b"Content-Type".decode(), "b"]], "all")
+
+    assert first[0][0] is second[0][0]
+
+
+@pytest.mark.parametrize(
+    ("headers", "expected"),
+    [
+        ([["Host", "a"]], None),
+        ([["Signature", 'keyId="k",signature="s"']], {"date"}),
+        (
+            [
+                [
+                    "Authorization",
+                    'Signature keyId="k",headers="Host Date",signature="s"',
+                ],
+            ],
+            {"host", "date"},
+        ),
+        ([["Authorization", "Bearer token"]], None),
+        (
+            [["Signature-Input", 'sig1=("@method" "@path" "Content-Digest" "date")']],
+            {"content-digest", "date"},
+        ),
+        (
+            [
+                [
+                    "Signature-Input",
+                    'sig1=("@authority" "date");created=1, sig2=("digest")',
+                ],
+            ],
+            {"date", "digest"},
+        ),
+    ],
+)
+def test_signed_header_names(
+    headers: list[list[str]],
+    expected: set[str] | None,
+) -> None:
+    assert get_signed_header_names(headers) == expected
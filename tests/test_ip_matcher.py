@@ -0,0 +1,198 @@
+"""Matching client IPs against HTTP_ALLOWED_IPS."""
+
+import random
+from ipaddress import (
+    IPv4Address,
+    IPv4Network,
+    IPv6Address,
+    IPv6Network,
+    ip_address,
+)
+
+import pytest
+
+from activitypub_federation_queue_batcher._aiohttp_helpers import (
+    IPAddress,
+    IPMatcher,
+    IPRule,
+    is_allowed_ip,
+    parse_trusted_ips,
+)
+
+
+def linear_scan(rules: IPRule, ip: IPAddress) -> bool:
+    """Check every rule, as allowed IPs were matched before."""
+    return any(
+        (isinstance(rule, IPv4Address | IPv6Address) and ip == rule)
+        or (isinstance(rule, IPv4Network | IPv6Network) and ip in rule)
+        for rule in rules
+    )
+
+
+@pytest.mark.parametrize(
+    ("ip", "expected"),
+    [
+        # Network boundaries
+        ("10.0.0.255", False),
+        ("10.0.1.0", True),
+        ("10.0.1.255", True),
+        ("10.0.2.0", False),
+        # Single addresses and their neighbours
+        ("192.168.0.9", False),
+        ("192.168.0.10", True),
+        ("192.168.0.11", False),
+        # Lowest and highest addresses
+        ("0.0.0.0", False),  # noqa: S104
+        ("255.255.255.255", True),
+        ("255.255.255.254", False),
+        ("2001:db8::", True),
+        ("2001:db8::ffff:ffff:ffff:ffff", True),
+        ("2001:db8:0:1::", False),
+        ("2001:db7:ffff:ffff:ffff:ffff:ffff:ffff", False),
+        ("::1", True),
+        ("::", False),
+        ("::2", False),
+    ],
+)
+def test_boundaries(ip: str, expected: bool) -> None:  # noqa: FBT001
+    rules = parse_trusted_ips(
+        "10.0.1.0/24,192.168.0.10,255.255.255.255,2001:db8::/64,::1",
+    )
+    matcher = IPMatcher(rules)
+
+    assert matcher.matches(ip) is expected
+    assert matcher.matches(ip_address(ip)) is expected
+    assert linear_scan(rules, ip_address(ip)) is expected
+
+
+@pytest.mark.parametrize(
+    ("rules", "matching", "not_matching"),
+    [
+        # Adjacent networks are merged into a single range
+        (
+            "10.0.0.0/24,10.0.1.0/24,10.0.2.0",
+            ["10.0.0.0", "10.0.1.128", "10.0.2.0"],
+            ["9.255.255.255", "10.0.2.1"],
+        ),
+        # Overlapping and contained networks
+        (
+            "10.0.0.0/16,10.0.5.0/24,10.0.255.255,10.0.128.0/17",
+            ["10.0.0.0", "10.0.5.5", "10.0.200.1", "10.0.255.255"],
+            ["10.1.0.0", "9.255.255.255"],
+        ),
+        # Networks which only partially overlap
+        (
+            "10.0.0.0/23,10.0.1.0/24,10.0.1.128/25,10.0.3.0/24",
+            ["10.0.1.255", "10.0.3.0"],
+            ["10.0.2.0", "10.0.2.255", "10.0.4.0"],
+        ),
+        # Duplicate rules
+        (
+            "10.0.0.1,10.0.0.1,10.0.0.0/31,10.0.0.0/31",
+            ["10.0.0.0", "10.0.0.1"],
+            ["10.0.0.2"],
+        ),
+    ],
+)
+def test_merged_networks(
+    rules: str,
+    matching: list[str],
+    not_matching: list[str],
+) -> None:
+    matcher = IPMatcher(parse_trusted_ips(rules))
+
+    for ip in matching:
+        assert matcher.matches(ip), ip
+    for ip in not_matching:
+        assert not matcher.matches(ip), ip
+
+
+def test_ip_versions_are_separate() -> None:
+    # The same integer values in the other IP version don't match
+    matcher = IPMatcher(parse_trusted_ips("0.0.0.0/0,::1"))
+
+    assert matcher.matches("203.0.113.7")
+    assert not matcher.matches("::2")
+    assert not matcher.matches("2001:db8::cb00:7107")
+
+    matcher = IPMatcher(parse_trusted_ips("::/0"))
+    assert matcher.matches("2001:db8::1")
+    assert not matcher.matches("203.0.113.7")
+
+
+def test_ipv4_mapped_ipv6() -> None:
+    # Mapped addresses are IPv6 addresses, just like with the linear scan they
+    # only match IPv6 rules.
+    matcher = IPMatcher(parse_trusted_ips("203.0.113.0/24"))
+    assert matcher.matches("203.0.113.7")
+    assert not matcher.matches("::ffff:203.0.113.7")
+
+    matcher = IPMatcher(parse_trusted_ips("::ffff:203.0.113.0/120"))
+    assert matcher.matches("::ffff:203.0.113.7")
+    assert not matcher.matches("::ffff:203.0.114.7")
+    assert not matcher.matches("203.0.113.7")
+
+
+def test_empty_rules() -> None:
+    matcher = IPMatcher([])
+
+    for ip in ["0.0.0.1", "203.0.113.7", "255.255.255.255", "::", "::1"]:
+        assert not matcher.matches(ip)
+        assert not is_allowed_ip(allowed_ips=matcher, client_ip=ip)
+
+
+def test_invalid_ip() -> None:
+    matcher = IPMatcher(parse_trusted_ips("0.0.0.0/0"))
+
+    with pytest.raises(ValueError):  # noqa: PT011
+        matcher.matches("not an ip")
+
+
+def test_cached_results() -> None:
+    matcher = IPMatcher(parse_trusted_ips("10.0.0.0/8"))
+
+    for _ in range(3):
+        assert matcher.matches("10.1.2.3")
+        assert not matcher.matches("11.1.2.3")
+
+
+def random_rules(rng: random.Random, count: int) -> list[IPv4Network | IPv6Network]:
+    rules: list[IPv4Network | IPv6Network] = []
+    for _ in range(count):
+        if rng.random() < 0.5:
+            prefix = rng.randint(16, 32)
+            rules.append(
+                IPv4Network(
+                    (rng.getrandbits(32) >> (32 - prefix) << (32 - prefix), prefix),
+                ),
+            )
+        else:
+            prefix = rng.randint(96, 128)
+            rules.append(
+                IPv6Network(
+                    (rng.getrandbits(128) >> (128 - prefix) << (128 - prefix), prefix),
+                ),
+            )
+    return rules
+
+
+def test_same_as_linear_scan() -> None:
+    rng = random.Random(0)
+    rules = random_rules(rng, 500)
+    matcher = IPMatcher(rules)
+
+    candidates: list[IPAddress] = []
+    for rule in rules:
+        # Addresses at and just outside of the boundaries of every rule
+        first = int(rule.network_address)
+        last = int(rule.broadcast_address)
+        address = IPv4Address if rule.version == 4 else IPv6Address
+        maximum = 2**rule.max_prefixlen - 1
+        candidates.extend(
+            address(value)
+            for value in (first - 1, first, last, last + 1)
+            if 0 <= value <= maximum
+        )
+
+    for ip in candidates:
+        assert matcher.matches(ip) is linear_scan(rules, ip), ip
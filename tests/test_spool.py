@@ -0,0 +1,212 @@
+"""Spooling activities to disk and replaying them, also after a crash."""
+
+import asyncio
+import zlib
+from pathlib import Path
+
+import pytest
+
+from activitypub_federation_queue_batcher._spool_helpers import (
+    SPOOL_RECORD_PREFIX,
+    ActivitySpool,
+    iter_spool_records,
+)
+
+RECORDS = [b"a", b"{}" * 100, bytes(range(256)), b"\0" * 8]
+
+
+def encode_records(records: list[bytes]) -> bytes:
+    return b"".join(
+        SPOOL_RECORD_PREFIX.pack(len(data), zlib.crc32(data)) + data for data in records
+    )
+
+
+def write_segment(directory: Path, index: int, data: bytes) -> Path:
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"{index:020d}.spool"
+    path.write_bytes(data)
+    return path
+
+
+class Publisher:
+    def __init__(self, *, fail_at: int | None = None) -> None:
+        self.chunks: list[list[bytes]] = []
+        # Index of a chunk which fails to be published once
+        self.fail_at = fail_at
+
+    async def __call__(self, chunk: list[bytes]) -> None:
+        if len(self.chunks) == self.fail_at:
+            self.fail_at = None
+            msg = "Queue unavailable"
+            raise ConnectionError(msg)
+
+        self.chunks.append(chunk)
+
+    @property
+    def records(self) -> list[bytes]:
+        return [data for chunk in self.chunks for data in chunk]
+
+
+def replay(spool: ActivitySpool, publisher: Publisher, chunk_size: int = 2) -> None:
+    async def run() -> None:
+        await spool.replay(publisher, chunk_size)
+
+    asyncio.run(run())
+
+
+def test_iter_records(tmp_path: Path) -> None:
+    data = encode_records(RECORDS)
+    path = write_segment(tmp_path, 0, data)
+
+    records = list(iter_spool_records(path))
+    assert [record for _, record in records] == RECORDS
+    assert records[-1][0] == len(data)
+
+    # Reading can continue after any record
+    for n, (offset, _) in enumerate(records, 1):
+        assert [record for _, record in iter_spool_records(path, offset)] == RECORDS[n:]
+
+
+def test_truncated_at_every_offset(tmp_path: Path) -> None:
+    # A crash may interrupt writing a record at any point
+    data = encode_records(RECORDS)
+    ends = {len(encode_records(RECORDS[:n])): n for n in range(len(RECORDS) + 1)}
+
+    for i in range(len(data)):
+        path = write_segment(tmp_path, 0, data[:i])
+        complete = max(n for end, n in ends.items() if end <= i)
+
+        assert [record for _, record in iter_spool_records(path)] == RECORDS[:complete]
+
+
+@pytest.mark.parametrize("position", [0, 1, 2, 3])
+def test_corrupted_record(tmp_path: Path, position: int) -> None:
+    # Only the prefix of a record may have made it to disk, with its data
+    # being zeros or garbage
+    start = len(encode_records(RECORDS[:position]))
+    data = bytearray(encode_records(RECORDS))
+    data[start + SPOOL_RECORD_PREFIX.size - 1] ^= 0xFF
+
+    path = write_segment(tmp_path, 0, bytes(data))
+    assert [record for _, record in iter_spool_records(path)] == RECORDS[:position]
+
+
+@pytest.mark.parametrize("size", [1, SPOOL_RECORD_PREFIX.size, 100])
+def test_zeroed_tail(tmp_path: Path, size: int) -> None:
+    # After a crash, a file may have been extended with zeros while the records
+    # written there never made it to disk.
+    path = write_segment(tmp_path, 0, encode_records(RECORDS) + bytes(size))
+
+    assert [record for _, record in iter_spool_records(path)] == RECORDS
+
+
+def test_replay_partial_segment(tmp_path: Path) -> None:
+    data = encode_records(RECORDS)
+    write_segment(tmp_path, 0, data + encode_records([b"partial"])[:-1])
+    write_segment(tmp_path, 1, encode_records([b"next"]))
+
+    spool = ActivitySpool(tmp_path, 2**20)
+    publisher = Publisher()
+    replay(spool, publisher)
+
+    # The incomplete record is dropped, following segments are still replayed
+    assert publisher.records == [*RECORDS, b"next"]
+    assert spool.is_empty()
+    assert not (tmp_path / f"{0:020d}.spool").exists()
+    assert not (tmp_path / f"{1:020d}.spool").exists()
+
+    spool.close()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_replay_zeroed_segment(tmp_path: Path) -> None:
+    write_segment(tmp_path, 0, encode_records(RECORDS) + bytes(4096))
+    write_segment(tmp_path, 1, bytes(4096))
+    write_segment(tmp_path, 2, encode_records([b"next"]))
+
+    spool = ActivitySpool(tmp_path, 2**20)
+    publisher = Publisher()
+    replay(spool, publisher)
+    spool.close()
+
+    assert publisher.records == [*RECORDS, b"next"]
+
+
+def test_replay_empty_segment(tmp_path: Path) -> None:
+    write_segment(tmp_path, 0, b"")
+    write_segment(tmp_path, 1, encode_records(RECORDS))
+
+    spool = ActivitySpool(tmp_path, 2**20)
+    publisher = Publisher()
+    replay(spool, publisher)
+    spool.close()
+
+    assert publisher.records == RECORDS
+
+
+def test_replay_continues_after_failure(tmp_path: Path) -> None:
+    write_segment(tmp_path, 0, encode_records(RECORDS))
+    write_segment(tmp_path, 1, encode_records(RECORDS[::-1]))
+
+    spool = ActivitySpool(tmp_path, 2**20)
+    publisher = Publisher(fail_at=1)
+    with pytest.raises(ConnectionError):
+        replay(spool, publisher)
+    assert publisher.records == RECORDS[:2]
+    assert not spool.is_empty()
+
+    # The chunk which failed is published again, but not the ones before it
+    replay(spool, publisher)
+    assert publisher.records == [*RECORDS, *RECORDS[::-1]]
+    spool.close()
+
+
+def test_replay_after_restart(tmp_path: Path) -> None:
+    # The process stopped in the middle of replaying a partially written segment
+    write_segment(tmp_path, 0, encode_records(RECORDS)[:-1])
+
+    spool = ActivitySpool(tmp_path, 2**20)
+    publisher = Publisher(fail_at=1)
+    with pytest.raises(ConnectionError):
+        replay(spool, publisher)
+    spool.close()
+
+    # Replaying starts over at the beginning of the segment
+    spool = ActivitySpool(tmp_path, 2**20)
+    restarted = Publisher()
+    replay(spool, restarted)
+    spool.close()
+
+    assert publisher.records == RECORDS[:2]
+    assert restarted.records == RECORDS[:-1]
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_append_and_replay(tmp_path: Path) -> None:
+    # Segments left behind by a previous run are replayed first
+    write_segment(tmp_path, 3, encode_records([b"old"]))
+    adopted = write_segment(tmp_path / "other", 0, encode_records([b"adopted"]))
+    publisher = Publisher()
+
+    async def run() -> None:
+        spool = ActivitySpool(tmp_path, 10, adopted=[adopted])
+        sync = asyncio.create_task(spool.run())
+        try:
+            for i in range(5):
+                await spool.append(f"new {i}".encode())
+
+            await spool.replay(publisher, 2)
+            assert spool.is_empty()
+        finally:
+            sync.cancel()
+            spool.close()
+
+    asyncio.run(run())
+
+    assert publisher.records == [
+        b"adopted",
+        b"old",
+        *(f"new {i}".encode() for i in range(5)),
+    ]
+    assert list(tmp_path.glob("*.spool")) == []
+    assert not adopted.exists()